@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from elasticsearch.serializer import JSONSerializer
+
+import sync_es
+
+
+class InjectedCrash(Exception):
+    pass
+
+
+class FakeElasticsearch(object):
+    ''' Enough of the es client for helpers.bulk, keeping the documents in memory.
+        Each bulk request takes latency + per_action * actions seconds. Updates of missing
+        documents fail with document_missing_exception and deletes of them with a 404 like
+        in es, and missing_rate of the other updates fail that way too. After crash_after
+        bulk requests, the next one raises InjectedCrash, either before or after applying
+        its actions. '''
+
+    def __init__(self, latency=0, per_action=0, missing_rate=0, crash_after=None, seed=0):
+        self.transport = type('Transport', (), {'serializer': JSONSerializer()})()
+        self.latency = latency
+        self.per_action = per_action
+        self.missing_rate = missing_rate
+        self.crash_after = crash_after
+        self.random = random.Random(seed)
+        # (index, id) -> source
+        self.docs = {}
+        self.bulk_sizes = []
+        self.lock = threading.Lock()
+
+    def bulk(self, body, *args, **kwargs):
+        lines = body.splitlines()
+        requests = []
+        while lines:
+            ((op_type, meta),) = json.loads(lines.pop(0)).items()
+            source = None if op_type == 'delete' else json.loads(lines.pop(0))
+            requests.append((op_type, meta, source))
+
+        time.sleep(self.latency + self.per_action * len(requests))
+        with self.lock:
+            crash = self.crash_after is not None and len(self.bulk_sizes) >= self.crash_after
+            if crash:
+                self.crash_after = None
+                if self.random.random() < 0.5:
+                    raise InjectedCrash('before applying')
+
+            self.bulk_sizes.append(len(requests))
+            items = [{op_type: self._apply(op_type, meta, source)}
+                     for op_type, meta, source in requests]
+            if crash:
+                raise InjectedCrash('after applying')
+
+        return {'took': 1, 'errors': any(item[op_type]['status'] >= 300
+                                         for item in items for op_type in item),
+                'items': items}
+
+    def _apply(self, op_type, meta, source):
+        key = (meta['_index'], meta['_id'])
+        result = {'_index': meta['_index'], '_id': meta['_id'], 'status': 200}
+        doc = self.docs.get(key)
+        if op_type == 'delete':
+            if self.docs.pop(key, None) is None:
+                result.update(status=404, result='not_found')
+        elif op_type == 'update':
+            if (doc is None and not source.get('doc_as_upsert')) or \
+                    (doc is not None and self.random.random() < self.missing_rate):
+                result.update(status=404, error={
+                    'type': 'document_missing_exception',
+                    'reason': '[_doc][{}]: document missing'.format(meta['_id'])})
+            else:
+                self.docs[key] = dict(doc or {}, **source['doc'])
+        else:
+            self.docs[key] = source
+        return result
+
+
+def write_churn_recording(path, events, seed=0):
+    ''' Records events shaped like the site: new torrents with their stats, edits, the odd
+        deletion, and mostly tracker stats updates of 1-50 torrents at a time '''
+    rng = random.Random(seed)
+    now = datetime(2020, 1, 1)
+    torrents = {}
+    next_id = 1
+
+    def torrent_row(torrent_id):
+        return {'id': torrent_id, 'display_name': 'Torrent {}'.format(torrent_id),
+                'created_time': now, 'updated_time': now, 'description': '',
+                'info_hash': torrent_id.to_bytes(20, 'big'), 'filesize': torrent_id * 1024,
+                'uploader_id': rng.randrange(1, 1000), 'main_category_id': 1,
+                'sub_category_id': 1, 'comment_count': 0, 'flags': rng.choice((0, 2, 4)),
+                'has_torrent': 1}
+
+    def stats_row(torrent_id):
+        return {'torrent_id': torrent_id, 'last_updated': now,
+                'download_count': rng.randrange(1000), 'leech_count': rng.randrange(100),
+                'seed_count': rng.randrange(100)}
+
+    with open(path, 'w') as f:
+        for i in range(events):
+            now += timedelta(milliseconds=rng.randrange(10))
+            # rotate the log now and then, so replay has to order file names too
+            pos = ('mysql-bin.{:06d}'.format(1 + i // 50000), 4 + (i % 50000) * 100,
+                   now.timestamp())
+            r = rng.random()
+            if r < 0.05 or len(torrents) < 100:
+                torrent_id, next_id = next_id, next_id + 1
+                torrents[torrent_id] = torrent_row(torrent_id)
+                sync_es.record_event(f, pos, 'nyaa_torrents', 'WriteRowsEvent',
+                                     [{'values': torrents[torrent_id]}])
+                sync_es.record_event(f, pos[:1] + (pos[1] + 50,) + pos[2:], 'nyaa_statistics',
+                                     'WriteRowsEvent', [{'values': stats_row(torrent_id)}])
+            elif r < 0.08:
+                torrent_id = rng.choice(list(torrents))
+                before = torrents[torrent_id]
+                torrents[torrent_id] = dict(before, display_name='Edited {}'.format(i),
+                                            updated_time=now)
+                sync_es.record_event(f, pos, 'nyaa_torrents', 'UpdateRowsEvent',
+                                     [{'before_values': before,
+                                       'after_values': torrents[torrent_id]}])
+            elif r < 0.09:
+                torrent_id = rng.choice(list(torrents))
+                sync_es.record_event(f, pos, 'nyaa_torrents', 'DeleteRowsEvent',
+                                     [{'values': torrents.pop(torrent_id)}])
+            else:
+                rows = [stats_row(torrent_id)
+                        for torrent_id in rng.sample(list(torrents), min(len(torrents),
+                                                                         rng.randint(1, 50)))]
+                sync_es.record_event(f, pos, 'nyaa_statistics', 'UpdateRowsEvent',
+                                     [{'before_values': row, 'after_values': row}
+                                      for row in rows])
+
+
+def count_actions(path):
+    return sum(1 for _ in sync_es.ReplaySource(path))
+
+
+def run_engine(source, es, save_pos=None, **options):
+    ''' Syncs source into es, returns the seconds taken '''
+    engine = sync_es.SyncEngine(
+        source, sync_es.EsSink(es, options.pop('es_chunk_size', 10000)),
+        save_pos=save_pos or (lambda log_file, log_pos, synced_time: None), **options)
+    started = time.time()
+    engine.run()
+    return time.time() - started
+
+
+def crash_restart(path, crashes, seed=0, **options):
+    ''' Syncs a recording into a fake es that crashes now and then, restarting from the
+        saved position each time like a supervisor would. Returns (the final documents,
+        restarts, actions read, whether the saved positions only ever went forward). '''
+    rng = random.Random(seed)
+    es = FakeElasticsearch(seed=seed)
+    pos = None
+    restarts = actions_read = 0
+    in_order = True
+
+    while True:
+        es.crash_after = len(es.bulk_sizes) + rng.randrange(1, 20) \
+            if restarts < crashes else None
+        saves = []
+
+        def counted(source):
+            nonlocal actions_read
+            for item in source:
+                actions_read += 1
+                yield item
+
+        source = sync_es.ReplaySource(path, *pos) if pos else sync_es.ReplaySource(path)
+        try:
+            run_engine(counted(source), es,
+                       lambda log_file, log_pos, synced_time: saves.append((log_file, log_pos)),
+                       **options)
+            return es.docs, restarts, actions_read, in_order
+        except InjectedCrash:
+            restarts += 1
+        finally:
+            in_order = in_order and saves == sorted(saves) and \
+                not (pos and saves and saves[0] < pos)
+            pos = saves[-1] if saves else pos
+
+
+def quantiles(values):
+    values = sorted(values)
+    return '{}/{}/{}/{}'.format(values[0], values[len(values) // 2],
+                                values[len(values) * 9 // 10], values[-1])
+
+
+@click.group()
+@click.option('--replay', type=click.Path(exists=True, dir_okay=False),
+              help='Events recorded by sync_es (record_file), instead of generated ones.')
+@click.option('--events', type=int, default=50000,
+              help='Binlog events to generate.')
+@click.pass_context
+def bench_sync_es(ctx, replay, events):
+    ''' Runs sync_es' engine offline, on recorded or generated binlog events and an
+        in-memory es. '''
+    # no position saving logs
+    sync_es.log.setLevel('WARNING')
+    if not replay:
+        fd, replay = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        ctx.call_on_close(lambda: os.remove(replay))
+        write_churn_recording(replay, events)
+    ctx.obj = replay
+
+
+@bench_sync_es.command()
+@click.option('--latency', 'latencies', type=float, multiple=True,
+              help='Seconds per bulk request (default: 0.01, 0.05, 0.2, 1).')
+@click.option('--per-action', type=float, default=0.00002,
+              help='Seconds per action in a bulk request.')
+@click.option('--in-flight', 'in_flights', type=int, multiple=True,
+              help='Concurrent bulk requests (default: 1, 2, 4, 8).')
+@click.option('--chunk-size', type=int, default=10000, help='Actions per batch.')
+@click.option('--es-chunk-size', type=int, default=2000, help='Actions per bulk request.')
+@click.option('--missing-rate', type=float, default=0,
+              help='Share of updates to fail with document_missing_exception.')
+@click.pass_obj
+def throughput(replay, latencies, per_action, in_flights, chunk_size, es_chunk_size,
+               missing_rate):
+    ''' Measures sustained actions/s for a range of simulated es bulk latencies and numbers
+        of concurrent bulk requests, and the sizes of the bulk requests made
+        (min/median/90th percentile/max). '''
+    actions = count_actions(replay)
+    click.echo('{} actions'.format(actions))
+    click.echo('latency\tin flight\tactions/s\tbulks\tbulk sizes\tcoalesced')
+    for latency in latencies or (0.01, 0.05, 0.2, 1):
+        for max_in_flight in in_flights or (1, 2, 4, 8):
+            es = FakeElasticsearch(latency=latency, per_action=per_action,
+                                   missing_rate=missing_rate)
+            elapsed = run_engine(sync_es.ReplaySource(replay), es, chunk_size=chunk_size,
+                                 es_chunk_size=es_chunk_size, flush_interval=0.5,
+                                 max_in_flight=max_in_flight)
+            click.echo('{:.3f}\t{}\t{:.0f}\t{}\t{}\t{:.2f}'.format(
+                latency, max_in_flight, actions / elapsed, len(es.bulk_sizes),
+                quantiles(es.bulk_sizes), actions / sum(es.bulk_sizes)))
+
+
+@bench_sync_es.command()
+@click.option('--crashes', type=int, default=10, help='Crashes per run.')
+@click.option('--runs', type=int, default=5)
+@click.option('--in-flight', type=int, default=4, help='Concurrent bulk requests.')
+@click.pass_obj
+def crash(replay, crashes, runs, in_flight):
+    ''' Checks that crashing at random points and restarting from the saved position ends
+        with the same documents as an uninterrupted sync, and how much work the restarts
+        redo. Exits with 1 if not. '''
+    options = {'chunk_size': 1000, 'es_chunk_size': 250, 'flush_interval': 0.05,
+               'max_in_flight': in_flight, 'save_interval': 0.1, 'save_every': 1000}
+    expected = FakeElasticsearch()
+    run_engine(sync_es.ReplaySource(replay), expected, **options)
+    actions = count_actions(replay)
+
+    failed = False
+    click.echo('run\trestarts\tre-read actions\tpositions in order\tdocuments match')
+    for run in range(runs):
+        docs, restarts, actions_read, in_order = crash_restart(
+            replay, crashes, seed=run, **options)
+        matches = docs == expected.docs
+        failed = failed or not (matches and in_order)
+        click.echo('{}\t{}\t{}\t{}\t{}'.format(run, restarts, actions_read - actions,
+                                               'yes' if in_order else 'NO',
+                                               'yes' if matches else 'NO'))
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    bench_sync_es()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+import collections
+import hashlib
+import heapq
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import click
+import sqlalchemy
+
+from nyaa import create_app, info_dicts, models
+from nyaa.extensions import db
+
+FLAVORS = {
+    'nyaa': models.NyaaTorrent,
+    'sukebei': models.SukebeiTorrent,
+}
+
+STORE_CONFIG_KEYS = ['BASE_DIR', 'INFO_DICT_STORE', 'INFO_DICT_PACK_DIR',
+                     'INFO_DICT_COMPRESSION', 'INFO_DICT_MAX_PACK_SIZE']
+
+MISSING = 'missing'
+CORRUPT = 'corrupt'
+ORPHANED = 'orphaned'
+
+# Set up in each worker by _init_worker
+_store = None
+
+
+def _init_worker(store_config):
+    global _store
+    _store = info_dicts.create_store(store_config)
+
+
+def check_batch(rows):
+    ''' Hashes the info dicts of (id, info_hash) rows in a worker.
+        Returns (rows checked, bytes read, [(id, info_hash, problem)]). '''
+    problems = []
+    bytes_read = 0
+    for torrent_id, info_hash in rows:
+        bencoded_info_dict = _store.get(info_hash)
+        if bencoded_info_dict is None:
+            problems.append((torrent_id, info_hash, MISSING))
+            continue
+
+        bytes_read += len(bencoded_info_dict)
+        if hashlib.sha1(bencoded_info_dict).digest() != info_hash:
+            problems.append((torrent_id, info_hash, CORRUPT))
+    return len(rows), bytes_read, problems
+
+
+def stream_batches(connection, torrent_class, after_id, batch_size):
+    ''' Yields lists of (id, info_hash) for torrents with has_torrent set, in id order,
+        read with a server-side cursor '''
+    table = torrent_class.__table__
+    query = sqlalchemy.select([table.c.id, table.c.info_hash]) \
+        .where(sqlalchemy.and_(table.c.has_torrent.is_(True), table.c.id > after_id)) \
+        .order_by(table.c.id)
+    result = connection.execution_options(stream_results=True).execute(query)
+
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        yield [(torrent_id, bytes(info_hash)) for torrent_id, info_hash in rows]
+
+
+def stream_info_hashes(connection, torrent_class):
+    ''' Yields the info hashes of all torrents (whether they have one or not) in order '''
+    table = torrent_class.__table__
+    query = sqlalchemy.select([table.c.info_hash]).order_by(table.c.info_hash)
+    result = connection.execution_options(stream_results=True).execute(query)
+    for (info_hash,) in result:
+        yield bytes(info_hash)
+
+
+class Checkpoint(object):
+    ''' The last torrent id fully checked per flavor, whether orphans were checked,
+        and running totals, saved to a JSON file '''
+
+    def __init__(self, path):
+        self.path = path
+        self.last_ids = {}
+        self.orphans_done = False
+        self.totals = collections.Counter()
+        self._saved_at = 0
+
+        if path and os.path.exists(path):
+            with open(path, 'r') as in_file:
+                data = json.load(in_file)
+            self.last_ids = data['last_ids']
+            self.orphans_done = data['orphans_done']
+            self.totals.update(data['totals'])
+
+    def save(self, force=False):
+        now = time.time()
+        if not self.path or (not force and now - self._saved_at < 5):
+            return
+        self._saved_at = now
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as out_file:
+            json.dump({'last_ids': self.last_ids, 'orphans_done': self.orphans_done,
+                       'totals': self.totals}, out_file)
+        os.replace(temp_path, self.path)
+
+
+def report(flavor, torrent_id, info_hash, problem):
+    click.echo('{}\t{}\t{}\t{}'.format(problem, flavor, torrent_id or '-', info_hash.hex()))
+
+
+def clear_has_torrent(torrent_class, torrent_ids):
+    table = torrent_class.__table__
+    db.session.execute(table.update()
+                       .where(table.c.id.in_(torrent_ids))
+                       .values(has_torrent=False))
+    db.session.commit()
+
+
+def scan_flavor(flavor, pool, checkpoint, fix, batch_size, max_pending):
+    torrent_class = FLAVORS[flavor]
+    after_id = checkpoint.last_ids.get(flavor, 0)
+    if after_id:
+        click.echo('Resuming {} after id {}'.format(flavor, after_id), err=True)
+
+    started = last_progress = time.time()
+    checked = bytes_read = 0
+    pending = collections.deque()
+
+    def finish_oldest():
+        nonlocal checked, bytes_read
+        last_id, async_result = pending.popleft()
+        count, batch_bytes, problems = async_result.get()
+
+        for torrent_id, info_hash, problem in problems:
+            report(flavor, torrent_id, info_hash, problem)
+            checkpoint.totals[problem] += 1
+        if fix and problems:
+            clear_has_torrent(torrent_class, [torrent_id for torrent_id, _, _ in problems])
+
+        checked += count
+        bytes_read += batch_bytes
+        checkpoint.totals['checked'] += count
+        # Batches finish in order, so everything up to here is done
+        checkpoint.last_ids[flavor] = last_id
+        checkpoint.save()
+
+    with db.engine.connect() as connection:
+        for rows in stream_batches(connection, torrent_class, after_id, batch_size):
+            pending.append((rows[-1][0], pool.apply_async(check_batch, (rows,))))
+            # Don't read further ahead than the pool can hash
+            while len(pending) > max_pending:
+                finish_oldest()
+
+            now = time.time()
+            if now - last_progress >= 10:
+                last_progress = now
+                elapsed = now - started
+                click.echo('{}: {} checked, {:.0f}/s, {:.1f} MiB/s'.format(
+                    flavor, checked, checked / elapsed, bytes_read / elapsed / 1024 ** 2),
+                    err=True)
+
+        while pending:
+            finish_oldest()
+
+    checkpoint.save(force=True)
+    elapsed = max(time.time() - started, 0.001)
+    click.echo('{}: done, {} checked in {:.0f}s ({:.0f}/s, {:.1f} MiB/s)'.format(
+        flavor, checked, elapsed, checked / elapsed, bytes_read / elapsed / 1024 ** 2), err=True)
+
+
+def has_torrent_with_hash(connection, info_hash):
+    ''' Looks up whether a torrent of any flavor has the info hash right now '''
+    for torrent_class in FLAVORS.values():
+        table = torrent_class.__table__
+        query = sqlalchemy.select([table.c.id]).where(table.c.info_hash == info_hash).limit(1)
+        if connection.execute(query).first() is not None:
+            return True
+    return False
+
+
+def scan_orphans(store, checkpoint, fix):
+    ''' Finds stored info dicts that no torrent (of any flavor) refers to, by merging
+        the sorted stored hashes with the sorted hashes of all torrents '''
+    flavors = sorted(FLAVORS)
+    connections = [db.engine.connect() for _ in flavors]
+    lookup_connection = db.engine.connect()
+    try:
+        torrent_hashes = heapq.merge(*(stream_info_hashes(connection, FLAVORS[flavor])
+                                       for connection, flavor in zip(connections, flavors)))
+        torrent_hash = next(torrent_hashes, None)
+
+        for info_hash in store.iter_hashes():
+            while torrent_hash is not None and torrent_hash < info_hash:
+                torrent_hash = next(torrent_hashes, None)
+            if torrent_hash == info_hash:
+                continue
+            # Torrents uploaded since the hash streams started are not in them
+            if has_torrent_with_hash(lookup_connection, info_hash):
+                continue
+
+            report('-', None, info_hash, ORPHANED)
+            checkpoint.totals[ORPHANED] += 1
+            if fix:
+                store.delete(info_hash)
+    finally:
+        for connection in connections + [lookup_connection]:
+            connection.close()
+
+
+@click.command()
+@click.option('--flavor', 'flavors', type=click.Choice(sorted(FLAVORS)), multiple=True,
+              help='Torrent tables to check (default: all).')
+@click.option('--fix', is_flag=True, default=False,
+              help='Clear has_torrent on missing/corrupt torrents, and delete orphans.')
+@click.option('--orphans/--no-orphans', default=True,
+              help='Also look for info dicts no torrent refers to (default: yes).')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='File to save progress in, and resume from.')
+@click.option('--workers', type=int, default=os.cpu_count(),
+              help='Hashing processes (default: CPU count).')
+@click.option('--batch-size', type=int, default=1000)
+def check_info_dicts(flavors, fix, orphans, checkpoint, workers, batch_size):
+    ''' Checks that every torrent with has_torrent set has an info dict matching its
+        info_hash. Problems are written to stdout as tab-separated
+        (problem, flavor, id, info hash) lines, progress to stderr. '''
+    app = create_app('config')
+    flavors = flavors or sorted(FLAVORS)
+    checkpoint = Checkpoint(checkpoint)
+
+    with app.app_context():
+        store_config = {key: app.config.get(key) for key in STORE_CONFIG_KEYS}
+        store_config['INFO_DICT_STORE'] = store_config['INFO_DICT_STORE'] or 'files'
+
+        with multiprocessing.Pool(workers, _init_worker, (store_config,)) as pool:
+            for flavor in flavors:
+                scan_flavor(flavor, pool, checkpoint, fix, batch_size, max_pending=workers * 4)
+
+        if orphans:
+            if checkpoint.orphans_done:
+                click.echo('Orphans already checked, skipping', err=True)
+            else:
+                scan_orphans(info_dicts.create_store(store_config), checkpoint, fix)
+                checkpoint.orphans_done = True
+                checkpoint.save(force=True)
+
+    click.echo(', '.join('{} {}'.format(count, key)
+                         for key, count in sorted(checkpoint.totals.items())), err=True)
+    if any(checkpoint.totals[problem] for problem in (MISSING, CORRUPT, ORPHANED)) and not fix:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    check_info_dicts()
@@ -146,6 +146,16 @@ PER_IP_ACCOUNT_COOLDOWN = 24 * 3600
 # Backup original .torrent uploads
 BACKUP_TORRENT_FOLDER = 'torrents'
 
+# Where the info dicts of uploaded torrents are kept:
+# 'files' - one file each, under BASE_DIR/info_dicts/
+# 'packed' - appended into large pack files in INFO_DICT_PACK_DIR (default
+#   BASE_DIR/info_dict_packs), see pack_info_dicts.py for migrating and compacting
+INFO_DICT_STORE = 'files'
+INFO_DICT_PACK_DIR = None
+# None, 'zlib' or 'zstd' (needs the zstandard package). Only affects new entries.
+INFO_DICT_COMPRESSION = None
+INFO_DICT_MAX_PACK_SIZE = 1024 ** 3
+
 ############
 ## Search ##
 ############
@@ -156,9 +166,40 @@ RESULTS_PER_PAGE = 75
 # How many pages we'll return at most
 MAX_PAGES = 100
 
+# Page listings and searches with next/previous links (cursors) instead of page numbers,
+# so deep pages are as cheap as the first one. Page numbers (?p=) keep working
+# (and are still limited by MAX_PAGES and ES_MAX_SEARCH_RESULT), cursors aren't limited.
+# With False, listings have page numbers, but cursors given in links still work.
+SEARCH_KEYSET_PAGINATION = False
+
+# Database listings (with page numbers) that skip counting their results, and only
+# show whether there's a next page: 'browse' (the front page, for visitors who aren't
+# logged in) and 'user' (user pages). RSS feeds never count.
+# For example: SEARCH_COUNTLESS_PAGINATION = ['browse', 'user']
+SEARCH_COUNTLESS_PAGINATION = []
+
+# Count search results without a search term or user from the torrent_counts table,
+# instead of counting torrents. Run reconcile_torrent_counts.py periodically (say, daily)
+# to fix any drift, for example from torrents changed by hand in the database.
+SEARCH_TORRENT_COUNTS = False
+
 # How long and how many entries to cache for count queries
 COUNT_CACHE_SIZE = 256
 COUNT_CACHE_DURATION = 30
+# Where to cache counts: 'local' (per worker process, COUNT_CACHE_SIZE entries)
+# or 'shared' (in the app cache, see Cache below, shared by all workers)
+COUNT_CACHE_BACKEND = 'local'
+
+# How long to keep search results (torrent ids and counts) in the app cache (see Cache
+# below, entries count against CACHE_THRESHOLD and are about 1KB each). Set to 0 to disable.
+# Moderators always bypass it. Results may be this many seconds old, for example 60.
+SEARCH_CACHE_TIMEOUT = 0
+# How long for the newest torrents (first page sorted by date, and RSS), if enabled
+SEARCH_CACHE_NEWEST_TIMEOUT = 10
+
+# Most results /export.jsonl streams for a search (one JSON object per torrent).
+# Set to 0 to disable the endpoint.
+SEARCH_EXPORT_MAX_RESULTS = 100000
 
 # Use baked queries for database search
 USE_BAKED_SEARCH = False
@@ -166,15 +207,44 @@ USE_BAKED_SEARCH = False
 # Use better searching with ElasticSearch
 # See README.MD on setup!
 USE_ELASTIC_SEARCH = False
+# Use ES for listings without a search term too (front page, categories, user pages),
+# instead of the database. They go back to the database while ES is failing (for
+# ES_BROWSE_RETRY_INTERVAL seconds after an error) or more than ES_BROWSE_MAX_LAG
+# seconds behind it.
+ES_BROWSE = False
+ES_BROWSE_RETRY_INTERVAL = 30
+ES_BROWSE_MAX_LAG = 300
+# Tell users when listings from ES are this many seconds behind
+ES_BROWSE_LAG_NOTICE = 30
+# sync_es's position file ("save_loc" in its config), which tells how far behind ES is.
+# Must be readable by the site. None to not check.
+ES_SYNC_STATE_FILE = None
+# Count front page ES results per category and filter in the same request, and show
+# the counts above the results
+ES_SEARCH_FACETS = False
 # Highlight matches (for debugging)
 ENABLE_ELASTIC_SEARCH_HIGHLIGHT = False
 
 # Max ES search results, do not set over 10000
 ES_MAX_SEARCH_RESULT = 1000
-# ES index name generally (nyaa or sukebei)
+# ES index name generally (nyaa or sukebei). reindex_es.py turns it into an alias of
+# versioned indices, which it swaps when rebuilding
 ES_INDEX_NAME = SITE_FLAVOR
 # ES hosts
 ES_HOSTS = ['localhost:9200']
+# Connections kept open to each ES node, per worker process. Searches beyond this
+# open throwaway connections (counted in es.stats.pool_exhausted).
+# With gevent, set this to about the number of concurrent searches per worker.
+ES_POOL_SIZE = 10
+# Request timeout in seconds, how many times to retry a request on another node,
+# and whether timeouts should be retried too
+ES_TIMEOUT = 10
+ES_MAX_RETRIES = 3
+ES_RETRY_ON_TIMEOUT = False
+# Discover the other nodes of the cluster from ES_HOSTS (on start, on connection
+# failure and every ES_SNIFF_INTERVAL seconds)
+ES_SNIFF = False
+ES_SNIFF_INTERVAL = 60
 
 ################
 ## Commenting ##
@@ -217,6 +287,27 @@ CACHE_THRESHOLD = 8192
 # CACHE_REDIS_HOST = "127.0.0.1"
 # CACHE_KEY_PREFIX = "catcache_"
 
+# Maximum total size in bytes of generated .torrent files to keep in memory (per worker)
+# for downloads. Set to 0 to disable.
+TORRENT_FILE_CACHE_SIZE = 64 * 1024 * 1024
+
+# How .torrent downloads get their info dict (the bulk of the file) to the client:
+# None - read it and send the whole file from Python
+# 'ssi' - redirect (X-Accel-Redirect) to the front-end server's internal /_ssi/ location,
+#   which gets only the metadata around it, with an SSI include it fills in from
+#   TORRENT_INFO_DICT_SSI_LOCATION (see .docker/nginx.conf)
+# 'file_wrapper' - send the metadata from Python and the info dict file through the
+#   WSGI server's wsgi.file_wrapper
+# Both need INFO_DICT_STORE = 'files', and act like None otherwise.
+TORRENT_FILE_DELIVERY = None
+# Internal front-end location serving BASE_DIR/info_dicts/
+TORRENT_INFO_DICT_SSI_LOCATION = '/_info_dicts/'
+
+# Most .torrent files /download/torrents.zip sends at once, given either ?ids=1,2,3
+# or the search arguments of the front page (one page of this many results).
+# Set to 0 to disable the endpoint.
+BULK_DOWNLOAD_MAX_TORRENTS = 100
+
 
 ###############
 ## Ratelimit ##
@@ -4,26 +4,40 @@ Bulk load torents from mysql into elasticsearch `nyaav2` index,
 which is assumed to already exist.
 This is a one-shot deal, so you'd either need to complement it
 with a cron job or some binlog-reading thing (TODO)
+
+Torrents are read in id ranges ("shards") by a pool of processes, each
+streaming its range with a server-side cursor and pushing it with parallel
+bulk requests. With --state-file, finished ranges are remembered and an
+interrupted import picks up where it left off.
 """
-import sys
 import json
+import multiprocessing
+import os
+import time
 
-# This should be progressbar33
-import progressbar
-from elasticsearch import Elasticsearch
+import click
+import sqlalchemy
+from elasticsearch import Elasticsearch, helpers
 from elasticsearch.client import IndicesClient
-from elasticsearch import helpers
 
 from nyaa import create_app, models
 from nyaa.extensions import db
 
-app = create_app('config')
-es = Elasticsearch(hosts=app.config['ES_HOSTS'], timeout=30)
-ic = IndicesClient(es)
+FLAVORS = {
+    'nyaa': models.NyaaTorrent,
+    'sukebei': models.SukebeiTorrent,
+}
+
+# Set up in each worker by _init_worker
+_app = None
+_es = None
+_bulk_options = None
+
 
 def pad_bytes(in_bytes, size):
     return in_bytes + (b'\x00' * max(0, size - len(in_bytes)))
 
+
 # turn into thing that elasticsearch indexes. We flatten in
 # the stats (seeders/leechers) so we can order by them in es naturally.
 # we _don't_ dereference uploader_id to the user's display name however,
@@ -68,66 +82,177 @@ def mk_es(t, index_name):
         }
     }
 
-# page through an sqlalchemy query, like the per_fetch but
-# doesn't break the eager joins its doing against the stats table.
-# annoying that this isn't built in somehow.
-def page_query(query, limit=sys.maxsize, batch_size=10000, progress_bar=None):
-    start = 0
-    while True:
-        # XXX very inelegant way to do this, i'm confus
-        stop = min(limit, start + batch_size)
-        if stop == start:
-            break
-        things = query.slice(start, stop)
-        if not things:
-            break
-        had_things = False
-        for thing in things:
-            had_things = True
-            yield(thing)
-        if not had_things or stop == limit:
-            break
-        if progress_bar:
-            progress_bar.update(start)
-        start = min(limit, start + batch_size)
-
-FLAVORS = [
-    ('nyaa', models.NyaaTorrent),
-    ('sukebei', models.SukebeiTorrent)
-]
-
-# Get binlog status from mysql
-with app.app_context():
-    master_status = db.engine.execute('SHOW MASTER STATUS;').fetchone()
 
-    position_json = {
+def _init_worker(bulk_options):
+    global _app, _es, _bulk_options
+    # A fresh app gets its own engine, so no connections are shared with the parent
+    _app = create_app('config')
+    _es = Elasticsearch(hosts=_app.config['ES_HOSTS'], timeout=30)
+    _bulk_options = bulk_options
+
+
+def import_shard(shard):
+    ''' Indexes the torrents of a flavor with start <= id < stop into index_name, in a worker.
+        Returns (shard, torrents indexed, seconds taken). '''
+    flavor, index_name, start, stop = shard
+    torrent_class = FLAVORS[flavor]
+    started = time.time()
+
+    with _app.app_context():
+        # yield_per streams the rows with a server-side cursor, keeping the joined stats
+        query = torrent_class.query \
+            .filter(torrent_class.id >= start, torrent_class.id < stop) \
+            .order_by(torrent_class.id) \
+            .yield_per(_bulk_options['chunk_size'])
+
+        count = 0
+        for ok, _ in helpers.parallel_bulk(_es, (mk_es(t, index_name) for t in query),
+                                           **_bulk_options):
+            count += ok
+        db.session.remove()
+
+    return shard, count, time.time() - started
+
+
+def id_ranges(torrent_class, range_size):
+    ''' Splits the ids of a torrent table into [start, stop) ranges of range_size ids '''
+    table = torrent_class.__table__
+    min_id, max_id = db.session.execute(
+        sqlalchemy.select([sqlalchemy.func.min(table.c.id),
+                           sqlalchemy.func.max(table.c.id)])).fetchone()
+    if min_id is None:
+        return []
+
+    first = min_id - min_id % range_size
+    return [(start, start + range_size) for start in range(first, max_id + 1, range_size)]
+
+
+def binlog_position():
+    ''' Gets the current binlog position from mysql, as sync_es saves it '''
+    master_status = db.engine.execute('SHOW MASTER STATUS;').fetchone()
+    return {
         'log_file': master_status[0],
         'log_pos': master_status[1]
     }
 
-    print('Save the following in the file configured in your ES sync config JSON:')
-    print(json.dumps(position_json))
 
-    for flavor, torrent_class in FLAVORS:
-        print('Importing torrents for index', flavor, 'from', torrent_class)
-        bar = progressbar.ProgressBar(
-            maxval=torrent_class.query.count(),
-            widgets=[ progressbar.SimpleProgress(),
-                      ' [', progressbar.Timer(), '] ',
-                      progressbar.Bar(),
-                      ' (', progressbar.ETA(), ') ',
-                ])
+class ImportState(object):
+    ''' The binlog position an import started at, the range size it uses and the id ranges
+        it finished per flavor, saved to a JSON file '''
 
-        # turn off refreshes while bulk loading
-        ic.put_settings(body={'index': {'refresh_interval': '-1'}}, index=flavor)
+    def __init__(self, path):
+        self.path = path
+        self.position = None
+        self.range_size = None
+        self.done = {}
 
-        bar.start()
-        helpers.bulk(es, (mk_es(t, flavor) for t in page_query(torrent_class.query, progress_bar=bar)), chunk_size=10000)
-        bar.finish()
+        if path and os.path.exists(path):
+            with open(path, 'r') as in_file:
+                data = json.load(in_file)
+            self.position = data['position']
+            self.range_size = data['range_size']
+            self.done = {flavor: set(map(tuple, ranges))
+                         for flavor, ranges in data['done'].items()}
 
-        # Refresh the index immideately
-        ic.refresh(index=flavor)
-        print('Index refresh done.')
+    def save(self):
+        if not self.path:
+            return
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as out_file:
+            json.dump({'position': self.position, 'range_size': self.range_size,
+                       'done': {flavor: sorted(ranges) for flavor, ranges in self.done.items()}},
+                      out_file)
+        os.replace(temp_path, self.path)
+
+    def finish(self):
+        ''' Forgets the import, so the next run starts over '''
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def import_flavor(flavor, pool, ic, state, index_name=None):
+    ''' Imports the torrents of a flavor into index_name (default: the flavor) '''
+    torrent_class = FLAVORS[flavor]
+    index_name = index_name or flavor
+    done = state.done.setdefault(flavor, set())
+    ranges = id_ranges(torrent_class, state.range_size)
+    shards = [(flavor, index_name, start, stop)
+              for start, stop in ranges if (start, stop) not in done]
 
+    click.echo('Importing torrents for index {} from {}: {} of {} id ranges left'.format(
+        index_name, torrent_class.__name__, len(shards), len(ranges)), err=True)
+    if not shards:
+        return
+
+    # turn off refreshes while bulk loading
+    ic.put_settings(body={'index': {'refresh_interval': '-1'}}, index=index_name)
+    started = time.time()
+    total = 0
+    try:
+        for (_, _, start, stop), count, elapsed in pool.imap_unordered(import_shard, shards):
+            total += count
+            click.echo('{} [{}, {}): {} torrents in {:.1f}s ({:.0f}/s)'.format(
+                flavor, start, stop, count, elapsed, count / max(elapsed, 0.001)), err=True)
+            done.add((start, stop))
+            state.save()
+    finally:
+        # Refresh the index immideately
+        ic.refresh(index=index_name)
         # restore to near-enough real time
-        ic.put_settings(body={'index': {'refresh_interval': '30s'}}, index=flavor)
+        ic.put_settings(body={'index': {'refresh_interval': '30s'}}, index=index_name)
+
+    elapsed = max(time.time() - started, 0.001)
+    click.echo('{}: {} torrents in {:.0f}s ({:.0f}/s)'.format(
+        flavor, total, elapsed, total / elapsed), err=True)
+
+
+@click.command()
+@click.option('--flavor', 'flavors', type=click.Choice(sorted(FLAVORS)), multiple=True,
+              help='Torrent tables to import (default: all).')
+@click.option('--state-file', type=click.Path(dir_okay=False),
+              help='File to save finished id ranges in, and resume from.')
+@click.option('--workers', type=int, default=os.cpu_count(),
+              help='Importing processes (default: CPU count).')
+@click.option('--bulk-threads', type=int, default=2,
+              help='Concurrent bulk requests per process.')
+@click.option('--chunk-size', type=int, default=2000,
+              help='Torrents per bulk request.')
+@click.option('--range-size', type=int, default=100000,
+              help='Torrent ids per shard (fixed once an import has started).')
+def import_to_es(flavors, state_file, workers, bulk_threads, chunk_size, range_size):
+    ''' Imports all torrents into their Elasticsearch indices. Prints the binlog position
+        to start sync_es from on stdout, progress on stderr. '''
+    app = create_app('config')
+    flavors = flavors or sorted(FLAVORS)
+    state = ImportState(state_file)
+    es = Elasticsearch(hosts=app.config['ES_HOSTS'], timeout=30)
+    ic = IndicesClient(es)
+
+    with app.app_context():
+        if state.position is None:
+            # Taken before reading any torrents, so sync_es replays everything
+            # that changes during the import.
+            state.position = binlog_position()
+            state.range_size = range_size
+            state.save()
+        else:
+            click.echo('Resuming import from {}'.format(state_file), err=True)
+
+        print('Save the following in the file configured in your ES sync config JSON:')
+        print(json.dumps(state.position), flush=True)
+
+        # Don't hand pooled connections down to the workers
+        db.session.remove()
+        db.engine.dispose()
+
+        bulk_options = {'thread_count': bulk_threads, 'chunk_size': chunk_size}
+        with multiprocessing.Pool(workers, _init_worker, (bulk_options,)) as pool:
+            for flavor in flavors:
+                import_flavor(flavor, pool, ic, state)
+
+    state.finish()
+
+
+if __name__ == '__main__':
+    import_to_es()
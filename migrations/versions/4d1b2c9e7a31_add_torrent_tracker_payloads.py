@@ -0,0 +1,35 @@
+"""Add torrent tracker payloads
+
+Revision ID: 4d1b2c9e7a31
+Revises: 5cbcee17bece
+Create Date: 2026-10-17 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '4d1b2c9e7a31'
+down_revision = '5cbcee17bece'
+branch_labels = None
+depends_on = None
+
+TABLE_PREFIXES = ('nyaa', 'sukebei')
+
+
+def upgrade():
+    for prefix in TABLE_PREFIXES:
+        op.create_table(prefix + '_torrents_tracker_payload',
+            sa.Column('torrent_id', sa.Integer(), nullable=False),
+            sa.Column('trackers_digest', sa.BINARY(length=20), nullable=False),
+            sa.Column('payload', mysql.MEDIUMBLOB(), nullable=False),
+            sa.ForeignKeyConstraint(['torrent_id'], [prefix + '_torrents.id'], ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('torrent_id')
+        )
+
+
+def downgrade():
+    for prefix in TABLE_PREFIXES:
+        op.drop_table(prefix + '_torrents_tracker_payload')
@@ -0,0 +1,43 @@
+"""Add torrent counts
+
+Revision ID: 9a6e3f1c2b84
+Revises: 4d1b2c9e7a31
+Create Date: 2026-10-17 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a6e3f1c2b84'
+down_revision = '4d1b2c9e7a31'
+branch_labels = None
+depends_on = None
+
+TABLE_PREFIXES = ('nyaa', 'sukebei')
+
+# HIDDEN | TRUSTED | REMAKE | COMPLETE | DELETED, see models.COUNTED_TORRENT_FLAGS
+COUNTED_TORRENT_FLAGS = 2 | 4 | 8 | 16 | 32
+
+
+def upgrade():
+    for prefix in TABLE_PREFIXES:
+        op.create_table(prefix + '_torrent_counts',
+            sa.Column('main_category_id', sa.Integer(), autoincrement=False, nullable=False),
+            sa.Column('sub_category_id', sa.Integer(), autoincrement=False, nullable=False),
+            sa.Column('flags', sa.Integer(), autoincrement=False, nullable=False),
+            sa.Column('torrent_count', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('main_category_id', 'sub_category_id', 'flags')
+        )
+        op.execute(
+            'INSERT INTO {0}_torrent_counts '
+            '(main_category_id, sub_category_id, flags, torrent_count) '
+            'SELECT main_category_id, sub_category_id, flags & {1}, COUNT(*) '
+            'FROM {0}_torrents GROUP BY main_category_id, sub_category_id, flags & {1}'
+            .format(prefix, COUNTED_TORRENT_FLAGS))
+
+
+def downgrade():
+    for prefix in TABLE_PREFIXES:
+        op.drop_table(prefix + '_torrent_counts')
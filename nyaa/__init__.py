@@ -6,7 +6,7 @@ import flask
 from flask_assets import Bundle  # noqa F401
 
 from nyaa.api_handler import api_blueprint
-from nyaa.extensions import assets, cache, db, fix_paginate, limiter, toolbar
+from nyaa.extensions import assets, cache, db, es, fix_paginate, limiter, toolbar
 from nyaa.template_utils import bp as template_utils_bp
 from nyaa.template_utils import caching_url_for
 from nyaa.utils import random_string
@@ -131,4 +131,7 @@ def create_app(config):
     # Rate Limiting, reads app.config itself
     limiter.init_app(app)
 
+    # Elasticsearch client, created on first use in each worker
+    es.init_app(app)
+
     return app
@@ -10,7 +10,7 @@ from werkzeug import secure_filename
 import sqlalchemy
 from orderedset import OrderedSet
 
-from nyaa import models, utils
+from nyaa import info_dicts, models, torrents, utils
 from nyaa.extensions import db
 
 app = flask.current_app
@@ -195,6 +195,7 @@ def handle_torrent_upload(upload_form, uploading_user=None, fromAPI=False):
     # Delete existing torrent which is marked as deleted
     if torrent_data.db_id is not None:
         old_torrent = models.Torrent.by_id(torrent_data.db_id)
+        old_torrent.remove_count()
         db.session.delete(old_torrent)
         db.session.commit()
         # Delete physical file after transaction has been committed
@@ -234,13 +235,7 @@ def handle_torrent_upload(upload_form, uploading_user=None, fromAPI=False):
                              uploader_ip=ip_address(flask.request.remote_addr).packed)
 
     # Store bencoded info_dict
-    info_dict_path = torrent.info_dict_path
-
-    info_dict_dir = os.path.dirname(info_dict_path)
-    os.makedirs(info_dict_dir, exist_ok=True)
-
-    with open(info_dict_path, 'wb') as out_file:
-        out_file.write(torrent_data.bencoded_info_dict)
+    info_dicts.get_store().put(torrent.info_hash, torrent_data.bencoded_info_dict)
 
     torrent.stats = models.Statistic()
     torrent.has_torrent = True
@@ -302,6 +297,7 @@ def handle_torrent_upload(upload_form, uploading_user=None, fromAPI=False):
 
     db.session.add(torrent)
     db.session.flush()
+    torrent.update_count()
 
     # Store the users trackers
     trackers = OrderedSet()
@@ -360,6 +356,10 @@ def handle_torrent_upload(upload_form, uploading_user=None, fromAPI=False):
                                                  tracker_id=tracker.id, order=order)
         db.session.add(torrent_tracker)
 
+    # Trackers are done, store the payload for downloads
+    db.session.expire(torrent, ['trackers'])
+    update_tracker_payload(torrent)
+
     # Before final commit, validate the torrent again
     validate_torrent_post_upload(torrent, upload_form)
 
@@ -384,7 +384,45 @@ def handle_torrent_upload(upload_form, uploading_user=None, fromAPI=False):
     return torrent
 
 
+def update_tracker_payload(torrent):
+    ''' (Re)builds the stored tracker payload of a torrent, for when its trackers or the
+        default trackers have changed. Doesn't commit. Returns the payload. '''
+    payload = torrents.create_tracker_payload(torrent)
+    trackers_digest = torrents.trackers_digest()
+
+    if torrent.tracker_payload is None:
+        torrent.tracker_payload = models.TorrentTrackerPayload(trackers_digest=trackers_digest,
+                                                               payload=payload)
+    else:
+        torrent.tracker_payload.trackers_digest = trackers_digest
+        torrent.tracker_payload.payload = payload
+    return payload
+
+
+def get_tracker_payload(torrent, commit=True):
+    ''' Returns the bencoded tracker payload of a torrent (see torrents.create_tracker_payload)
+        Rebuilds and stores it if it's missing (torrents from before payloads), or was built
+        with other default trackers (trackers.txt or MAIN_ANNOUNCE_URL changed).
+        Without commit, a rebuilt payload is left for commit_tracker_payloads. '''
+    stored = torrent.tracker_payload
+    if stored is not None and stored.trackers_digest == torrents.trackers_digest():
+        return stored.payload
+
+    payload = update_tracker_payload(torrent)
+    if commit:
+        commit_tracker_payloads()
+    return payload
+
+
+def commit_tracker_payloads():
+    ''' Stores the payloads rebuilt by get_tracker_payload '''
+    try:
+        db.session.commit()
+    except sqlalchemy.exc.SQLAlchemyError:
+        # Probably another worker beat us to it, which is fine
+        db.session.rollback()
+
+
 def _delete_info_dict(torrent):
-    info_dict_path = torrent.info_dict_path
-    if os.path.exists(info_dict_path):
-        os.remove(info_dict_path)
+    torrents.invalidate_torrent_file(torrent.id)
+    info_dicts.get_store().delete(torrent.info_hash)
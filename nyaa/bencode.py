@@ -1,4 +1,4 @@
-from io import BytesIO
+import re
 
 
 def _pairwise(iterable):
@@ -8,7 +8,8 @@ def _pairwise(iterable):
     return zip(iterable, iterable)
 
 
-__all__ = ['encode', 'decode', 'BencodeException', 'MalformedBencodeException']
+__all__ = ['encode', 'encode_into', 'decode', 'decode_with_span', 'split_dict',
+           'BencodeException', 'MalformedBencodeException']
 
 # https://wiki.theory.org/BitTorrentSpecification#Bencoding
 
@@ -31,137 +32,329 @@ _B_END = b'e'
 
 # Decoding of bencoded data
 
-def _bencode_decode(file_object, decode_keys_as_utf8=True):
+# Used to locate the offending byte when an integer or a bytestring length is malformed
+_INT_BODY_RE = re.compile(rb'-?[0-9]*')
+_STR_LEN_RE = re.compile(rb'[0-9]+')
+
+# Single bytes as ints, for comparing against bytes[index]
+_I_INT = _B_INT[0]
+_I_LIST = _B_LIST[0]
+_I_DICT = _B_DICT[0]
+_I_END = _B_END[0]
+_I_COLON = ord(':')
+_I_ZERO = _DIGITS[0]
+_I_NINE = _DIGITS[-1]
+
+
+def _bencode_decode(data, decode_keys_as_utf8=True, view_threshold=None):
     """ Decodes a bencoded value, raising a MalformedBencodeException on errors.
         decode_keys_as_utf8 controls decoding dict keys as utf8 (which they
-        almost always are) """
-    if isinstance(file_object, str):
-        file_object = file_object.encode('utf8')
-    if isinstance(file_object, bytes):
-        file_object = BytesIO(file_object)
-
-    def create_ex(msg):
+        almost always are).
+        Works on the whole input at once with integer offsets (instead of reading
+        it a byte at a time), and keeps open lists and dicts on a stack instead
+        of recursing. Error messages and positions match the original decoder
+        (see tests/bencode_reference.py).
+
+        For a lazier decode, bytestrings of at least view_threshold bytes are returned
+        as memoryviews into the input instead of copies (eg. the 'pieces' blob of a torrent). """
+    return _decode_buffer(_as_bytes(data), decode_keys_as_utf8,
+                          view_threshold=view_threshold)[0]
+
+
+def decode_with_span(data, key, decode_keys_as_utf8=True, view_threshold=None):
+    """ Decodes a bencoded dict like decode(), also locating the value of the given
+        top-level key in the input. Returns (value, span), where span is
+        (start, end, canonical) or None if the key was not found.
+        data[start:end] is the exact bencoded value as it was given, and canonical
+        tells whether encode() would reproduce those bytes (sorted and unique dict keys,
+        no leading zeros). If it is not canonical, encode the decoded value instead. """
+    if isinstance(key, str):
+        key = key.encode('utf8')
+    return _decode_buffer(_as_bytes(data), decode_keys_as_utf8, span_key=key,
+                          view_threshold=view_threshold)
+
+
+def split_dict(data):
+    """ Splits a bencoded dict into its keys (decoded as utf8) and their values, which are
+        left bencoded and only checked to be well-formed. Returns a dict of key: bytes. """
+    data = _as_bytes(data)
+    data_len = len(data)
+
+    def create_ex(msg, position):
         return MalformedBencodeException(
-            '{0} at position {1} (0x{1:02X} hex)'.format(msg, file_object.tell()))
-
-    def _read_list():
-        """ Decodes values from stream until a None is returned ('e') """
-        items = []
-        while True:
-            value = _bencode_decode(file_object, decode_keys_as_utf8=decode_keys_as_utf8)
-            if value is None:
-                break
-            items.append(value)
-        return items
-
-    kind = file_object.read(1)
-    if not kind:
-        raise create_ex('EOF, expecting kind')
-
-    if kind == _B_INT:  # Integer
-        int_bytes = b''
-        while True:
-            c = file_object.read(1)
-            if not c:
-                raise create_ex('EOF, expecting more integer')
-            elif c == _B_END:
-                try:
-                    return int(int_bytes.decode('utf8'))
-                except Exception:
-                    raise create_ex('Unable to parse int')
-
-            # not a digit OR '-' in the middle of the int
-            if (c not in _DIGITS + b'-') or (c == b'-' and int_bytes):
-                raise create_ex('Unexpected input while reading an integer: ' + repr(c))
-            else:
-                int_bytes += c
-
-    elif kind == _B_LIST:  # List
-        return _read_list()
-
-    elif kind == _B_DICT:  # Dictionary
-        keys_and_values = _read_list()
-        if len(keys_and_values) % 2 != 0:
-            raise MalformedBencodeException('Uneven amount of key/value pairs')
-
-        # "Technically" the bencode dictionary keys are bytestrings,
-        # but real-world they're always(?) UTF-8.
-        decoded_dict = dict((decode_keys_as_utf8 and k.decode('utf8') or k, v)
-                            for k, v in _pairwise(keys_and_values))
-        return decoded_dict
-
-    # List/dict end, but make sure input is not just 'e'
-    elif kind == _B_END and file_object.tell() > 0:
-        return None
-
-    elif kind in _DIGITS:  # Bytestring
-        str_len_bytes = kind  # keep first digit
-        # Read string length until a ':'
-        while True:
-            c = file_object.read(1)
-            if not c:
-                raise create_ex('EOF, expecting more string len')
-            if c in _DIGITS:
-                str_len_bytes += c
-            elif c == b':':
-                break
+            '{0} at position {1} (0x{1:02X} hex)'.format(msg, position))
+
+    if not data.startswith(_B_DICT):
+        raise create_ex('Not a dictionary', 1)
+
+    items = {}
+    position = 1
+    while True:
+        if position >= data_len:
+            raise create_ex('EOF, expecting kind', data_len)
+        if data[position] == _I_END:
+            return items
+
+        key_start = position
+        position = _skip_value(data, position, create_ex)
+        if not _I_ZERO <= data[key_start] <= _I_NINE:
+            raise create_ex('Dictionary key is not a bytestring', position)
+        key = data[data.index(b':', key_start) + 1:position].decode('utf8')
+
+        value_start = position
+        position = _skip_value(data, position, create_ex)
+        items[key] = data[value_start:position]
+
+
+def _as_bytes(data):
+    """ Returns the input to decode as bytes """
+    if isinstance(data, str):
+        return data.encode('utf8')
+    elif not isinstance(data, (bytes, bytearray, memoryview)):
+        # A file object (eg. an uploaded FileStorage)
+        data = data.read()
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    return data
+
+
+def _decode_buffer(data, decode_keys_as_utf8=True, span_key=None, view_threshold=None):
+    """ Decodes bencoded bytes, returning (value, span).
+        See decode() and decode_with_span() for the arguments. """
+    data_len = len(data)
+    position = 0
+    find = data.find
+
+    if view_threshold is not None:
+        data_view = memoryview(data)
+
+    def create_ex(msg, position):
+        return MalformedBencodeException(
+            '{0} at position {1} (0x{1:02X} hex)'.format(msg, position))
+
+    # Lists of items for the currently open lists and dicts, innermost last
+    stack = []
+    # Start positions of the open lists and dicts
+    stack_start = []
+
+    # Only track canonical encoding when a span is asked for
+    check_canonical = span_key is not None
+    span = None
+    # Start positions of values that encode() would encode differently
+    noncanonical_positions = []
+
+    while True:
+        if position >= data_len:
+            raise create_ex('EOF, expecting kind', data_len)
+
+        value_start = position
+        kind = data[position]
+
+        if _I_ZERO <= kind <= _I_NINE:  # Bytestring
+            # Read string length until a ':'
+            str_len_end = find(b':', position)
+            if str_len_end < 0 or not data[position:str_len_end].isdigit():
+                # Find the first non-digit for the error message
+                str_len_end = _STR_LEN_RE.match(data, position).end()
+                if str_len_end >= data_len:
+                    raise create_ex('EOF, expecting more string len', data_len)
+                raise create_ex('Unexpected input while reading string length: ' +
+                                repr(data[str_len_end:str_len_end + 1]), str_len_end + 1)
+
+            if check_canonical and kind == _I_ZERO and str_len_end > position + 1:
+                noncanonical_positions.append(value_start)
+
+            str_len = int(data[position:str_len_end])
+            str_start = str_len_end + 1
+            position = str_start + str_len
+            if position > data_len:
+                raise create_ex('Read only {} bytes, {} wanted'.format(
+                    data_len - str_start, str_len), data_len)
+
+            if (view_threshold is not None and str_len >= view_threshold and
+                    not (stack and data[stack_start[-1]] == _I_DICT and len(stack[-1]) % 2 == 0)):
+                # Not a dict key, those are always bytes
+                value = data_view[str_start:position]
             else:
-                raise create_ex('Unexpected input while reading string length: ' + repr(c))
-        try:
-            str_len = int(str_len_bytes.decode())
-        except Exception:
-            raise create_ex('Unable to parse bytestring length')
-
-        bytestring = file_object.read(str_len)
-        if len(bytestring) != str_len:
-            raise create_ex('Read only {} bytes, {} wanted'.format(len(bytestring), str_len))
-
-        return bytestring
-    else:
-        raise create_ex('Unexpected data type ({})'.format(repr(kind)))
+                value = data[str_start:position]
+
+        elif kind == _I_INT:  # Integer
+            int_end = find(_B_END, position)
+            int_bytes = data[position + 1:int_end]
+            if int_end < 0 or not (int_bytes.isdigit() or
+                                   (int_bytes[:1] == b'-' and int_bytes[1:].isdigit())):
+                # Find the first unexpected byte for the error message
+                int_end = _INT_BODY_RE.match(data, position + 1).end()
+                if int_end >= data_len:
+                    raise create_ex('EOF, expecting more integer', data_len)
+                if data[int_end] != _I_END:
+                    # not a digit OR '-' in the middle of the int
+                    raise create_ex('Unexpected input while reading an integer: ' +
+                                    repr(data[int_end:int_end + 1]), int_end + 1)
+                # Empty or a lone '-'
+                raise create_ex('Unable to parse int', int_end + 1)
+
+            if check_canonical and (int_bytes[:2] == b'-0' or
+                                    (int_bytes[0] == _I_ZERO and len(int_bytes) > 1)):
+                noncanonical_positions.append(value_start)
+
+            value = int(int_bytes)
+            position = int_end + 1
+
+        elif kind == _I_LIST or kind == _I_DICT:  # List or dictionary
+            stack.append([])
+            stack_start.append(position)
+            position += 1
+            continue
+
+        elif kind == _I_END:  # List/dict end
+            position += 1
+            if not stack:
+                # A lone 'e' decodes to None, like it always has
+                return None, span
+
+            value = stack.pop()
+            value_start = stack_start.pop()
+            if data[value_start] == _I_DICT:
+                if len(value) % 2 != 0:
+                    raise MalformedBencodeException('Uneven amount of key/value pairs')
+
+                # "Technically" the bencode dictionary keys are bytestrings,
+                # but real-world they're always(?) UTF-8.
+                raw_keys = keys = value[0::2]
+                if decode_keys_as_utf8:
+                    try:
+                        keys = [key.decode('utf8') for key in raw_keys]
+                    except AttributeError:
+                        raise create_ex('Dictionary key is not a bytestring', position)
+
+                # encode() sorts the keys (UTF-8 sorts the same as the decoded keys)
+                if check_canonical:
+                    try:
+                        if any(a >= b for a, b in zip(raw_keys, raw_keys[1:])):
+                            noncanonical_positions.append(value_start)
+                    except TypeError:
+                        noncanonical_positions.append(value_start)
+
+                value = dict(zip(keys, value[1::2]))
+
+        else:
+            raise create_ex('Unexpected data type ({})'.format(
+                repr(data[position:position + 1])), position + 1)
+
+        if not stack:
+            if span is not None:
+                start, end = span
+                canonical = not any(start <= p < end for p in noncanonical_positions)
+                span = (start, end, canonical)
+            return value, span
+
+        items = stack[-1]
+        # The value for span_key in the top-level dict (odd items are values)
+        if (check_canonical and len(stack) == 1 and len(items) % 2 == 1 and
+                items[-1] == span_key and data[stack_start[0]] == _I_DICT):
+            span = (value_start, position)
+        items.append(value)
+
+
+def _skip_value(data, position, create_ex):
+    """ Finds the end of the bencoded value at position without decoding it.
+        Only the framing is checked (with the same errors as _decode_buffer),
+        not the dict keys. """
+    data_len = len(data)
+    depth = 0
+
+    while True:
+        if position >= data_len:
+            raise create_ex('EOF, expecting kind', data_len)
+
+        kind = data[position]
+
+        if _I_ZERO <= kind <= _I_NINE:  # Bytestring
+            str_len_end = _STR_LEN_RE.match(data, position).end()
+            if str_len_end >= data_len:
+                raise create_ex('EOF, expecting more string len', data_len)
+            if data[str_len_end] != _I_COLON:
+                raise create_ex('Unexpected input while reading string length: ' +
+                                repr(data[str_len_end:str_len_end + 1]), str_len_end + 1)
+
+            str_len = int(data[position:str_len_end])
+            position = str_len_end + 1 + str_len
+            if position > data_len:
+                raise create_ex('Read only {} bytes, {} wanted'.format(
+                    data_len - str_len_end - 1, str_len), data_len)
+
+        elif kind == _I_INT:  # Integer
+            int_end = _INT_BODY_RE.match(data, position + 1).end()
+            if int_end >= data_len:
+                raise create_ex('EOF, expecting more integer', data_len)
+            if data[int_end] != _I_END:
+                raise create_ex('Unexpected input while reading an integer: ' +
+                                repr(data[int_end:int_end + 1]), int_end + 1)
+            if data[position + 1:int_end] in (b'', b'-'):
+                raise create_ex('Unable to parse int', int_end + 1)
+            position = int_end + 1
+
+        elif kind == _I_LIST or kind == _I_DICT:  # List or dictionary
+            depth += 1
+            position += 1
+            continue
+
+        elif kind == _I_END and depth > 0:  # List/dict end
+            depth -= 1
+            position += 1
+
+        else:
+            raise create_ex('Unexpected data type ({})'.format(
+                repr(data[position:position + 1])), position + 1)
+
+        if depth == 0:
+            return position
 
 
 # Bencoding
 
-def _bencode_int(value):
-    """ Encode an integer, eg 64 -> i64e """
-    return _B_INT + str(value).encode('utf8') + _B_END
-
-
-def _bencode_bytes(value):
-    """ Encode a bytestring (strings as UTF-8), eg 'hello' -> 5:hello """
+def _bencode_into(value, write):
+    """ Bencode any supported value (int, bytes, str, list, dict) by passing its
+        parts to write(), without building intermediate bytes for lists and dicts """
     if isinstance(value, str):
         value = value.encode('utf8')
-    return str(len(value)).encode('utf8') + b':' + value
-
-
-def _bencode_list(value):
-    """ Encode a list, eg [64, "hello"] -> li64e5:helloe """
-    return _B_LIST + b''.join(_bencode(item) for item in value) + _B_END
 
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        write(b'%d:' % len(value))
+        write(value)
+    elif isinstance(value, int):
+        write(b'i%de' % value)
+    elif isinstance(value, list):
+        write(_B_LIST)
+        for item in value:
+            _bencode_into(item, write)
+        write(_B_END)
+    elif isinstance(value, dict):
+        write(_B_DICT)
+        for key in sorted(value.keys()):  # Sort keys as per spec
+            encoded_key = key.encode('utf8') if isinstance(key, str) else key
+            write(b'%d:' % len(encoded_key))
+            write(encoded_key)
+            _bencode_into(value[key], write)
+        write(_B_END)
+    else:
+        raise BencodeException('Unsupported type ' + str(type(value)))
 
-def _bencode_dict(value):
-    """ Encode a dict, which is keys and values interleaved as a list,
-        eg {"hello":123}-> d5:helloi123ee """
-    dict_keys = sorted(value.keys())  # Sort keys as per spec
-    return _B_DICT + b''.join(
-        _bencode_bytes(key) + _bencode(value[key]) for key in dict_keys) + _B_END
 
+def encode_into(value, out):
+    """ Bencodes a value into out, which is either a bytearray (appended to)
+        or a writable file object. Returns out. """
+    write = out.extend if isinstance(out, bytearray) else out.write
+    _bencode_into(value, write)
+    return out
 
-def _bencode(value):
-    """ Bencode any supported value (int, bytes, str, list, dict) """
-    if isinstance(value, int):
-        return _bencode_int(value)
-    elif isinstance(value, (str, bytes)):
-        return _bencode_bytes(value)
-    elif isinstance(value, list):
-        return _bencode_list(value)
-    elif isinstance(value, dict):
-        return _bencode_dict(value)
 
-    raise BencodeException('Unsupported type ' + str(type(value)))
+def encode(value):
+    """ Bencodes a value, returning bytes """
+    out = bytearray()
+    _bencode_into(value, out.extend)
+    return bytes(out)
 
 
-# The functions call themselves
-encode = _bencode
 decode = _bencode_decode
@@ -1,6 +1,8 @@
+import os
 import os.path
+import threading
 
-from flask import abort
+from flask import abort, current_app
 from flask.config import Config
 from flask_assets import Environment
 from flask_caching import Cache
@@ -9,6 +11,9 @@ from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_sqlalchemy import BaseQuery, Pagination, SQLAlchemy
 
+from elasticsearch import Elasticsearch, Urllib3HttpConnection
+from elasticsearch.exceptions import ConnectionTimeout
+
 assets = Environment()
 db = SQLAlchemy()
 toolbar = DebugToolbarExtension()
@@ -16,23 +21,162 @@ cache = Cache()
 limiter = Limiter(key_func=get_remote_address)
 
 
+class ElasticsearchStats(object):
+    ''' Request counters of an ElasticsearchClient, for this process '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clients_created = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        # Requests started while all of a node's pooled connections were in use
+        # (urllib3 then opens a throwaway connection)
+        self.pool_exhausted = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def started(self, pool_in_use, pool_size):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            if pool_in_use >= pool_size:
+                self.pool_exhausted += 1
+
+    def finished(self, exception=None):
+        with self._lock:
+            self.in_flight -= 1
+            if isinstance(exception, ConnectionTimeout):
+                self.timeouts += 1
+            elif exception is not None:
+                self.errors += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {key: value for key, value in vars(self).items() if not key.startswith('_')}
+
+
+class _StatsConnection(Urllib3HttpConnection):
+    ''' A connection (to one node) that keeps ElasticsearchStats up to date '''
+
+    def __init__(self, stats=None, maxsize=10, **kwargs):
+        super().__init__(maxsize=maxsize, **kwargs)
+        self.stats = stats
+        self.pool_size = maxsize
+        self.in_use = 0
+
+    def perform_request(self, *args, **kwargs):
+        self.stats.started(self.in_use, self.pool_size)
+        self.in_use += 1
+        exception = None
+        try:
+            return super().perform_request(*args, **kwargs)
+        except Exception as e:
+            exception = e
+            raise
+        finally:
+            self.in_use -= 1
+            self.stats.finished(exception)
+
+
+class ElasticsearchClient(object):
+    ''' Holds one Elasticsearch client (and its connection pool) per process, so searches
+        reuse kept-alive connections. The client is created on first use, and created again
+        in a forked child (like uwsgi workers forked after loading the app), since the
+        parent's sockets can't be shared. Under gevent the pool is shared by all greenlets
+        of the worker, so ES_POOL_SIZE should be about the number of concurrent searches. '''
+
+    def __init__(self, app=None):
+        self.app = None
+        self.stats = ElasticsearchStats()
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['elasticsearch'] = self
+
+    @property
+    def client(self):
+        client = self._client
+        if client is not None and self._pid == os.getpid():
+            return client
+
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                if self._pid != os.getpid():
+                    # Counters from the parent don't apply to us
+                    self.stats = ElasticsearchStats()
+                self._client = self.create_client(self.app or current_app)
+                self._pid = os.getpid()
+                self.stats.clients_created += 1
+            return self._client
+
+    def create_client(self, app):
+        config = app.config
+        sniff = config.get('ES_SNIFF', False)
+        return Elasticsearch(hosts=config['ES_HOSTS'],
+                             connection_class=_StatsConnection,
+                             stats=self.stats,
+                             maxsize=config.get('ES_POOL_SIZE', 10),
+                             timeout=config.get('ES_TIMEOUT', 10),
+                             max_retries=config.get('ES_MAX_RETRIES', 3),
+                             retry_on_timeout=config.get('ES_RETRY_ON_TIMEOUT', False),
+                             sniff_on_start=sniff,
+                             sniff_on_connection_fail=sniff,
+                             sniffer_timeout=config.get('ES_SNIFF_INTERVAL', 60) if sniff else None)
+
+    def close(self):
+        ''' Closes the client's connections (it will be recreated if used again) '''
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.transport.close()
+            self._client = None
+
+
+es = ElasticsearchClient()
+
+
 class LimitedPagination(Pagination):
     def __init__(self, actual_count, *args, **kwargs):
         self.actual_count = actual_count
         super().__init__(*args, **kwargs)
 
 
+class CountlessPagination(Pagination):
+    ''' A Pagination that doesn't know the total, only whether there is a next page.
+        Given one item more than a page (or has_more), so no COUNT query is needed. '''
+
+    def __init__(self, query, page, per_page, items, has_more=None):
+        if has_more is None:
+            has_more = len(items) > per_page
+        self.has_more = has_more
+        super().__init__(query, page, per_page, None, items[:per_page])
+
+    @property
+    def pages(self):
+        # As far as we know
+        return self.page + 1 if self.has_more else self.page
+
+
 def fix_paginate():
 
-    def paginate_faste(self, page=1, per_page=50, max_page=None, step=5, count_query=None):
+    def paginate_faste(self, page=1, per_page=50, max_page=None, step=5, count_query=None,
+                       total_count=None):
         if page < 1:
             abort(404)
 
         if max_page and page > max_page:
             abort(404)
 
-        # Count all items
-        if count_query is not None:
+        # Count all items (unless already counted)
+        if total_count is not None:
+            total_query_count = total_count
+        elif count_query is not None:
             total_query_count = count_query.scalar()
         else:
             total_query_count = self.count()
@@ -49,7 +193,24 @@ def fix_paginate():
         return LimitedPagination(actual_query_count, self, page, per_page, total_query_count,
                                  items)
 
+    def paginate_countless(self, page=1, per_page=50, max_page=None):
+        if page < 1:
+            abort(404)
+
+        if max_page and page > max_page:
+            abort(404)
+
+        # Grab items on current page, and one more to see if there's a next page
+        items = self.limit(per_page + 1).offset((page - 1) * per_page).all()
+
+        if not items and page != 1:
+            abort(404)
+
+        has_more = len(items) > per_page and not (max_page and page >= max_page)
+        return CountlessPagination(self, page, per_page, items, has_more)
+
     BaseQuery.paginate_faste = paginate_faste
+    BaseQuery.paginate_countless = paginate_countless
 
 
 def _get_config():
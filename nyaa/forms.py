@@ -399,11 +399,18 @@ class UploadForm(FlaskForm):
 
     def validate_torrent_file(form, field):
         # Decode and ensure data is bencoded data
+        torrent_bytes = field.data.read()
         try:
-            torrent_dict = bencode.decode(field.data)
+            # Also locate the info dict in the upload, so we can hash it as-is.
+            # Large strings (pieces) are left as views into the upload. Hybrid v2
+            # torrents are rejected here, as the keys of their piece layers aren't utf8.
+            torrent_dict, info_span = bencode.decode_with_span(
+                torrent_bytes, 'info', view_threshold=_TORRENT_VIEW_THRESHOLD)
             # field.data.close()
         except (bencode.MalformedBencodeException, UnicodeError):
             raise ValidationError('Malformed torrent file')
+        # Text (names, comments, urls) has to be bytes to be validated and decoded
+        _text_views_to_bytes(torrent_dict)
 
         # Uncomment for debug print of the torrent
         # _debug_print_torrent_metadata(torrent_dict)
@@ -434,7 +441,13 @@ class UploadForm(FlaskForm):
         # Note! bencode will sort dict keys, as per the spec
         # This may result in a different hash if the uploaded torrent does not match the
         # spec, but it's their own fault for using broken software! Right?
-        bencoded_info_dict = bencode.encode(torrent_dict['info'])
+        # If the uploaded info dict is already canonical, re-encoding would give the exact
+        # same bytes, so use a view of the upload instead.
+        info_start, info_end, info_canonical = info_span
+        if info_canonical:
+            bencoded_info_dict = memoryview(torrent_bytes)[info_start:info_end]
+        else:
+            bencoded_info_dict = bencode.encode(torrent_dict['info'])
         info_hash = utils.sha1_hash(bencoded_info_dict)
 
         # Check if the info_hash exists already in the database
@@ -514,6 +527,28 @@ class TrustedDecisionForm(FlaskForm):
     reject = SubmitField('Reject')
 
 
+# Bytestrings at least this long are decoded as views into the uploaded file
+_TORRENT_VIEW_THRESHOLD = 64 * 1024
+
+
+def _text_views_to_bytes(value):
+    ''' Copies the memoryviews in a decoded torrent to bytes in place, except for pieces,
+        which is never text '''
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, list):
+        items = enumerate(value)
+    else:
+        return
+
+    for key, item in items:
+        if isinstance(item, memoryview):
+            if key != 'pieces':
+                value[key] = bytes(item)
+        else:
+            _text_views_to_bytes(item)
+
+
 def _validate_trackers(torrent_dict, tracker_to_check_for=None):
     announce = torrent_dict.get('announce')
     assert announce is not None, 'no tracker in torrent'
@@ -563,6 +598,8 @@ def _validate_torrent_metadata(torrent_dict):
     info_dict = torrent_dict.get('info')
     assert info_dict is not None, 'no info_dict in torrent'
     assert isinstance(info_dict, dict), 'info is not a dict'
+    # We only store the info dict, so the piece layers v2 clients need would be lost
+    assert 'piece layers' not in torrent_dict, 'hybrid v2 torrents are not supported'
 
     encoding_bytes = torrent_dict.get('encoding', b'utf-8')
     encoding = _validate_bytes(encoding_bytes, 'encoding', test_decode='utf-8').lower()
@@ -601,7 +638,9 @@ def _validate_torrent_metadata(torrent_dict):
 
 
 def _validate_bytes(value, name='value', check_empty=True, test_decode=None):
-    assert isinstance(value, bytes), name + ' is not bytes'
+    # Large strings may be decoded as memoryviews, but those are never text
+    bytes_types = bytes if test_decode else (bytes, memoryview)
+    assert isinstance(value, bytes_types), name + ' is not bytes'
     if check_empty:
         assert len(value) > 0, name + ' is empty'
     if test_decode:
@@ -0,0 +1,526 @@
+''' Storage for the bencoded info dicts of uploaded torrents.
+
+    FileInfoDictStore keeps every info dict in its own file under info_dicts/aa/bb/<hash>.
+    PackedInfoDictStore appends them into a few large pack files instead, with a
+    hash -> (pack, offset, length) index. '''
+import fcntl
+import heapq
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from flask import current_app as app
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class InfoDictStore(object):
+    ''' Interface of info dict stores. Info dicts are keyed by their (binary) info hash. '''
+
+    def get(self, info_hash):
+        ''' Returns the bencoded info dict, or None if it's not stored '''
+        raise NotImplementedError
+
+    def put(self, info_hash, bencoded_info_dict):
+        raise NotImplementedError
+
+    def delete(self, info_hash):
+        raise NotImplementedError
+
+    def __contains__(self, info_hash):
+        raise NotImplementedError
+
+    def iter_hashes(self):
+        ''' Yields the info hashes of all stored info dicts '''
+        raise NotImplementedError
+
+    def path(self, info_hash):
+        ''' Returns the path of a plain file holding just the info dict, if there is one
+            (and it exists), for sending it with the front-end server or wsgi.file_wrapper '''
+        return None
+
+
+class FileInfoDictStore(InfoDictStore):
+    ''' One file per info dict, in the form of 'info_dicts/aa/bb/aabbccddee...' '''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, info_hash):
+        info_hash = info_hash.hex()
+        return os.path.join(self.directory, info_hash[0:2], info_hash[2:4], info_hash)
+
+    def path(self, info_hash):
+        info_dict_path = self._path(info_hash)
+        return info_dict_path if os.path.exists(info_dict_path) else None
+
+    def get(self, info_hash):
+        try:
+            with open(self._path(info_hash), 'rb') as in_file:
+                return in_file.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, info_hash, bencoded_info_dict):
+        info_dict_path = self._path(info_hash)
+        os.makedirs(os.path.dirname(info_dict_path), exist_ok=True)
+
+        with open(info_dict_path, 'wb') as out_file:
+            out_file.write(bencoded_info_dict)
+
+    def delete(self, info_hash):
+        info_dict_path = self._path(info_hash)
+        if os.path.exists(info_dict_path):
+            os.remove(info_dict_path)
+
+    def __contains__(self, info_hash):
+        return os.path.exists(self._path(info_hash))
+
+    def iter_hashes(self):
+        ''' Yields the info hashes in sorted order '''
+        for root, dirs, files in os.walk(self.directory):
+            dirs.sort()
+            for name in sorted(files):
+                if len(name) == 40:
+                    try:
+                        yield bytes.fromhex(name)
+                    except ValueError:
+                        pass
+
+
+# Entry codecs
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+# Marks deleted entries in the journal
+CODEC_DELETED = 0xff
+
+CODEC_NAMES = {None: CODEC_RAW, 'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD}
+
+# info_hash, pack number, offset, length, codec
+_RECORD = struct.Struct('>20sIQIB')
+
+
+class PackedInfoDictStore(InfoDictStore):
+    ''' Info dicts appended into pack files, located with an index.
+
+        The store lives in a directory of "generations". A generation N consists of:
+        - pack.N.M: the info dicts themselves, written one after another
+        - index.N: fixed-size records (see _RECORD) sorted by info hash, read with
+          binary search on an mmap. Written by compact() only.
+        - journal.N: records appended since the last compaction, including deletions.
+          Loaded into memory, and overrides the index.
+        CURRENT names the live generation. compact() writes all live entries into a new
+        generation and then swaps CURRENT, so readers in other processes never see
+        a half-written store.
+
+        Writers (in any process) serialize on an flock. Readers need no lock. '''
+
+    def __init__(self, directory, compression=None, max_pack_size=1024 ** 3):
+        if compression not in CODEC_NAMES:
+            raise ValueError('Unknown compression: ' + repr(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('zstd compression requires the zstandard package')
+
+        self.directory = directory
+        self.codec = CODEC_NAMES[compression]
+        self.max_pack_size = max_pack_size
+
+        os.makedirs(directory, exist_ok=True)
+        self._current_path = os.path.join(directory, 'CURRENT')
+        self._lock = threading.RLock()
+        self._generation = None
+
+        if not os.path.exists(self._current_path):
+            with self._write_lock():
+                if not os.path.exists(self._current_path):
+                    self._set_current(0)
+
+    # Reading
+
+    def get(self, info_hash):
+        with self._lock:
+            entry = self._find(info_hash)
+            if entry is None:
+                return None
+
+            pack, offset, length, codec = entry
+            try:
+                fd = self._pack_fd(pack)
+            except FileNotFoundError:
+                # Compacted away by another process since _find looked, so look again
+                if not self._refresh():
+                    raise
+                return self.get(info_hash)
+            data = os.pread(fd, length, offset)
+            if len(data) != length:
+                raise IOError('Truncated info dict {} in pack {}'.format(info_hash.hex(), pack))
+            return _decompress(data, codec)
+
+    def __contains__(self, info_hash):
+        with self._lock:
+            return self._find(info_hash) is not None
+
+    def iter_hashes(self):
+        ''' Yields the info hashes in sorted order '''
+        with self._lock:
+            self._refresh()
+            info_hashes = [info_hash for info_hash, _ in self._iter_live_entries()]
+        return iter(info_hashes)
+
+    def _find(self, info_hash):
+        ''' Returns (pack, offset, length, codec) or None '''
+        self._refresh()
+        entry = self._lookup(info_hash)
+        if entry is None:
+            # Might have been written by another process since we last looked
+            self._read_journal()
+            entry = self._lookup(info_hash)
+        return entry
+
+    def _lookup(self, info_hash):
+        entry = self._journal.get(info_hash)
+        if entry is None:
+            entry = self._index_lookup(info_hash)
+        if entry is None or entry[3] == CODEC_DELETED:
+            return None
+        return entry
+
+    def _index_lookup(self, info_hash):
+        index = self._index
+        if index is None:
+            return None
+
+        low, high = 0, len(index) // _RECORD.size
+        while low < high:
+            middle = (low + high) // 2
+            record_hash = index[middle * _RECORD.size:middle * _RECORD.size + 20]
+            if record_hash < info_hash:
+                low = middle + 1
+            elif record_hash > info_hash:
+                high = middle
+            else:
+                return _RECORD.unpack_from(index, middle * _RECORD.size)[1:]
+        return None
+
+    def _iter_index(self):
+        index = self._index
+        if index is not None:
+            for position in range(0, len(index) - _RECORD.size + 1, _RECORD.size):
+                record = _RECORD.unpack_from(index, position)
+                yield record[0], record[1:]
+
+    def _iter_live_entries(self):
+        ''' Yields (info_hash, (pack, offset, length, codec)) sorted by info hash '''
+        journal = self._journal
+        journal_entries = sorted(journal.items())
+        index_entries = ((info_hash, entry) for info_hash, entry in self._iter_index()
+                         if info_hash not in journal)
+
+        for info_hash, entry in heapq.merge(index_entries, journal_entries):
+            if entry[3] != CODEC_DELETED:
+                yield info_hash, entry
+
+    # State
+
+    def _path(self, name, generation=None):
+        if generation is None:
+            generation = self._generation
+        return os.path.join(self.directory, '{}.{}'.format(name, generation))
+
+    def _refresh(self):
+        ''' Reopens the store if another process has compacted it. Returns whether it did. '''
+        # Generations only go up, unlike the inode of CURRENT, which can be reused
+        with open(self._current_path, 'r') as in_file:
+            generation = int(in_file.read().strip())
+        if generation == self._generation:
+            return False
+        self._close()
+
+        self._generation = generation
+        self._pack_fds = {}
+        self._journal = {}
+        self._journal_offset = 0
+        self._index = None
+        self._index_file = None
+
+        index_path = self._path('index')
+        if os.path.exists(index_path) and os.path.getsize(index_path) > 0:
+            self._index_file = open(index_path, 'rb')
+            self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._read_journal()
+        return True
+
+    def _read_journal(self):
+        try:
+            with open(self._path('journal'), 'rb') as in_file:
+                in_file.seek(self._journal_offset)
+                data = in_file.read()
+        except FileNotFoundError:
+            # Not written to yet, or compacted away (picked up by the next _refresh)
+            return
+
+        # Ignore a partially written record at the end
+        usable = len(data) - len(data) % _RECORD.size
+        for position in range(0, usable, _RECORD.size):
+            record = _RECORD.unpack_from(data, position)
+            self._journal[record[0]] = record[1:]
+        self._journal_offset += usable
+
+    def _pack_fd(self, pack):
+        fd = self._pack_fds.get(pack)
+        if fd is None:
+            fd = os.open(self._path('pack', self._generation) + '.{}'.format(pack), os.O_RDONLY)
+            self._pack_fds[pack] = fd
+        return fd
+
+    def _close(self):
+        if self._generation is None:
+            return
+        for fd in self._pack_fds.values():
+            os.close(fd)
+        if self._index is not None:
+            self._index.close()
+            self._index_file.close()
+
+    def close(self):
+        with self._lock:
+            self._close()
+            self._generation = None
+
+    def _set_current(self, generation):
+        temp_path = self._current_path + '.tmp'
+        with open(temp_path, 'w') as out_file:
+            out_file.write('{}\n'.format(generation))
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(temp_path, self._current_path)
+
+    # Writing
+
+    def _write_lock(self):
+        return _FileLock(os.path.join(self.directory, 'LOCK'))
+
+    def put(self, info_hash, bencoded_info_dict):
+        self.put_many([(info_hash, bencoded_info_dict)])
+
+    def put_many(self, items):
+        ''' Stores (info_hash, bencoded_info_dict) pairs, skipping ones already stored '''
+        with self._lock, self._write_lock():
+            self._refresh()
+            self._read_journal()
+
+            writer = _PackWriter(self, self._generation, self._last_pack())
+            records = []
+            try:
+                for info_hash, bencoded_info_dict in items:
+                    if self._lookup(info_hash) is not None:
+                        continue
+                    codec, data = _compress(bencoded_info_dict, self.codec)
+                    pack, offset = writer.write(data)
+                    record = (info_hash, pack, offset, len(data), codec)
+                    records.append(_RECORD.pack(*record))
+                    self._journal[info_hash] = record[1:]
+            finally:
+                writer.close()
+                self._append_journal(records)
+
+    def delete(self, info_hash):
+        with self._lock, self._write_lock():
+            self._refresh()
+            self._read_journal()
+            if self._lookup(info_hash) is None:
+                return
+            self._journal[info_hash] = (0, 0, 0, CODEC_DELETED)
+            self._append_journal([_RECORD.pack(info_hash, 0, 0, 0, CODEC_DELETED)])
+
+    def _append_journal(self, records):
+        if not records:
+            return
+        with open(self._path('journal'), 'ab') as out_file:
+            # Drop a partial record left over by a crashed writer
+            size = out_file.tell()
+            if size % _RECORD.size:
+                out_file.truncate(size - size % _RECORD.size)
+            out_file.write(b''.join(records))
+            self._journal_offset = out_file.tell()
+
+    def _last_pack(self):
+        packs = [entry[0] for entry in self._journal.values() if entry[3] != CODEC_DELETED]
+        if self._index is not None:
+            # compact() fills the packs in index order, so the last record is in the last pack
+            packs.append(_RECORD.unpack_from(self._index, len(self._index) - _RECORD.size)[1])
+        return max(packs, default=0)
+
+    def compact(self, added=None):
+        ''' Rewrites all live entries into a new generation, dropping deleted ones.
+            added may be an iterable of (info_hash, bencoded_info_dict) sorted by info hash,
+            to add in the same pass (see pack_info_dicts.py migrate).
+            Returns (entries written, bytes in the old packs, bytes in the new packs). '''
+        with self._lock, self._write_lock():
+            self._refresh()
+            self._read_journal()
+
+            old_generation = self._generation
+            new_generation = old_generation + 1
+            old_size = sum(os.path.getsize(os.path.join(self.directory, name))
+                           for name in os.listdir(self.directory)
+                           if name.startswith('pack.{}.'.format(old_generation)))
+
+            existing = ((info_hash, (True, entry)) for info_hash, entry
+                        in self._iter_live_entries())
+            new = ((info_hash, (False, data)) for info_hash, data in (added or ()))
+
+            writer = _PackWriter(self, new_generation, 0)
+            count = 0
+            last_hash = None
+            try:
+                with open(self._path('index', new_generation), 'wb') as index_file:
+                    for info_hash, (is_existing, value) in heapq.merge(
+                            existing, new, key=lambda item: (item[0], not item[1][0])):
+                        if info_hash == last_hash:
+                            # Already stored, or a duplicate in added
+                            continue
+                        last_hash = info_hash
+
+                        if is_existing:
+                            # Copy as-is, without recompressing
+                            pack, offset, length, codec = value
+                            data = os.pread(self._pack_fd(pack), length, offset)
+                        else:
+                            codec, data = _compress(value, self.codec)
+
+                        pack, offset = writer.write(data)
+                        index_file.write(_RECORD.pack(info_hash, pack, offset, len(data), codec))
+                        count += 1
+
+                    index_file.flush()
+                    os.fsync(index_file.fileno())
+                writer.close()
+            except BaseException:
+                writer.close()
+                self._remove_generation(new_generation)
+                raise
+
+            new_size = writer.total_size
+            self._set_current(new_generation)
+            self._refresh()
+            self._remove_generation(old_generation)
+
+            return count, old_size, new_size
+
+    def _remove_generation(self, generation):
+        prefixes = ('pack.{}.'.format(generation), 'index.{}'.format(generation),
+                    'journal.{}'.format(generation))
+        for name in os.listdir(self.directory):
+            if name.startswith(prefixes[0]) or name in prefixes[1:]:
+                os.remove(os.path.join(self.directory, name))
+
+
+class _PackWriter(object):
+    ''' Appends data into the packs of a generation, starting a new pack when one is full '''
+
+    def __init__(self, store, generation, pack):
+        self.store = store
+        self.generation = generation
+        self.pack = pack
+        self.total_size = 0
+        self._file = None
+
+    def _open(self):
+        path = self.store._path('pack', self.generation) + '.{}'.format(self.pack)
+        self._file = open(path, 'ab')
+
+    def write(self, data):
+        if self._file is None:
+            self._open()
+        offset = self._file.tell()
+        if offset and offset + len(data) > self.store.max_pack_size:
+            self._file.close()
+            self.pack += 1
+            self._open()
+            offset = self._file.tell()
+
+        self._file.write(data)
+        self.total_size += len(data)
+        return self.pack, offset
+
+    def close(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+
+class _FileLock(object):
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+
+
+def _compress(data, codec):
+    ''' Returns (codec, data), falling back to raw if compression doesn't help '''
+    if codec == CODEC_ZLIB:
+        compressed = zlib.compress(data, 6)
+    elif codec == CODEC_ZSTD:
+        compressed = zstandard.ZstdCompressor().compress(data)
+    else:
+        return CODEC_RAW, bytes(data)
+
+    if len(compressed) >= len(data):
+        return CODEC_RAW, bytes(data)
+    return codec, compressed
+
+
+def _decompress(data, codec):
+    if codec == CODEC_RAW:
+        return data
+    elif codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    elif codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise IOError('Info dict is zstd compressed, but zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise IOError('Unknown info dict codec: {}'.format(codec))
+
+
+def create_store(config):
+    ''' Creates the info dict store configured with INFO_DICT_STORE '''
+    store_type = config.get('INFO_DICT_STORE', 'files')
+    if store_type == 'files':
+        return FileInfoDictStore(os.path.join(config['BASE_DIR'], 'info_dicts'))
+    elif store_type == 'packed':
+        directory = config.get('INFO_DICT_PACK_DIR') or \
+            os.path.join(config['BASE_DIR'], 'info_dict_packs')
+        return PackedInfoDictStore(directory, config.get('INFO_DICT_COMPRESSION'),
+                                   config.get('INFO_DICT_MAX_PACK_SIZE', 1024 ** 3))
+    raise ValueError('Unknown INFO_DICT_STORE: ' + repr(store_type))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    ''' Returns the info dict store of the current app, created on first use '''
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_store(app.config)
+    return _store
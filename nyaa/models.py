@@ -11,6 +11,7 @@ from urllib.parse import urlencode
 import flask
 from markupsafe import escape as escape_markup
 
+import sqlalchemy
 from sqlalchemy import ForeignKeyConstraint, Index, func
 from sqlalchemy.ext import declarative
 from sqlalchemy.ext.hybrid import hybrid_property
@@ -104,6 +105,11 @@ class TorrentFlags(IntEnum):
     COMMENT_LOCKED = 128
 
 
+# The flags search results are filtered by, which torrent counts are kept per value of
+COUNTED_TORRENT_FLAGS = (TorrentFlags.HIDDEN | TorrentFlags.TRUSTED | TorrentFlags.REMAKE |
+                         TorrentFlags.COMPLETE | TorrentFlags.DELETED)
+
+
 class TorrentBase(DeclarativeHelperBase):
     __tablename_base__ = 'torrents'
 
@@ -190,6 +196,11 @@ class TorrentBase(DeclarativeHelperBase):
                                cascade="all, delete-orphan",
                                order_by=cls._flavor_prefix('TorrentTrackers.order'))
 
+    @declarative.declared_attr
+    def tracker_payload(cls):
+        return db.relationship(cls._flavor_prefix('TorrentTrackerPayload'), uselist=False,
+                               cascade="all, delete-orphan", back_populates='torrent')
+
     @declarative.declared_attr
     def comments(cls):
         return db.relationship(cls._flavor_prefix('Comment'), uselist=True,
@@ -208,6 +219,27 @@ class TorrentBase(DeclarativeHelperBase):
         cls.query.filter_by(id=torrent_id).update({'comment_count': db.session.query(
             func.count(Comment.id)).filter_by(torrent_id=torrent_id).as_scalar()}, False)
 
+    @property
+    def count_key(self):
+        ''' The (main_category_id, sub_category_id, flags) TorrentCount row this counts in '''
+        return (self.main_category_id, self.sub_category_id,
+                (self.flags or 0) & COUNTED_TORRENT_FLAGS)
+
+    def update_count(self, old_count_key=None):
+        ''' Moves this torrent from its old count_key row of TorrentCount to its current one,
+            or only counts it if it's new. Part of the current transaction. '''
+        count_class = globals()[self._flavor_prefix('TorrentCount')]
+        count_key = self.count_key
+        if count_key != old_count_key:
+            if old_count_key:
+                count_class.adjust(old_count_key, -1)
+            count_class.adjust(count_key, 1)
+
+    def remove_count(self):
+        ''' Stops counting this torrent, when it is deleted. Part of the current transaction. '''
+        count_class = globals()[self._flavor_prefix('TorrentCount')]
+        count_class.adjust(self.count_key, -1)
+
     @property
     def created_utc_timestamp(self):
         ''' Returns a UTC POSIX timestamp, as seconds '''
@@ -303,6 +335,26 @@ class TorrentFilelistBase(DeclarativeHelperBase):
                                back_populates='filelist')
 
 
+class TorrentTrackerPayloadBase(DeclarativeHelperBase):
+    ''' The bencoded announce, announce-list and url-list of a torrent's .torrent file
+        (see torrents.create_tracker_payload and backend.get_tracker_payload) '''
+    __tablename_base__ = 'torrents_tracker_payload'
+
+    @declarative.declared_attr
+    def torrent_id(cls):
+        fk = db.ForeignKey(cls._table_prefix('torrents.id'), ondelete="CASCADE")
+        return db.Column(db.Integer, fk, primary_key=True)
+
+    # Digest of the default trackers it was built with, see torrents.trackers_digest
+    trackers_digest = db.Column(BinaryType(length=20), nullable=False)
+    payload = db.Column(MediumBlobType, nullable=False)
+
+    @declarative.declared_attr
+    def torrent(cls):
+        return db.relationship(cls._flavor_prefix('Torrent'), uselist=False,
+                               back_populates='tracker_payload')
+
+
 class StatisticBase(DeclarativeHelperBase):
     __tablename_base__ = 'statistics'
 
@@ -322,6 +374,38 @@ class StatisticBase(DeclarativeHelperBase):
                                back_populates='stats')
 
 
+class TorrentCountBase(DeclarativeHelperBase):
+    ''' The number of torrents per category and COUNTED_TORRENT_FLAGS value, so searches
+        without terms can be counted without counting torrents (see search.counted_total).
+        Kept up to date by TorrentBase.update_count, and reconcile_torrent_counts.py. '''
+    __tablename_base__ = 'torrent_counts'
+
+    main_category_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    sub_category_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    flags = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    torrent_count = db.Column(db.Integer, default=0, nullable=False)
+
+    @classmethod
+    def adjust(cls, count_key, delta):
+        ''' Adds delta to the count of the given count_key row, creating it if needed '''
+        main_cat_id, sub_cat_id, flags = count_key
+        table = cls.__table__
+        values = dict(main_category_id=main_cat_id, sub_category_id=sub_cat_id, flags=flags)
+
+        if config['USE_MYSQL']:
+            statement = mysql.insert(table).values(torrent_count=delta, **values)
+            db.session.execute(statement.on_duplicate_key_update(
+                torrent_count=table.c.torrent_count + delta))
+            return
+
+        result = db.session.execute(
+            table.update()
+            .where(sqlalchemy.and_(*(table.c[key] == value for key, value in values.items())))
+            .values(torrent_count=table.c.torrent_count + delta))
+        if not result.rowcount:
+            db.session.execute(table.insert().values(torrent_count=delta, **values))
+
+
 class Trackers(db.Model):
     __tablename__ = 'trackers'
 
@@ -978,6 +1062,15 @@ class SukebeiTorrentFilelist(TorrentFilelistBase, db.Model):
     __flavor__ = 'Sukebei'
 
 
+# TorrentTrackerPayload
+class NyaaTorrentTrackerPayload(TorrentTrackerPayloadBase, db.Model):
+    __flavor__ = 'Nyaa'
+
+
+class SukebeiTorrentTrackerPayload(TorrentTrackerPayloadBase, db.Model):
+    __flavor__ = 'Sukebei'
+
+
 # Statistic
 class NyaaStatistic(StatisticBase, db.Model):
     __flavor__ = 'Nyaa'
@@ -987,6 +1080,15 @@ class SukebeiStatistic(StatisticBase, db.Model):
     __flavor__ = 'Sukebei'
 
 
+# TorrentCount
+class NyaaTorrentCount(TorrentCountBase, db.Model):
+    __flavor__ = 'Nyaa'
+
+
+class SukebeiTorrentCount(TorrentCountBase, db.Model):
+    __flavor__ = 'Sukebei'
+
+
 # TorrentTrackers
 class NyaaTorrentTrackers(TorrentTrackersBase, db.Model):
     __flavor__ = 'Nyaa'
@@ -1054,7 +1156,9 @@ class SukebeiTrackerApi(TrackerApiBase, db.Model):
 if config['SITE_FLAVOR'] == 'nyaa':
     Torrent = NyaaTorrent
     TorrentFilelist = NyaaTorrentFilelist
+    TorrentTrackerPayload = NyaaTorrentTrackerPayload
     Statistic = NyaaStatistic
+    TorrentCount = NyaaTorrentCount
     TorrentTrackers = NyaaTorrentTrackers
     MainCategory = NyaaMainCategory
     SubCategory = NyaaSubCategory
@@ -1067,7 +1171,9 @@ if config['SITE_FLAVOR'] == 'nyaa':
 elif config['SITE_FLAVOR'] == 'sukebei':
     Torrent = SukebeiTorrent
     TorrentFilelist = SukebeiTorrentFilelist
+    TorrentTrackerPayload = SukebeiTorrentTrackerPayload
     Statistic = SukebeiStatistic
+    TorrentCount = SukebeiTorrentCount
     TorrentTrackers = SukebeiTorrentTrackers
     MainCategory = SukebeiMainCategory
     SubCategory = SukebeiSubCategory
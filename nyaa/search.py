@@ -1,7 +1,15 @@
+import base64
+import binascii
+import collections
+import functools
+import hashlib
+import inspect
+import itertools
+import json
 import math
+import operator
 import re
 import shlex
-import threading
 import time
 
 import flask
@@ -9,13 +17,15 @@ from flask_sqlalchemy import Pagination
 
 import sqlalchemy
 import sqlalchemy_fulltext.modes as FullTextMode
-from elasticsearch import Elasticsearch
 from elasticsearch_dsl import Q, Search
+from elasticsearch_dsl.response import Response
+from elasticsearch_dsl.utils import AttrDict
 from sqlalchemy.ext import baked
 from sqlalchemy_fulltext import FullTextSearch
 
 from nyaa import models
-from nyaa.extensions import db
+from nyaa.extensions import CountlessPagination, LimitedPagination, cache, db, es
+from nyaa.utils import LRUCache
 
 app = flask.current_app
 
@@ -73,6 +83,17 @@ def _generate_query_string(term, category, filter, user):
     return params
 
 
+def keyset_query_args(req_args, page_number):
+    ''' Returns the keyset pagination arguments (see keyset_paginate) of a database
+        listing. Keyset pagination is used when given a cursor, or by default
+        (SEARCH_KEYSET_PAGINATION) unless a page number is given. '''
+    after = req_args.get('after')
+    before = req_args.get('before')
+    keyset = bool(after or before) or \
+        (app.config.get('SEARCH_KEYSET_PAGINATION', False) and page_number is None)
+    return {'keyset': keyset, 'after': after, 'before': before}
+
+
 # For preprocessing ES search terms in _parse_es_search_terms
 QUOTED_LITERAL_REGEX = re.compile(r'(?i)(-)?"(.+?)"')
 QUOTED_LITERAL_GROUP_REGEX = re.compile(r'''
@@ -181,49 +202,283 @@ def _parse_es_search_terms(search, search_terms):
     return search
 
 
-def search_elastic(term='', user=None, sort='id', order='desc',
-                   category='0_0', quality_filter='0', page=1,
-                   rss=False, admin=False, logged_in_user=None,
-                   per_page=75, max_search_results=1000):
-    # This function can easily be memcached now
-    if page > 4294967295:
-        flask.abort(404)
+# Search result cache, see cached_search
 
-    es_client = Elasticsearch(hosts=app.config['ES_HOSTS'])
+# Per-process counters of hits, misses, moderator bypasses and cached torrents
+# dropped on hydration (no longer visible)
+SEARCH_CACHE_STATS = collections.Counter()
 
-    es_sort_keys = {
-        'id': 'id',
-        'size': 'filesize',
-        # 'name': 'display_name',  # This is slow and buggy
-        'comments': 'comment_count',
-        'seeders': 'seed_count',
-        'leechers': 'leech_count',
-        'downloads': 'download_count'
+
+def _search_visibility(user, rss, logged_in_user):
+    ''' Returns what (other than deletion) hides torrents from a non-moderator search, as
+        (hide hidden torrents, uploader id whose hidden torrents are shown, hide anonymous) '''
+    if user:
+        # User view, all of their own torrents or only the public ones
+        if logged_in_user and logged_in_user.id == user and not rss:
+            return (False, None, False)
+        return (True, None, True)
+    if logged_in_user and not rss:
+        return (True, logged_in_user.id, False)
+    return (True, None, False)
+
+
+def _is_visible(torrent, visibility):
+    ''' Works on both Torrents and ES hits '''
+    hide_hidden, own_uploader_id, hide_anonymous = visibility
+    if torrent.deleted:
+        return False
+    if hide_hidden and torrent.hidden and \
+            (own_uploader_id is None or torrent.uploader_id != own_uploader_id):
+        return False
+    return not (hide_anonymous and torrent.anonymous)
+
+
+def _search_cache_timeout(sort, order, page, rss):
+    ''' The newest uploads change fastest, so they're cached for less time '''
+    if rss or (page == 1 and sort.lower() == 'id' and order.lower() == 'desc'):
+        return app.config.get('SEARCH_CACHE_NEWEST_TIMEOUT', 10)
+    return app.config.get('SEARCH_CACHE_TIMEOUT', 0)
+
+
+def _hydrate_db_results(entry, params, visibility):
+    kind, torrent_ids, extra = entry
+    torrents_by_id = {torrent.id: torrent for torrent in
+                      models.Torrent.query.filter(models.Torrent.id.in_(torrent_ids))}
+    items = [torrents_by_id[torrent_id] for torrent_id in torrent_ids
+             if torrent_id in torrents_by_id]
+    items = [torrent for torrent in items if _is_visible(torrent, visibility)]
+    SEARCH_CACHE_STATS['dropped'] += len(torrent_ids) - len(items)
+
+    if kind == 'keyset':
+        return KeysetPagination(items, params['per_page'], *extra)
+    if kind == 'countless':
+        return CountlessPagination(None, params['page'], params['per_page'], items, extra)
+    if kind == 'page':
+        total_count, actual_count = extra
+        if actual_count is None:
+            return Pagination(None, params['page'], params['per_page'], total_count, items)
+        return LimitedPagination(actual_count, None, params['page'], params['per_page'],
+                                 total_count, items)
+    # RSS
+    return items
+
+
+def _dehydrate_db_results(results):
+    ''' Returns (kind, torrent ids, what else is needed to rebuild the results) '''
+    if isinstance(results, KeysetPagination):
+        return ('keyset', [torrent.id for torrent in results.items],
+                (results.prev_cursor, results.next_cursor))
+    if isinstance(results, CountlessPagination):
+        return ('countless', [torrent.id for torrent in results.items], results.has_more)
+    if isinstance(results, Pagination):
+        return ('page', [torrent.id for torrent in results.items],
+                (results.total, getattr(results, 'actual_count', None)))
+    # RSS
+    return ('list', [torrent.id for torrent in results], None)
+
+
+def _hydrate_es_results(entry, params, visibility):
+    torrent_ids, total_count, highlights, cursors, aggregations = entry
+    index_name = app.config.get('ES_INDEX_NAME')
+    docs = es.client.mget(index=index_name, body={'ids': torrent_ids})['docs'] \
+        if torrent_ids else []
+
+    hits = []
+    for doc in docs:
+        if not doc.get('found') or not _is_visible(AttrDict(doc['_source']), visibility):
+            continue
+        hit = {'_index': doc['_index'], '_id': doc['_id'], '_source': doc['_source']}
+        highlight = highlights.get(int(doc['_id']))
+        if highlight:
+            hit['highlight'] = highlight
+        hits.append(hit)
+    SEARCH_CACHE_STATS['dropped'] += len(torrent_ids) - len(hits)
+
+    body = {
+        'took': 0,
+        'timed_out': False,
+        'hits': {'total': {'value': total_count, 'relation': 'eq'},
+                 'max_score': None, 'hits': hits}
     }
+    if cursors is None and aggregations is not None:
+        body['aggregations'] = aggregations
+    response = Response(Search(using=es.client, index=index_name), body)
+    if cursors is not None:
+        pagination = KeysetPagination(list(response), params['per_page'], *cursors)
+        pagination.aggregations = aggregations
+        return pagination
+    return response
+
+
+def _dehydrate_es_results(results):
+    ''' Returns (torrent ids, total count, highlights, keyset cursors, aggregations) '''
+    highlights = {int(hit.meta.id): hit.meta.highlight.to_dict()
+                  for hit in results if 'highlight' in hit.meta}
+    torrent_ids = [int(hit.meta.id) for hit in results]
+    if isinstance(results, KeysetPagination):
+        return (torrent_ids, None, highlights, (results.prev_cursor, results.next_cursor),
+                results.aggregations)
+    return (torrent_ids, results.hits.total.value, highlights, None,
+            results.to_dict().get('aggregations'))
+
+
+def cached_search(dehydrate, hydrate):
+    ''' Caches the results of a search function in the app cache, for SEARCH_CACHE_TIMEOUT
+        (or SEARCH_CACHE_NEWEST_TIMEOUT) seconds. Only the torrent ids and counts are
+        stored (dehydrate), the torrents themselves are loaded again on a hit (hydrate),
+        leaving out any that were deleted or hidden since.
+        The cache key covers all arguments, and of the searching user only what changes
+        the results. Moderator (admin) searches always skip the cache. '''
+    def decorator(f):
+        signature = inspect.signature(f)
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = bound.arguments
+
+            if not app.config.get('SEARCH_CACHE_TIMEOUT'):
+                return f(*args, **kwargs)
+            if params['admin']:
+                SEARCH_CACHE_STATS['bypassed'] += 1
+                return f(*args, **kwargs)
+
+            visibility = _search_visibility(params['user'], params['rss'],
+                                            params['logged_in_user'])
+            key_params = sorted((name, value) for name, value in params.items()
+                                if name not in ('admin', 'logged_in_user'))
+            key_data = repr((f.__name__, app.config['SITE_FLAVOR'], key_params, visibility))
+            cache_key = 'search_' + hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+
+            entry = cache.get(cache_key)
+            if entry is not None:
+                SEARCH_CACHE_STATS['hits'] += 1
+                return hydrate(entry, params, visibility)
+
+            SEARCH_CACHE_STATS['misses'] += 1
+            results = f(*args, **kwargs)
+            if not isinstance(results, (Pagination, KeysetPagination, Response)):
+                # Materialize RSS queries, so they're only run once
+                results = list(results)
+            cache.set(cache_key, dehydrate(results),
+                      timeout=_search_cache_timeout(params['sort'], params['order'],
+                                                    params['page'], params['rss']))
+            return results
+        return wrapper
+    return decorator
+
+
+class ElasticHealth(object):
+    ''' Whether listings without a search term should come from ES (ES_BROWSE), per process.
+        Not for ES_BROWSE_RETRY_INTERVAL seconds after a failed search, nor while ES is more
+        than ES_BROWSE_MAX_LAG seconds behind the database, going by the synced_time sync_es
+        saves in its position file (ES_SYNC_STATE_FILE). '''
+
+    # How often to read the position file, in seconds
+    lag_check_interval = 5
+
+    def __init__(self):
+        self.failed_at = None
+        self._synced_time = None
+        self._lag_checked_at = None
+
+    def failed(self):
+        self.failed_at = time.monotonic()
+
+    def lag(self):
+        ''' Returns how many seconds ES is behind, or None if unknown '''
+        state_file = app.config.get('ES_SYNC_STATE_FILE')
+        if not state_file:
+            return None
+
+        now = time.monotonic()
+        if self._lag_checked_at is None or now - self._lag_checked_at >= self.lag_check_interval:
+            self._lag_checked_at = now
+            try:
+                with open(state_file, 'r') as in_file:
+                    synced_time = json.load(in_file).get('synced_time')
+            except (OSError, ValueError):
+                synced_time = None
+            self._synced_time = synced_time
+
+        if self._synced_time is None:
+            return None
+        return max(0, time.time() - self._synced_time)
+
+    def lag_notice(self):
+        ''' Returns the lag if it's worth telling users about (ES_BROWSE_LAG_NOTICE seconds) '''
+        lag = self.lag()
+        if lag is not None and lag >= app.config.get('ES_BROWSE_LAG_NOTICE', 30):
+            return lag
+
+    def healthy(self):
+        retry_interval = app.config.get('ES_BROWSE_RETRY_INTERVAL', 30)
+        if self.failed_at is not None and time.monotonic() - self.failed_at < retry_interval:
+            return False
+
+        max_lag = app.config.get('ES_BROWSE_MAX_LAG')
+        lag = self.lag()
+        return not (max_lag and lag is not None and lag > max_lag)
+
+
+es_health = ElasticHealth()
+
+
+# The ES filter of each quality filter, see QUALITY_FILTER_FLAGS
+ES_QUALITY_FILTERS = {
+    '1': Q('term', remake=False),
+    '2': Q('term', trusted=True),
+    '3': Q('term', complete=True),
+}
 
-    sort_ = sort.lower()
-    if sort_ not in es_sort_keys:
-        flask.abort(400)
 
-    es_sort = es_sort_keys[sort]
+def _add_es_facets(s, category_filters, quality_filters):
+    ''' Adds the category and quality filters to a Search as post filters, with aggregations
+        counting the results of every category (under the quality filter) and of every
+        quality filter (in the category), see search_facets '''
+    def combined(filters):
+        return Q('bool', filter=filters) if filters else Q('match_all')
 
-    order_keys = {
-        'desc': 'desc',
-        'asc': 'asc'
-    }
+    if category_filters or quality_filters:
+        s = s.post_filter(combined(category_filters + quality_filters))
 
-    order_ = order.lower()
-    if order_ not in order_keys:
-        flask.abort(400)
+    s.aggs.bucket('categories', 'filter', combined(quality_filters)) \
+        .bucket('main', 'terms', field='main_category_id', size=100) \
+        .bucket('sub', 'terms', field='sub_category_id', size=100)
+    s.aggs.bucket('quality', 'filter', combined(category_filters)) \
+        .bucket('filters', 'filters', filters=ES_QUALITY_FILTERS)
+    return s
 
-    # Only allow ID, desc if RSS
-    if rss:
-        sort = es_sort_keys['id']
-        order = 'desc'
 
-    # funky, es sort is default asc, prefixed by '-' if desc
-    if 'desc' == order:
-        es_sort = '-' + es_sort
+def search_facets(results):
+    ''' Returns the facets of search_elastic(facets=True) results, as {'categories':
+        {category id: count}, 'quality': {quality filter: count}}, or None '''
+    if isinstance(results, KeysetPagination):
+        aggregations = results.aggregations
+    else:
+        aggregations = results.to_dict().get('aggregations')
+    if not aggregations:
+        return None
+
+    categories = {'0_0': aggregations['categories']['doc_count']}
+    for main_bucket in aggregations['categories']['main']['buckets']:
+        main_cat_id = main_bucket['key']
+        categories['{}_0'.format(main_cat_id)] = main_bucket['doc_count']
+        for sub_bucket in main_bucket['sub']['buckets']:
+            categories['{}_{}'.format(main_cat_id, sub_bucket['key'])] = sub_bucket['doc_count']
+
+    quality = {'0': aggregations['quality']['doc_count']}
+    for quality_filter, bucket in aggregations['quality']['filters']['buckets'].items():
+        quality[quality_filter] = bucket['doc_count']
+    return {'categories': categories, 'quality': quality}
+
+
+def _elastic_search(term, user, category, quality_filter, rss, admin, logged_in_user,
+                    facets=False):
+    ''' Returns the ES Search for the torrents a search shows, without sorting.
+        With facets, also counts them per category and quality filter (see _add_es_facets). '''
+    es_client = es.client
 
     # Quality filter
     quality_keys = [
@@ -313,20 +568,82 @@ def search_elastic(term='', user=None, sort='id', order='desc',
             else:
                 s = s.filter('term', hidden=False)
 
+    category_filters = []
     if main_category:
-        s = s.filter('term', main_category_id=main_cat_id)
+        category_filters.append(Q('term', main_category_id=main_cat_id))
     elif sub_category:
-        s = s.filter('term', main_category_id=main_cat_id)
-        s = s.filter('term', sub_category_id=sub_cat_id)
-
-    if quality_filter == 0:
-        pass
-    elif quality_filter == 1:
-        s = s.filter('term', remake=False)
-    elif quality_filter == 2:
-        s = s.filter('term', trusted=True)
-    elif quality_filter == 3:
-        s = s.filter('term', complete=True)
+        category_filters.append(Q('term', main_category_id=main_cat_id))
+        category_filters.append(Q('term', sub_category_id=sub_cat_id))
+
+    quality_filters = []
+    if quality_filter:
+        quality_filters.append(ES_QUALITY_FILTERS[str(quality_filter)])
+
+    if facets:
+        return _add_es_facets(s, category_filters, quality_filters)
+
+    for es_filter in category_filters + quality_filters:
+        s = s.filter(es_filter)
+    return s
+
+
+@cached_search(_dehydrate_es_results, _hydrate_es_results)
+def search_elastic(term='', user=None, sort='id', order='desc',
+                   category='0_0', quality_filter='0', page=1,
+                   rss=False, admin=False, logged_in_user=None,
+                   per_page=75, max_search_results=1000, keyset=False, after=None, before=None,
+                   facets=False):
+    # This function can easily be memcached now
+    if page > 4294967295:
+        flask.abort(404)
+
+    es_sort_keys = {
+        'id': 'id',
+        'size': 'filesize',
+        # 'name': 'display_name',  # This is slow and buggy
+        'comments': 'comment_count',
+        'seeders': 'seed_count',
+        'leechers': 'leech_count',
+        'downloads': 'download_count'
+    }
+
+    sort_ = sort.lower()
+    if sort_ not in es_sort_keys:
+        flask.abort(400)
+
+    es_sort = es_sort_keys[sort]
+
+    order_keys = {
+        'desc': 'desc',
+        'asc': 'asc'
+    }
+
+    order_ = order.lower()
+    if order_ not in order_keys:
+        flask.abort(400)
+
+    # Only allow ID, desc if RSS
+    if rss:
+        sort = es_sort_keys['id']
+        order = 'desc'
+
+    # funky, es sort is default asc, prefixed by '-' if desc
+    if 'desc' == order:
+        es_sort = '-' + es_sort
+
+    s = _elastic_search(term, user, category, quality_filter, rss, admin, logged_in_user,
+                        facets=facets)
+
+    highlight = app.config.get('ENABLE_ELASTIC_SEARCH_HIGHLIGHT')
+    if highlight:
+        s = s.highlight_options(tags_schema='styled')
+        s = s.highlight("display_name")
+
+    # Cursors aren't limited by max_search_results
+    if keyset or after or before:
+        if rss:
+            sort_, order_ = 'id', 'desc'
+        return elastic_keyset_paginate(s, sort_, order_, per_page, after=after, before=before)
 
     # Apply sort
     s = s.sort(es_sort)
@@ -340,11 +657,6 @@ def search_elastic(term='', user=None, sort='id', order='desc',
         to_idx = min(max_search_results, max_page * per_page)
         s = s[from_idx:to_idx]
 
-    highlight = app.config.get('ENABLE_ELASTIC_SEARCH_HIGHLIGHT')
-    if highlight:
-        s = s.highlight_options(tags_schema='styled')
-        s = s.highlight("display_name")
-
     # Return query, uncomment print line to debug query
     # from pprint import pprint
     # print(json.dumps(s.to_dict()))
@@ -370,9 +682,20 @@ class QueryPairCaller(object):
         return wrapper
 
 
+# The (flag, value) the torrents of each quality filter have
+QUALITY_FILTER_FLAGS = {
+    '0': None,
+    '1': (models.TorrentFlags.REMAKE, False),
+    '2': (models.TorrentFlags.TRUSTED, True),
+    '3': (models.TorrentFlags.COMPLETE, True)
+}
+
+
+@cached_search(_dehydrate_db_results, _hydrate_db_results)
 def search_db(term='', user=None, sort='id', order='desc', category='0_0',
               quality_filter='0', page=1, rss=False, admin=False,
-              logged_in_user=None, per_page=75):
+              logged_in_user=None, per_page=75, keyset=False, after=None, before=None,
+              count=True):
     if page > 4294967295:
         flask.abort(404)
 
@@ -414,15 +737,8 @@ def search_db(term='', user=None, sort='id', order='desc', category='0_0',
     if order_ not in order_keys:
         flask.abort(400)
 
-    filter_keys = {
-        '0': None,
-        '1': (models.TorrentFlags.REMAKE, False),
-        '2': (models.TorrentFlags.TRUSTED, True),
-        '3': (models.TorrentFlags.COMPLETE, True)
-    }
-
     sentinel = object()
-    filter_tuple = filter_keys.get(quality_filter.lower(), sentinel)
+    filter_tuple = QUALITY_FILTER_FLAGS.get(quality_filter.lower(), sentinel)
     if filter_tuple is sentinel:
         flask.abort(400)
 
@@ -526,13 +842,27 @@ def search_db(term='', user=None, sort='id', order='desc', category='0_0',
         query = query.join(sort_column.class_)
         query = query.with_hint(sort_column.class_, 'USE INDEX ({0})'.format(index_name))
 
+    if keyset or after or before:
+        if rss:
+            sort, order_ = 'id', 'desc'
+        return keyset_paginate(query, sort.lower(), order_, per_page, after=after, before=before)
+
     query = query.order_by(getattr(sort_column, order)())
 
     if rss:
         query = query.limit(per_page)
+    elif not count:
+        query = query.paginate_countless(page, per_page=per_page, max_page=MAX_PAGES)
     else:
-        query = query.paginate_faste(page, per_page=per_page, step=5, count_query=count_query,
-                                     max_page=MAX_PAGES)
+        total_count = None
+        # Not for unknown categories, which aren't filtered by above
+        category_applied = main_category or sub_category or not (main_cat_id or sub_cat_id)
+        if not term and not user and (admin or not logged_in_user or rss) and category_applied:
+            total_count = counted_total(main_cat_id, sub_cat_id, filter_tuple, admin)
+        if total_count is None:
+            total_count = cached_count(count_query)
+        query = query.paginate_faste(page, per_page=per_page, step=5,
+                                     total_count=total_count, max_page=MAX_PAGES)
 
     return query
 
@@ -610,9 +940,11 @@ BAKED_FILTER_LAMBDAS = {
 }
 
 
+@cached_search(_dehydrate_db_results, _hydrate_db_results)
 def search_db_baked(term='', user=None, sort='id', order='desc', category='0_0',
                     quality_filter='0', page=1, rss=False, admin=False,
-                    logged_in_user=None, per_page=75):
+                    logged_in_user=None, per_page=75, keyset=False, after=None, before=None,
+                    count=True):
     if page > 4294967295:
         flask.abort(404)
 
@@ -748,59 +1080,122 @@ def search_db_baked(term='', user=None, sort='id', order='desc', category='0_0',
     # Sort and order
     query += sort_lambda
 
+    if keyset or after or before:
+        if rss:
+            sort, order = 'id', 'desc'
+        return baked_keyset_paginate(query, baked_params, sort.lower(), order.lower(), per_page,
+                                     after=after, before=before)
+
     if rss:
         query += lambda q: q.limit(bp('per_page'))
         baked_params['per_page'] = per_page
 
         return query(db.session()).params(**baked_params).all()
 
-    return baked_paginate(query, count_query, baked_params,
-                          page, per_page=per_page, step=5, max_page=MAX_PAGES)
+    total_count = None
+    if count and not term and not user and (admin or not logged_in_user):
+        total_count = counted_total(main_cat_id, sub_cat_id,
+                                    QUALITY_FILTER_FLAGS.get(quality_filter.lower()), admin)
 
+    return baked_paginate(query, count_query, baked_params,
+                          page, per_page=per_page, step=5, max_page=MAX_PAGES, count=count,
+                          total_count=total_count)
 
-class ShoddyLRU(object):
-    def __init__(self, max_entries=128, expiry=60):
-        self.max_entries = max_entries
-        self.expiry = expiry
 
-        # Contains [value, last_used, expires_at]
-        self.entries = {}
-        self._lock = threading.Lock()
+class SharedCache(object):
+    ''' The LRUCache interface on top of the app cache (flask_caching), so entries are shared
+        by all worker processes. Eviction is up to the cache backend. '''
 
-        self._sentinel = object()
+    def __init__(self, prefix, expiry=60):
+        self.prefix = prefix
+        self.expiry = expiry
+        self.stats = collections.Counter()
 
     def get(self, key, default=None):
-        entry = self.entries.get(key)
-        if entry is None:
+        value = cache.get(self.prefix + key)
+        if value is None:
+            self.stats['misses'] += 1
             return default
+        self.stats['hits'] += 1
+        return value
 
-        now = time.time()
-        if now > entry[2]:
-            with self._lock:
-                del self.entries[key]
-            return default
+    def put(self, key, value, expiry=None):
+        cache.set(self.prefix + key, value, timeout=expiry or self.expiry)
 
-        entry[1] = now
-        return entry[0]
 
-    def put(self, key, value, expiry=None):
-        with self._lock:
-            overflow = len(self.entries) - self.max_entries
-            if overflow > 0:
-                # Pick the least recently used keys
-                removed_keys = [key for key, value in sorted(
-                    self.entries.items(), key=lambda t:t[1][1])][:overflow]
-                for key in removed_keys:
-                    del self.entries[key]
+_count_cache = None
 
-            now = time.time()
-            self.entries[key] = [value, now, now + (expiry or self.expiry)]
 
+def get_count_cache():
+    ''' Returns the cache for search result counts, as set by COUNT_CACHE_BACKEND,
+        COUNT_CACHE_SIZE and COUNT_CACHE_DURATION '''
+    global _count_cache
+    if _count_cache is None:
+        expiry = app.config.get('COUNT_CACHE_DURATION') or 30
+        if app.config.get('COUNT_CACHE_BACKEND') == 'shared':
+            _count_cache = SharedCache('count_', expiry)
+        else:
+            _count_cache = LRUCache(app.config.get('COUNT_CACHE_SIZE', 256), expiry)
+    return _count_cache
+
+
+def _count_query_key(query):
+    ''' Returns a key for a count query that is the same in every process '''
+    if isinstance(query, baked.Result):
+        # The cache key of a baked query holds code objects, so key on the query it builds
+        query = query._as_query()
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    params = dict(compiled.params, **query._params)
+    key_data = repr((str(compiled), sorted(params.items())))
+    return hashlib.sha1(key_data.encode('utf-8')).hexdigest()
+
+
+def cached_count(query):
+    ''' Runs a count query, or returns its count from the count cache '''
+    duration = app.config.get('COUNT_CACHE_DURATION')
+    if not duration:
+        return query.scalar()
+
+    count_cache = get_count_cache()
+    query_key = _count_query_key(query)
+    count = count_cache.get(query_key)
+    if count is None:
+        count = query.scalar()
+        count_cache.put(query_key, count, expiry=duration)
+    return count
+
+
+def counted_total(main_cat_id, sub_cat_id, filter_tuple, admin):
+    ''' Returns the number of torrents in a category (0 for all) that match a quality filter
+        (see QUALITY_FILTER_FLAGS), and aren't deleted or hidden unless admin, from
+        TorrentCount. The category must be one the search filtered by (not an unknown one).
+        Returns None if SEARCH_TORRENT_COUNTS is off. '''
+    if not app.config.get('SEARCH_TORRENT_COUNTS'):
+        return None
+
+    mask = 0
+    value = 0
+    if not admin:
+        mask |= models.TorrentFlags.DELETED | models.TorrentFlags.HIDDEN
+    if filter_tuple:
+        flag, is_set = filter_tuple
+        mask |= flag
+        value |= flag if is_set else 0
 
-LRU_CACHE = ShoddyLRU(256, 60)
+    query = db.session.query(sqlalchemy.func.sum(models.TorrentCount.torrent_count))
+    # Like the searches, a subcategory is only looked for in its main category
+    if sub_cat_id:
+        query = query.filter(models.TorrentCount.main_category_id == main_cat_id,
+                             models.TorrentCount.sub_category_id == sub_cat_id)
+    elif main_cat_id:
+        query = query.filter(models.TorrentCount.main_category_id == main_cat_id)
+    if mask:
+        query = query.filter(models.TorrentCount.flags.op('&')(int(mask)) == int(value))
+    return int(query.scalar() or 0)
 
 
-def baked_paginate(query, count_query, params, page=1, per_page=50, max_page=None, step=5):
+def baked_paginate(query, count_query, params, page=1, per_page=50, max_page=None, step=5,
+                   count=True, total_count=None):
     if page < 1:
         flask.abort(404)
 
@@ -811,23 +1206,26 @@ def baked_paginate(query, count_query, params, page=1, per_page=50, max_page=Non
     ses = db.session()
 
     # Count all items, use cache
-    if app.config['COUNT_CACHE_DURATION']:
-        query_key = (count_query._effective_key(ses), tuple(sorted(params.items())))
-        total_query_count = LRU_CACHE.get(query_key)
+    if count:
+        total_query_count = total_count
         if total_query_count is None:
-            total_query_count = count_query(ses).params(**params).scalar()
-            LRU_CACHE.put(query_key, total_query_count, expiry=app.config['COUNT_CACHE_DURATION'])
-    else:
-        total_query_count = count_query(ses).params(**params).scalar()
+            total_query_count = cached_count(count_query(ses).params(**params))
 
-    # Grab items on current page
+    # Grab items on current page (and one more to see if there's a next one, if not counting)
     query += lambda q: q.limit(bp('limit')).offset(bp('offset'))
-    params['limit'] = per_page
+    params['limit'] = per_page if count else per_page + 1
     params['offset'] = (page - 1) * per_page
 
     res = query(ses).params(**params)
     items = res.all()
 
+    if not count:
+        if not items and page != 1:
+            flask.abort(404)
+
+        has_more = len(items) > per_page and not (max_page and page >= max_page)
+        return CountlessPagination(None, page, per_page, items, has_more)
+
     if max_page:
         total_query_count = min(total_query_count, max_page * per_page)
 
@@ -838,3 +1236,247 @@ def baked_paginate(query, count_query, params, page=1, per_page=50, max_page=Non
         flask.abort(404)
 
     return Pagination(None, page, per_page, total_query_count, items)
+
+
+# Keyset pagination: instead of an offset, a page is given by a cursor of the (sort value, id)
+# of the last torrent before it (after) or the first torrent after it (before), so every
+# page costs about the same as the first one
+
+KEYSET_SORT_VALUES = {
+    'id': operator.attrgetter('id'),
+    'size': operator.attrgetter('filesize'),
+    'comments': operator.attrgetter('comment_count'),
+    'seeders': operator.attrgetter('stats.seed_count'),
+    'leechers': operator.attrgetter('stats.leech_count'),
+    'downloads': operator.attrgetter('stats.download_count'),
+}
+
+# The same for ES, by the indexed fields (see import_to_es.mk_es)
+ES_SORT_FIELDS = {
+    'id': 'id',
+    'size': 'filesize',
+    'comments': 'comment_count',
+    'seeders': 'seed_count',
+    'leechers': 'leech_count',
+    'downloads': 'download_count',
+}
+ES_KEYSET_SORT_VALUES = {sort: operator.attrgetter(field)
+                         for sort, field in ES_SORT_FIELDS.items()}
+
+
+class KeysetPagination(object):
+    ''' A page of keyset paginated results, with the cursors of the pages around it '''
+
+    # Raw ES aggregations, see search_facets
+    aggregations = None
+
+    def __init__(self, items, per_page, prev_cursor=None, next_cursor=None):
+        self.items = items
+        self.per_page = per_page
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(sort, order, torrent, sort_values=KEYSET_SORT_VALUES):
+    ''' Returns an opaque cursor pointing at a torrent (or ES hit, with ES_KEYSET_SORT_VALUES)
+        in results with the given sorting '''
+    cursor = '{}:{}:{}:{}'.format(sort, order, sort_values[sort](torrent), torrent.id)
+    return base64.urlsafe_b64encode(cursor.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort, order):
+    ''' Returns the (sort value, id) of a cursor, or None if the cursor was made for
+        another sorting (so the listing starts over). Aborts on garbage. '''
+    try:
+        cursor = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+        cursor_sort, cursor_order, sort_value, torrent_id = cursor.split(':')
+        sort_value, torrent_id = int(sort_value), int(torrent_id)
+    except (ValueError, binascii.Error):
+        flask.abort(400)
+
+    if (cursor_sort, cursor_order) != (sort, order):
+        return None
+    return sort_value, torrent_id
+
+
+def _keyset_criteria(query, sort, order, backwards, has_cursor):
+    ''' Orders the query by the sort column and id, and if has_cursor, filters it to rows
+        past the cursor_value and cursor_id bind parameters. Backwards reverses both
+        (the rows before the cursor, nearest first). '''
+    bp = sqlalchemy.bindparam
+    sort_column = BAKED_SORT_KEYS[sort]
+    # Break ties by the id in the sort column's own table, so the sort column's index
+    # (which ends with the primary key) gives the whole order
+    if sort_column.class_ is models.Statistic:
+        id_column = models.Statistic.torrent_id
+    else:
+        id_column = models.Torrent.id
+    descending = (order == 'desc') != backwards
+
+    if has_cursor:
+        past = operator.lt if descending else operator.gt
+        if sort == 'id':
+            criterion = past(id_column, bp('cursor_id'))
+        else:
+            criterion = sqlalchemy.or_(
+                past(sort_column, bp('cursor_value')),
+                sqlalchemy.and_(sort_column == bp('cursor_value'),
+                                past(id_column, bp('cursor_id'))))
+        query = query.filter(criterion)
+
+    direction = 'desc' if descending else 'asc'
+    ordering = [getattr(id_column, direction)()]
+    if sort != 'id':
+        ordering.insert(0, getattr(sort_column, direction)())
+    return query.order_by(None).order_by(*ordering)
+
+
+def _keyset_params(sort, order, after, before):
+    ''' Returns (backwards, bind parameters) for a keyset query '''
+    backwards = bool(before)
+    cursor = decode_cursor(before or after, sort, order) if (before or after) else None
+    if cursor is None:
+        return False, {}
+    return backwards, {'cursor_value': cursor[0], 'cursor_id': cursor[1]}
+
+
+def _make_keyset_pagination(rows, sort, order, per_page, backwards, has_cursor,
+                            sort_values=KEYSET_SORT_VALUES):
+    # One row more than a page was asked for, to know if there are more
+    has_more = len(rows) > per_page
+    items = rows[:per_page]
+    if backwards:
+        items.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = has_cursor, has_more
+
+    prev_cursor = next_cursor = None
+    if items:
+        if has_prev:
+            prev_cursor = encode_cursor(sort, order, items[0], sort_values)
+        if has_next:
+            next_cursor = encode_cursor(sort, order, items[-1], sort_values)
+    return KeysetPagination(items, per_page, prev_cursor, next_cursor)
+
+
+def keyset_paginate(query, sort, order, per_page, after=None, before=None):
+    backwards, params = _keyset_params(sort, order, after, before)
+    query = _keyset_criteria(query, sort, order, backwards, bool(params))
+    rows = query.params(**params).limit(per_page + 1).all()
+    return _make_keyset_pagination(rows, sort, order, per_page, backwards, bool(params))
+
+
+def baked_keyset_paginate(query, params, sort, order, per_page, after=None, before=None):
+    bp = sqlalchemy.bindparam
+    backwards, cursor_params = _keyset_params(sort, order, after, before)
+    has_cursor = bool(cursor_params)
+
+    # The arguments are part of the baked query's cache key
+    query.add_criteria(lambda q: _keyset_criteria(q, sort, order, backwards, has_cursor),
+                       sort, order, backwards, has_cursor)
+    query += lambda q: q.limit(bp('limit'))
+    params = dict(params, limit=per_page + 1, **cursor_params)
+
+    rows = query(db.session()).params(**params).all()
+    return _make_keyset_pagination(rows, sort, order, per_page, backwards, has_cursor)
+
+
+def elastic_keyset_paginate(search, sort, order, per_page, after=None, before=None):
+    ''' keyset_paginate for an ES Search, with search_after instead of filters '''
+    backwards, params = _keyset_params(sort, order, after, before)
+    direction = 'desc' if (order == 'desc') != backwards else 'asc'
+
+    sorting = [{'id': {'order': direction}}]
+    if sort != 'id':
+        sorting.insert(0, {ES_SORT_FIELDS[sort]: {'order': direction}})
+    # Pages don't show a total, so don't count one
+    search = search.sort(*sorting).extra(track_total_hits=False)[:per_page + 1]
+    if params:
+        if sort == 'id':
+            search_after = [params['cursor_id']]
+        else:
+            search_after = [params['cursor_value'], params['cursor_id']]
+        search = search.extra(search_after=search_after)
+
+    response = search.execute()
+    pagination = _make_keyset_pagination(list(response), sort, order, per_page, backwards,
+                                         bool(params), ES_KEYSET_SORT_VALUES)
+    pagination.aggregations = response.to_dict().get('aggregations')
+    return pagination
+
+
+# Exporting all results of a search, see main.export_search
+
+EXPORT_FIELDS = ['id', 'display_name', 'created_time', 'info_hash', 'filesize',
+                 'main_category_id', 'sub_category_id', 'comment_count', 'trusted', 'remake',
+                 'complete', 'seed_count', 'leech_count', 'download_count']
+
+
+def _export_torrent(torrent):
+    return {
+        'id': torrent.id,
+        'display_name': torrent.display_name,
+        'created_time': torrent.created_time.isoformat(),
+        'info_hash': torrent.info_hash_as_hex,
+        'filesize': torrent.filesize,
+        'main_category_id': torrent.main_category_id,
+        'sub_category_id': torrent.sub_category_id,
+        'comment_count': torrent.comment_count,
+        'trusted': torrent.trusted,
+        'remake': torrent.remake,
+        'complete': torrent.complete,
+        'seed_count': torrent.stats.seed_count,
+        'leech_count': torrent.stats.leech_count,
+        'download_count': torrent.stats.download_count,
+    }
+
+
+def _export_hit(hit):
+    source = hit.to_dict()
+    return {field: source.get(field) for field in EXPORT_FIELDS}
+
+
+def export_search(max_results, term='', user=None, category='0_0', quality_filter='0',
+                  admin=False, logged_in_user=None, batch_size=1000):
+    ''' Yields (up to max_results) all torrents a search finds, as dicts of EXPORT_FIELDS.
+        Searches with a term go through an ES scroll if ES is used (in no particular order),
+        others are paged through newest first with keyset pagination. '''
+    if app.config.get('USE_ELASTIC_SEARCH') and term:
+        s = _elastic_search(term, user, category, quality_filter, False, admin, logged_in_user)
+        # Closing the generator early clears the scroll
+        for hit in itertools.islice(s.params(size=batch_size).scan(), max_results):
+            yield _export_hit(hit)
+        return
+
+    after = None
+    exported = 0
+    while exported < max_results:
+        # Unwrapped, to not fill the search cache with export pages
+        page = search_db.__wrapped__(term=term, user=user, category=category,
+                                     quality_filter=quality_filter, admin=admin,
+                                     logged_in_user=logged_in_user,
+                                     per_page=min(batch_size, max_results - exported),
+                                     keyset=True, after=after)
+        for torrent in page:
+            yield _export_torrent(torrent)
+        exported += len(page)
+        if not page.has_next:
+            break
+        after = page.next_cursor
+        # Don't keep every exported torrent in the session's identity map
+        db.session.expunge_all()
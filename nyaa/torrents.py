@@ -1,5 +1,9 @@
 import functools
+import hashlib
 import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
 from urllib.parse import quote, urlencode
 
 import flask
@@ -11,14 +15,24 @@ from nyaa import bencode
 
 USED_TRACKERS = OrderedSet()
 
+# Bumped whenever USED_TRACKERS is (re)loaded, to tell apart .torrent files built before it
+_trackers_version = 0
+_trackers_updated_time = None
+# (trackers version, digest), see trackers_digest
+_trackers_digest = None
+
 
 def read_trackers_from_file(file_object):
+    global _trackers_version, _trackers_updated_time
     USED_TRACKERS.clear()
 
     for line in file_object:
         line = line.strip()
         if line and not line.startswith('#'):
             USED_TRACKERS.add(line)
+
+    _trackers_version += 1
+    _trackers_updated_time = datetime.utcnow()
     return USED_TRACKERS
 
 
@@ -36,6 +50,24 @@ def default_trackers():
     return USED_TRACKERS[:]
 
 
+def trackers_version():
+    ''' Returns (version, updated time) of the default tracker list.
+        The time is None if no list has been loaded. '''
+    default_trackers()
+    return (_trackers_version, app.config.get('MAIN_ANNOUNCE_URL')), _trackers_updated_time
+
+
+def trackers_digest():
+    ''' Returns a sha1 digest of MAIN_ANNOUNCE_URL and the default tracker list,
+        to tell which ones a stored tracker payload was built with '''
+    global _trackers_digest
+    version = trackers_version()[0]
+    if _trackers_digest is None or _trackers_digest[0] != version:
+        trackers = '\n'.join(get_default_trackers())
+        _trackers_digest = (version, hashlib.sha1(trackers.encode('utf-8')).digest())
+    return _trackers_digest[1]
+
+
 def get_trackers_and_webseeds(torrent):
     trackers = OrderedSet()
     webseeds = OrderedSet()
@@ -121,24 +153,44 @@ def create_default_metadata_base(torrent, trackers=None, webseeds=None):
                                  _external=True)
         # 'encoding' : 'UTF-8' # It's almost always UTF-8 and expected, but if it isn't...
     }
+    metadata_base.update(create_tracker_metadata(trackers, webseeds))
+
+    return metadata_base
+
+
+def create_tracker_metadata(trackers, webseeds):
+    ''' Returns the announce, announce-list and url-list of a .torrent file '''
+    tracker_metadata = {}
 
     if len(trackers) > 0:
-        metadata_base['announce'] = trackers[0]
+        tracker_metadata['announce'] = trackers[0]
     if len(trackers) > 1:
         # Yes, it's a list of lists with a single element inside.
-        metadata_base['announce-list'] = [[tracker] for tracker in trackers]
+        tracker_metadata['announce-list'] = [[tracker] for tracker in trackers]
 
     # Add webseeds
     if webseeds:
-        metadata_base['url-list'] = webseeds
+        tracker_metadata['url-list'] = webseeds
 
-    return metadata_base
+    return tracker_metadata
 
 
-def create_bencoded_torrent(torrent, bencoded_info, metadata_base=None):
+def create_tracker_payload(torrent):
+    ''' Returns the bencoded tracker metadata of a torrent (see create_tracker_metadata)
+        for storing with it, so downloads don't need to query its trackers '''
+    trackers, webseeds = get_trackers_and_webseeds(torrent)
+    return bencode.encode(create_tracker_metadata(trackers, webseeds))
+
+
+def create_bencoded_torrent(torrent, bencoded_info, metadata_base=None, out=None,
+                            bencoded_values=None):
     ''' Creates a bencoded torrent metadata for a given torrent,
         optionally using a given metadata_base dict (note: 'info' key will be
-        popped off the dict) '''
+        popped off the dict).
+        bencoded_values may add more already bencoded values by key (eg. a stored
+        tracker payload split with bencode.split_dict).
+        Everything is written straight into out (a bytearray or a writable file object),
+        which is returned. If out is not given, a new bytearray is used. '''
     if metadata_base is None:
         metadata_base = create_default_metadata_base(torrent)
 
@@ -146,12 +198,122 @@ def create_bencoded_torrent(torrent, bencoded_info, metadata_base=None):
 
     # Make sure info doesn't exist on the base
     metadata_base.pop('info', None)
-    prefixed_dict = {key: metadata_base[key] for key in metadata_base if key < 'info'}
-    suffixed_dict = {key: metadata_base[key] for key in metadata_base if key > 'info'}
 
-    prefix = bencode.encode(prefixed_dict)
-    suffix = bencode.encode(suffixed_dict)
+    if out is None:
+        out = bytearray()
+    write = out.extend if isinstance(out, bytearray) else out.write
+
+    bencoded_values = dict(bencoded_values or (), info=bencoded_info)
+
+    # Write the metadata dict ourselves, so the already bencoded info dict can be placed
+    # in its sorted position without decoding it
+    write(b'd')
+    for key in sorted(set(metadata_base).union(bencoded_values)):
+        bencode.encode_into(key, out)
+        if key in bencoded_values:
+            write(bencoded_values[key])
+        else:
+            bencode.encode_into(metadata_base[key], out)
+    write(b'e')
+
+    return out
+
+
+def create_bencoded_torrent_parts(torrent, metadata_base=None, bencoded_values=None):
+    ''' Like create_bencoded_torrent, but returns the bencoded torrent metadata before
+        and after the info dict as (prefix, suffix) bytearrays, so the info dict can be
+        sent from elsewhere (eg. straight from its file). '''
+    if metadata_base is None:
+        metadata_base = create_default_metadata_base(torrent)
+
+    metadata_base['encoding'] = torrent.encoding
+    metadata_base.pop('info', None)
+    bencoded_values = dict(bencoded_values or ())
+    bencoded_values.pop('info', None)
+
+    prefix = bytearray(b'd')
+    suffix = bytearray()
+    for key in sorted(set(metadata_base).union(bencoded_values)):
+        out = prefix if key < 'info' else suffix
+        bencode.encode_into(key, out)
+        if key in bencoded_values:
+            out.extend(bencoded_values[key])
+        else:
+            bencode.encode_into(metadata_base[key], out)
+    prefix.extend(b'4:info')
+    suffix.extend(b'e')
+
+    return prefix, suffix
+
+
+class TorrentFileCache(object):
+    ''' LRU cache of assembled .torrent files by torrent id, bounded by their total size.
+        Each entry is stored with a version (see torrent_file_version), and
+        looking it up with any other version drops it. '''
+
+    def __init__(self):
+        # Contains torrent_id: (version, data, etag)
+        self.entries = OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def get(self, torrent_id, version):
+        ''' Returns (data, etag), or None if the entry is missing or outdated '''
+        with self._lock:
+            entry = self.entries.get(torrent_id)
+            if entry is None:
+                return None
+
+            if entry[0] != version:
+                self._remove(torrent_id)
+                return None
+
+            self.entries.move_to_end(torrent_id)
+            return entry[1:]
+
+    def put(self, torrent_id, version, data, etag, max_size):
+        data = bytes(data)
+        with self._lock:
+            self._remove(torrent_id)
+            if len(data) > max_size:
+                return
+
+            self.entries[torrent_id] = (version, data, etag)
+            self.size += len(data)
+
+            while self.size > max_size:
+                _, (_, old_data, _) = self.entries.popitem(last=False)
+                self.size -= len(old_data)
+
+    def invalidate(self, torrent_id):
+        with self._lock:
+            self._remove(torrent_id)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _remove(self, torrent_id):
+        entry = self.entries.pop(torrent_id, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+TORRENT_FILE_CACHE = TorrentFileCache()
+
+
+def torrent_file_version(torrent):
+    ''' Returns (version, last modified time) of the .torrent file of a torrent.
+        Edits bump the torrent's updated_time, and reloading trackers.txt
+        or changing MAIN_ANNOUNCE_URL bumps the tracker list version. '''
+    tracker_version, trackers_updated_time = trackers_version()
+    last_modified = torrent.updated_time
+    if trackers_updated_time and (last_modified is None or trackers_updated_time > last_modified):
+        last_modified = trackers_updated_time
+    return (torrent.updated_time, tracker_version), last_modified
 
-    bencoded_torrent = prefix[:-1] + b'4:info' + bencoded_info + suffix[1:]
 
-    return bencoded_torrent
+def invalidate_torrent_file(torrent_id):
+    ''' Drops the cached .torrent file of a torrent, ie. when it's edited or deleted '''
+    TORRENT_FILE_CACHE.invalidate(torrent_id)
@@ -2,7 +2,10 @@ import functools
 import hashlib
 import random
 import string
-from collections import OrderedDict
+import threading
+import time
+import zipfile
+from collections import Counter, OrderedDict
 
 import flask
 
@@ -44,6 +47,58 @@ def cached_function(f):
     return decorator
 
 
+class LRUCache(object):
+    ''' A thread-safe least recently used cache with per-entry expiry. All operations are O(1).
+        Counts hits, misses (including expired entries) and evictions in stats. '''
+
+    def __init__(self, max_entries=128, expiry=60):
+        self.max_entries = max_entries
+        self.expiry = expiry
+        self.stats = Counter()
+
+        # key: (value, expires_at), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return default
+
+            if time.monotonic() >= entry[1]:
+                del self._entries[key]
+                self.stats['misses'] += 1
+                self.stats['expired'] += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[0]
+
+    def put(self, key, value, expiry=None):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + (expiry or self.expiry))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def hit_rate(stats):
+    ''' Returns the hit rate (0 to 1) of a cache's stats, or None if it hasn't been used '''
+    lookups = stats['hits'] + stats['misses']
+    return stats['hits'] / lookups if lookups else None
+
+
 def flatten_dict(d, result=None):
     if result is None:
         result = {}
@@ -90,3 +145,35 @@ def admin_only(f):
         else:
             flask.abort(401)
     return wrapper
+
+
+class _ZipBuffer(object):
+    ''' An unseekable file-like that collects what zipfile writes to it '''
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(entries):
+    ''' Yields a ZIP archive of (name, date_time, data) entries piece by piece, as the
+        entries are consumed. Entries are stored uncompressed. '''
+    zip_buffer = _ZipBuffer()
+    # zipfile can't seek back in _ZipBuffer, so it writes sizes after each entry instead
+    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+        for name, date_time, data in entries:
+            zip_file.writestr(zipfile.ZipInfo(name, date_time), data)
+            yield zip_buffer.pop()
+    # The central directory
+    yield zip_buffer.pop()
@@ -3,8 +3,9 @@ from ipaddress import ip_address
 
 import flask
 
-from nyaa import email, forms, models
-from nyaa.extensions import db
+from nyaa import email, forms, models, search
+from nyaa.extensions import db, es
+from nyaa.utils import hit_rate
 
 app = flask.current_app
 bp = flask.Blueprint('admin', __name__, url_prefix='/admin')
@@ -82,6 +83,7 @@ def view_reports():
         if not torrent or not report or report.status != 0:
             flask.abort(404)
 
+        old_count_key = torrent.count_key
         report_user = models.User.by_id(report.user_id)
         log = 'Report #{}: {} [#{}]({}), reported by [{}]({})'
         if action == 'delete':
@@ -105,6 +107,7 @@ def view_reports():
                              flask.url_for('users.view_user', user_name=report_user.username))
             report.status = 2
 
+        torrent.update_count(old_count_key)
         adminlog = models.AdminLog(log=log, admin_id=flask.g.user.id)
         db.session.add(adminlog)
 
@@ -187,6 +190,21 @@ def view_trusted_application(app_id):
                                  decision_form=decision_form)
 
 
+@bp.route('/cache_stats', endpoint='cache_stats', methods=['GET'])
+def view_cache_stats():
+    ''' Cache and Elasticsearch client counters of the worker process serving this '''
+    if not flask.g.user or not flask.g.user.is_moderator:
+        flask.abort(403)
+
+    count_stats = search.get_count_cache().stats
+    return flask.jsonify({
+        'search_cache': dict(search.SEARCH_CACHE_STATS,
+                             hit_rate=hit_rate(search.SEARCH_CACHE_STATS)),
+        'count_cache': dict(count_stats, hit_rate=hit_rate(count_stats)),
+        'elasticsearch': es.stats.as_dict(),
+    })
+
+
 def _send_trusted_decision_email(user, is_accepted):
     email_msg = email.EmailHolder(
         subject='Your {} Trusted Application was {}.'.format(app.config['GLOBAL_SITE_NAME'],
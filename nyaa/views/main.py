@@ -1,16 +1,25 @@
 import base64
+import binascii
+import itertools
+import json
 import math
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from ipaddress import ip_address
 
 import flask
 from flask_paginate import Pagination
+from werkzeug.urls import url_encode
+
+import sqlalchemy
+from elasticsearch.exceptions import ElasticsearchException
 
 from nyaa import models
-from nyaa.extensions import db
+from nyaa.extensions import db, limiter
 from nyaa.search import (DEFAULT_MAX_SEARCH_RESULT, DEFAULT_PER_PAGE, SERACH_PAGINATE_DISPLAY_MSG,
-                         _generate_query_string, search_db, search_db_baked, search_elastic)
+                         _generate_query_string, es_health, export_search, keyset_query_args,
+                         search_db, search_db_baked, search_elastic, search_facets)
 from nyaa.utils import chain_get
 from nyaa.views.account import logout
 
@@ -68,123 +77,88 @@ def home(rss):
     if req_args.get('page') == 'rss':
         render_as_rss = True
 
-    search_term = chain_get(req_args, 'q', 'term')
-
-    sort_key = req_args.get('s')
-    sort_order = req_args.get('o')
+    results_per_page = app.config.get('RESULTS_PER_PAGE', DEFAULT_PER_PAGE)
+    search_term, query_args = search_query_args(req_args, results_per_page, render_as_rss)
+    keyset_args = keyset_query_args(req_args, chain_get(req_args, 'p', 'page', 'offset'))
 
+    # As given, for the RSS link
     category = chain_get(req_args, 'c', 'cats')
     quality_filter = chain_get(req_args, 'f', 'filter')
-
     user_name = chain_get(req_args, 'u', 'user')
-    page_number = chain_get(req_args, 'p', 'page', 'offset')
-    try:
-        page_number = max(1, int(page_number))
-    except (ValueError, TypeError):
-        page_number = 1
 
     # Check simply if the key exists
     use_magnet_links = 'magnets' in req_args or 'm' in req_args
 
-    results_per_page = app.config.get('RESULTS_PER_PAGE', DEFAULT_PER_PAGE)
-
-    user_id = None
-    if user_name:
-        user = models.User.by_username(user_name)
-        if not user:
-            flask.abort(404)
-        user_id = user.id
-
-    special_results = {
-        'first_word_user': None,
-        'query_sans_user': None,
-        'infohash_torrent': None
-    }
-    # Add advanced features to searches (but not RSS or user searches)
-    if search_term and not render_as_rss and not user_id:
-        # Check if the first word of the search is an existing user
-        user_word_match = re.match(r'^([a-zA-Z0-9_-]+) *(.*|$)', search_term)
-        if user_word_match:
-            special_results['first_word_user'] = models.User.by_username(user_word_match.group(1))
-            special_results['query_sans_user'] = user_word_match.group(2)
-
-        # Check if search is a 40-char torrent hash (or 32-char base32 hash)
-        infohash_match = re.match(r'(?i)^([a-f0-9]{40})$', search_term)
-        base32_infohash_match = re.match(r'(?i)^([a-z0-9]{32})$', search_term)
-        if infohash_match:
-            # Check for info hash in database
-            matched_torrent = models.Torrent.by_info_hash_hex(infohash_match.group(1))
-            special_results['infohash_torrent'] = matched_torrent
-        elif base32_infohash_match:
-            # Convert base32 to info_hash
-            info_hash = base64.b32decode(base32_infohash_match.group(1))
-            matched_torrent = models.Torrent.by_info_hash(info_hash)
-            special_results['infohash_torrent'] = matched_torrent
-
-    query_args = {
-        'user': user_id,
-        'sort': sort_key or 'id',
-        'order': sort_order or 'desc',
-        'category': category or '0_0',
-        'quality_filter': quality_filter or '0',
-        'page': page_number,
-        'rss': render_as_rss,
-        'per_page': results_per_page
-    }
-
-    if flask.g.user:
-        query_args['logged_in_user'] = flask.g.user
-        if flask.g.user.is_moderator:  # God mode
-            query_args['admin'] = True
-
-    infohash_torrent = special_results.get('infohash_torrent')
-    if infohash_torrent:
-        # infohash_torrent is only set if this is not RSS or userpage search
-        flask.flash(flask.Markup('You were redirected here because '
-                                 'the given hash matched this torrent.'), 'info')
-        # Redirect user from search to the torrent if we found one with the specific info_hash
-        return flask.redirect(flask.url_for('torrents.view', torrent_id=infohash_torrent.id))
+    # Add advanced features to searches (but not RSS or user searches), looked up
+    # while the search runs
+    special_lookup = None
+    if search_term and not render_as_rss and not query_args['user']:
+        special_lookup = _start_special_results_lookup(search_term)
 
     # If searching, we get results from elastic search
     use_elastic = app.config.get('USE_ELASTIC_SEARCH')
-    if use_elastic and search_term:
-        query_args['term'] = search_term
-
-        max_search_results = app.config.get('ES_MAX_SEARCH_RESULT', DEFAULT_MAX_SEARCH_RESULT)
-
-        # Only allow up to (max_search_results / page) pages
-        max_page = min(query_args['page'], int(math.ceil(max_search_results / results_per_page)))
-
-        query_args['page'] = max_page
-        query_args['max_search_results'] = max_search_results
-
-        query_results = search_elastic(**query_args)
-
+    # Browsing too with ES_BROWSE, unless ES is failing or lagging behind
+    es_browse = bool(use_elastic and not search_term and app.config.get('ES_BROWSE') and
+                     es_health.healthy())
+    query_results = None
+    if use_elastic and (search_term or es_browse):
+        es_query_args = dict(query_args, term=search_term or '')
+        # Count the results of the other categories and filters in the same request
+        es_query_args['facets'] = bool(app.config.get('ES_SEARCH_FACETS') and not render_as_rss)
+
+        # Cursors (search_after) reach all results, page numbers only max_search_results.
+        # RSS always uses cursors, so feeds can link to their next page
+        if keyset_args['keyset'] or render_as_rss:
+            es_query_args.update(keyset_args, keyset=True)
+        else:
+            max_search_results = limit_es_page(es_query_args)
+
+        try:
+            query_results = search_elastic(**es_query_args)
+        except ElasticsearchException:
+            if not es_browse:
+                raise
+            # Browse the database instead (below), for a while
+            app.logger.exception('Browsing with ES failed, falling back to the database')
+            es_health.failed()
+
+    if query_results is not None:
         if render_as_rss:
             return render_rss(
-                '"{}"'.format(search_term), query_results,
+                '"{}"'.format(search_term) if search_term else 'Home', query_results,
                 use_elastic=True, magnet_links=use_magnet_links)
         else:
+            special_results, redirect = _finish_special_results_lookup(special_lookup)
+            if redirect:
+                return redirect
+
             rss_query_string = _generate_query_string(
                 search_term, category, quality_filter, user_name)
-            max_results = min(max_search_results, query_results['hits']['total']['value'])
-            # change p= argument to whatever you change page_parameter to or pagination breaks
-            pagination = Pagination(p=query_args['page'], per_page=results_per_page,
-                                    total=max_results, bs_version=3, page_parameter='p',
-                                    display_msg=SERACH_PAGINATE_DISPLAY_MSG)
+            pagination = None
+            if not es_query_args.get('keyset'):
+                max_results = min(max_search_results, query_results['hits']['total']['value'])
+                # change p= argument to whatever you change page_parameter to or pagination
+                # breaks
+                pagination = Pagination(p=es_query_args['page'], per_page=results_per_page,
+                                        total=max_results, bs_version=3, page_parameter='p',
+                                        display_msg=SERACH_PAGINATE_DISPLAY_MSG)
             return flask.render_template('home.html',
                                          use_elastic=True,
                                          pagination=pagination,
                                          torrent_query=query_results,
-                                         search=query_args,
+                                         search=es_query_args,
                                          rss_filter=rss_query_string,
-                                         special_results=special_results)
+                                         special_results=special_results,
+                                         es_lag=es_health.lag_notice() if es_browse else None,
+                                         facets=search_facets(query_results))
     else:
-        # If ES is enabled, default to db search for browsing
-        if use_elastic:
-            query_args['term'] = ''
-        else:  # Otherwise, use db search for everything
-            query_args['term'] = search_term or ''
+        query_args['term'] = db_search_term(search_term)
+
+        # RSS always uses keyset pagination, so feeds can link to their next page
+        query_args.update(keyset_args, keyset=keyset_args['keyset'] or render_as_rss)
+        # Visitors who aren't logged in may get pages without a total count
+        query_args['count'] = not (flask.g.user is None and
+                                   'browse' in app.config.get('SEARCH_COUNTLESS_PAGINATION', ()))
 
         if app.config['USE_BAKED_SEARCH']:
             query = search_db_baked(**query_args)
@@ -194,11 +168,15 @@ def home(rss):
         if render_as_rss:
             return render_rss('Home', query, use_elastic=False, magnet_links=use_magnet_links)
         else:
+            special_results, redirect = _finish_special_results_lookup(special_lookup)
+            if redirect:
+                return redirect
+
             rss_query_string = _generate_query_string(
                 search_term, category, quality_filter, user_name)
             # Use elastic is always false here because we only hit this section
-            # if we're browsing without a search term (which means we default to DB)
-            # or if ES is disabled
+            # if we're browsing without a search term (which means we default to DB,
+            # unless ES_BROWSE) or if ES is disabled
             return flask.render_template('home.html',
                                          use_elastic=False,
                                          torrent_query=query,
@@ -207,15 +185,198 @@ def home(rss):
                                          special_results=special_results)
 
 
+def search_query_args(req_args, per_page, rss=False):
+    ''' Returns (search term, arguments for search_elastic/search_db/search_db_baked) of the
+        search arguments the front page takes. Aborts with a 404 for an unknown user. '''
+    search_term = chain_get(req_args, 'q', 'term')
+    user_name = chain_get(req_args, 'u', 'user')
+    page_number = chain_get(req_args, 'p', 'page', 'offset')
+    try:
+        page_number = max(1, int(page_number))
+    except (ValueError, TypeError):
+        page_number = 1
+
+    user_id = None
+    if user_name:
+        user = models.User.by_username(user_name)
+        if not user:
+            flask.abort(404)
+        user_id = user.id
+
+    query_args = {
+        'user': user_id,
+        'sort': req_args.get('s') or 'id',
+        'order': req_args.get('o') or 'desc',
+        'category': chain_get(req_args, 'c', 'cats') or '0_0',
+        'quality_filter': chain_get(req_args, 'f', 'filter') or '0',
+        'page': page_number,
+        'rss': rss,
+        'per_page': per_page
+    }
+
+    if flask.g.user:
+        query_args['logged_in_user'] = flask.g.user
+        if flask.g.user.is_moderator:  # God mode
+            query_args['admin'] = True
+
+    return search_term, query_args
+
+
+def limit_es_page(query_args):
+    ''' Only allows up to (max_search_results / per_page) pages of an ES search.
+        Returns max_search_results. '''
+    max_search_results = app.config.get('ES_MAX_SEARCH_RESULT', DEFAULT_MAX_SEARCH_RESULT)
+    query_args['page'] = min(query_args['page'],
+                             int(math.ceil(max_search_results / query_args['per_page'])))
+    query_args['max_search_results'] = max_search_results
+    return max_search_results
+
+
+def db_search_term(search_term):
+    ''' Returns the term for searching the database: none if ES is enabled (which only
+        browses the database), otherwise the search term '''
+    if app.config.get('USE_ELASTIC_SEARCH'):
+        return ''
+    return search_term or ''
+
+
+# Runs the special results lookups of searches next to the searches themselves
+_special_results_executor = ThreadPoolExecutor(max_workers=4,
+                                               thread_name_prefix='special_results')
+
+
+def _lookup_special_results(first_word, info_hash):
+    ''' Returns the username of the user called first_word and the id of the torrent with
+        info_hash (either None if not found, or not given), in one query '''
+    columns = [sqlalchemy.null(), sqlalchemy.null()]
+    if first_word:
+        columns[0] = db.session.query(models.User.username) \
+            .filter(models.User.username == first_word).limit(1).as_scalar()
+    if info_hash:
+        columns[1] = db.session.query(models.Torrent.id) \
+            .filter(models.Torrent.info_hash == info_hash).limit(1).as_scalar()
+    return tuple(db.session.query(*columns).one())
+
+
+def _start_special_results_lookup(search_term):
+    ''' Starts looking up whether the first word of a search is a user and whether the search
+        is a torrent's info hash (40 hex or 32 base32 characters), in another thread.
+        Returns what _finish_special_results_lookup needs, or None if there's nothing to
+        look up. '''
+    first_word = query_sans_user = info_hash = None
+
+    user_word_match = re.match(r'^([a-zA-Z0-9_-]+) *(.*|$)', search_term)
+    if user_word_match:
+        first_word, query_sans_user = user_word_match.groups()
+
+    infohash_match = re.match(r'(?i)^([a-f0-9]{40})$', search_term)
+    base32_infohash_match = re.match(r'(?i)^([a-z0-9]{32})$', search_term)
+    if infohash_match:
+        info_hash = bytes.fromhex(infohash_match.group(1))
+    elif base32_infohash_match:
+        try:
+            info_hash = base64.b32decode(base32_infohash_match.group(1).upper())
+        except binascii.Error:
+            pass
+
+    if not (first_word or info_hash):
+        return None
+
+    app_object = app._get_current_object()
+
+    def lookup():
+        with app_object.app_context():
+            return _lookup_special_results(first_word, info_hash)
+
+    return _special_results_executor.submit(lookup), query_sans_user
+
+
+def _finish_special_results_lookup(special_lookup):
+    ''' Waits for a special results lookup, returns (special_results, redirect or None) '''
+    special_results = {
+        'first_word_user': None,
+        'query_sans_user': None,
+    }
+    if special_lookup is None:
+        return special_results, None
+
+    future, query_sans_user = special_lookup
+    username, torrent_id = future.result()
+
+    if torrent_id:
+        flask.flash(flask.Markup('You were redirected here because '
+                                 'the given hash matched this torrent.'), 'info')
+        # Redirect user from search to the torrent if we found one with the specific info_hash
+        return special_results, flask.redirect(flask.url_for('torrents.view',
+                                                             torrent_id=torrent_id))
+
+    if username:
+        special_results['first_word_user'] = username
+        special_results['query_sans_user'] = query_sans_user
+    return special_results, None
+
+
 def render_rss(label, query, use_elastic, magnet_links=False):
+    next_url = None
+    if getattr(query, 'next_cursor', None):
+        next_args = flask.request.args.copy()
+        next_args.pop('before', None)
+        next_args['after'] = query.next_cursor
+        next_url = '{}?{}'.format(flask.request.base_url, url_encode(next_args))
+
     rss_xml = flask.render_template('rss.xml',
                                     use_elastic=use_elastic,
                                     magnet_links=magnet_links,
                                     term=label,
                                     site_url=flask.request.url_root,
+                                    next_url=next_url,
                                     torrent_query=query)
     response = flask.make_response(rss_xml)
     response.headers['Content-Type'] = 'application/xml'
     # Cache for an hour
     response.headers['Cache-Control'] = 'max-age={}'.format(1 * 5 * 60)
     return response
+
+
+@bp.route('/export.jsonl', endpoint='export')
+@limiter.limit('10/hour', error_message="You've exported too many searches, "
+               "try again in an hour.")
+def export_search_results():
+    ''' Streams every result of a search (q, c, f and u, like the front page) as JSON lines,
+        up to SEARCH_EXPORT_MAX_RESULTS '''
+    max_results = app.config.get('SEARCH_EXPORT_MAX_RESULTS')
+    if not max_results:
+        flask.abort(404)
+
+    req_args = flask.request.args
+    user_name = chain_get(req_args, 'u', 'user')
+    user_id = None
+    if user_name:
+        user = models.User.by_username(user_name)
+        if not user:
+            flask.abort(404)
+        user_id = user.id
+
+    search_args = {
+        'term': chain_get(req_args, 'q', 'term') or '',
+        'user': user_id,
+        'category': chain_get(req_args, 'c', 'cats') or '0_0',
+        'quality_filter': chain_get(req_args, 'f', 'filter') or '0',
+    }
+    if flask.g.user:
+        search_args['logged_in_user'] = flask.g.user
+        search_args['admin'] = flask.g.user.is_moderator
+
+    results = export_search(max_results, **search_args)
+    # Run the search (and its argument checks) before the response starts
+    first_result = next(results, None)
+
+    def generate():
+        if first_result is not None:
+            for result in itertools.chain([first_result], results):
+                yield json.dumps(result, separators=(',', ':')) + '\n'
+
+    response = flask.Response(flask.stream_with_context(generate()),
+                              mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = 'attachment; filename="search.jsonl"'
+    return response
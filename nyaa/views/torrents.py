@@ -1,15 +1,23 @@
+import collections
+import hashlib
+import itertools
 import json
+import os
+import re
 from ipaddress import ip_address
 from urllib.parse import quote
 
 import flask
 from werkzeug.datastructures import CombinedMultiDict
+from werkzeug.wsgi import ClosingIterator, wrap_file
 
 from sqlalchemy.orm import joinedload
 
-from nyaa import backend, forms, models, torrents
+from nyaa import backend, bencode, forms, info_dicts, models, torrents
 from nyaa.extensions import db
-from nyaa.utils import cached_function
+from nyaa.search import search_db, search_db_baked, search_elastic
+from nyaa.utils import cached_function, stream_zip
+from nyaa.views.main import db_search_term, limit_es_page, search_query_args
 
 app = flask.current_app
 bp = flask.Blueprint('torrents', __name__)
@@ -108,6 +116,7 @@ def edit_torrent(torrent_id):
 
     if flask.request.method == 'POST' and form.submit.data and form.validate():
         # Form has been sent, edit torrent with data.
+        old_count_key = torrent.count_key
         torrent.main_category_id, torrent.sub_category_id = \
             form.category.parsed_data.get_category_ids()
         torrent.display_name = backend.sanitize_string((form.display_name.data or '').strip())
@@ -125,6 +134,8 @@ def edit_torrent(torrent_id):
             locked_changed = torrent.comment_locked != form.is_comment_locked.data
             torrent.comment_locked = form.is_comment_locked.data
 
+        torrent.update_count(old_count_key)
+
         url = flask.url_for('torrents.view', torrent_id=torrent.id)
         if editor.is_moderator and locked_changed:
             log = "Torrent [#{0}]({1}) marked as {2}".format(
@@ -134,6 +145,7 @@ def edit_torrent(torrent_id):
             db.session.add(adminlog)
 
         db.session.commit()
+        torrents.invalidate_torrent_file(torrent.id)
 
         flask.flash(flask.Markup(
             'Torrent has been successfully edited! Changes might take a few minutes to show up.'),
@@ -190,6 +202,7 @@ def _delete_torrent(torrent, form, banform):
 
     action = None
     url = flask.url_for('main.home')
+    old_count_key = torrent.count_key
 
     ban_torrent = form.ban.data
     if banform:
@@ -238,7 +251,9 @@ def _delete_torrent(torrent, form, banform):
             db.session.add(adminlog)
 
     if action:
+        torrent.update_count(old_count_key)
         db.session.commit()
+        torrents.invalidate_torrent_file(torrent.id)
         flask.flash(flask.Markup('Torrent has been successfully {0}.'.format(action)), 'success')
 
     if not banform or not (banform.ban_user.data or banform.ban_userip.data):
@@ -316,6 +331,46 @@ def redirect_magnet(torrent_id):
 @bp.route('/view/<int:torrent_id>/torrent')
 @bp.route('/download/<int:torrent_id>.torrent', endpoint='download')
 def download_torrent(torrent_id):
+    torrent = _get_downloadable_torrent(torrent_id)
+
+    delivery = app.config.get('TORRENT_FILE_DELIVERY')
+    info_dict_path = info_dicts.get_store().path(torrent.info_hash)
+    if delivery == 'ssi' and info_dict_path:
+        ssi_torrent_file, _, _ = _get_torrent_file(torrent, ssi=True)
+        if ssi_torrent_file is not None:
+            # Served again from download_ssi by the front-end server, in a location that
+            # parses SSI. Full .torrent files never pass through it.
+            resp = flask.Response()
+            resp.headers['X-Accel-Redirect'] = flask.url_for('torrents.download_ssi',
+                                                             torrent_id=torrent.id)
+            return resp
+
+    if delivery == 'file_wrapper' and info_dict_path:
+        torrent_file, torrent_file_size, etag, last_modified = \
+            _stream_torrent_file(torrent, info_dict_path)
+    else:
+        torrent_file, etag, last_modified = _get_torrent_file(torrent)
+        torrent_file_size = len(torrent_file)
+
+    return _torrent_file_response(torrent, torrent_file, torrent_file_size, etag, last_modified)
+
+
+@bp.route('/_ssi/download/<int:torrent_id>.torrent', endpoint='download_ssi')
+def download_torrent_ssi(torrent_id):
+    ''' The .torrent file with an SSI include in place of the info dict, for the front-end
+        server's internal location download_torrent redirects to '''
+    if app.config.get('TORRENT_FILE_DELIVERY') != 'ssi':
+        flask.abort(404)
+
+    torrent = _get_downloadable_torrent(torrent_id)
+    torrent_file, etag, last_modified = _get_torrent_file(torrent, ssi=True)
+    if torrent_file is None:
+        flask.abort(404)
+
+    return _torrent_file_response(torrent, torrent_file, len(torrent_file), etag, last_modified)
+
+
+def _get_downloadable_torrent(torrent_id):
     torrent = models.Torrent.by_id(torrent_id)
 
     if not torrent or not torrent.has_torrent:
@@ -324,7 +379,10 @@ def download_torrent(torrent_id):
     if torrent.deleted and not (flask.g.user and flask.g.user.is_moderator):
         flask.abort(404)
 
-    torrent_file, torrent_file_size = _make_torrent_file(torrent)
+    return torrent
+
+
+def _torrent_file_response(torrent, torrent_file, torrent_file_size, etag, last_modified):
     disposition = 'inline; filename="{0}"; filename*=UTF-8\'\'{0}'.format(
         quote(torrent.torrent_name.encode('utf-8')))
 
@@ -332,9 +390,101 @@ def download_torrent(torrent_id):
     resp.headers['Content-Type'] = 'application/x-bittorrent'
     resp.headers['Content-Disposition'] = disposition
     resp.headers['Content-Length'] = torrent_file_size
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    # Turns into a 304 if If-None-Match/If-Modified-Since match
+    return resp.make_conditional(flask.request)
+
+
+@bp.route('/download/torrents.zip', endpoint='download_zip')
+def download_torrents_zip():
+    ''' Sends the .torrent files of either the given ids (?ids=1,2,3) or a page of search
+        results (same arguments as main.home) as one ZIP, built while it is sent '''
+    max_torrents = app.config.get('BULK_DOWNLOAD_MAX_TORRENTS')
+    if not max_torrents:
+        flask.abort(404)
+
+    is_moderator = flask.g.user and flask.g.user.is_moderator
+    req_args = flask.request.args
+    if 'ids' in req_args:
+        torrent_ids = _parse_torrent_ids(req_args['ids'], max_torrents)
+    else:
+        torrent_ids = _search_torrent_ids(req_args, max_torrents)
+
+    # One query for all the torrents and their tracker payloads, kept in the requested order
+    torrent_query = models.Torrent.query \
+                                  .options(joinedload('tracker_payload')) \
+                                  .filter(models.Torrent.id.in_(torrent_ids))
+    torrents_by_id = {torrent.id: torrent for torrent in torrent_query} if torrent_ids else {}
+
+    # Build all the metadata up front, so the response can be streamed without the database
+    torrent_parts = []
+    for torrent_id in torrent_ids:
+        torrent = torrents_by_id.get(torrent_id)
+        if not torrent or not torrent.has_torrent or (torrent.deleted and not is_moderator):
+            continue
+
+        # Committing would expire the other torrents, so rebuilt payloads are stored at the end
+        metadata_base, bencoded_values = _torrent_metadata(torrent, commit=False)
+        prefix, suffix = torrents.create_bencoded_torrent_parts(torrent, metadata_base,
+                                                                bencoded_values)
+        file_name = '{0}_{1}'.format(torrent.id, re.sub(r'[\\/]', '_', torrent.torrent_name))
+        torrent_parts.append((torrent.info_hash, file_name,
+                              torrent.created_time.timetuple()[:6], bytes(prefix), bytes(suffix)))
+    if db.session.dirty or db.session.new:
+        backend.commit_tracker_payloads()
+
+    if not torrent_parts:
+        flask.abort(404)
+
+    store = info_dicts.get_store()
+
+    def zip_entries():
+        # Info dicts are read one at a time as the archive is written out
+        for info_hash, file_name, date_time, prefix, suffix in torrent_parts:
+            bencoded_info = store.get(info_hash)
+            if bencoded_info is not None:
+                yield file_name, date_time, prefix + bencoded_info + suffix
+
+    resp = flask.Response(stream_zip(zip_entries()), mimetype='application/zip')
+    resp.headers['Content-Disposition'] = 'attachment; filename="torrents.zip"'
     return resp
 
 
+def _parse_torrent_ids(ids_arg, max_torrents):
+    ''' Returns the distinct torrent ids of a comma-separated list, in order '''
+    torrent_ids = collections.OrderedDict()
+    for torrent_id in ids_arg.split(','):
+        torrent_id = torrent_id.strip()
+        if not re.fullmatch(r'[0-9]+', torrent_id):
+            flask.abort(400)
+        torrent_ids[int(torrent_id)] = None
+        if len(torrent_ids) > max_torrents:
+            flask.abort(flask.Response('At most {} torrents can be downloaded at once.'
+                                       .format(max_torrents), 400))
+    return list(torrent_ids)
+
+
+def _search_torrent_ids(req_args, max_torrents):
+    ''' Returns the torrent ids of one page of max_torrents search results,
+        searching like main.home does '''
+    search_term, query_args = search_query_args(req_args, max_torrents)
+
+    if app.config.get('USE_ELASTIC_SEARCH') and search_term:
+        query_args['term'] = search_term
+        limit_es_page(query_args)
+        return [hit.id for hit in search_elastic(**query_args)]
+
+    query_args['term'] = db_search_term(search_term)
+    # Only the ids are needed, not the total
+    query_args['count'] = False
+    if app.config['USE_BAKED_SEARCH']:
+        query = search_db_baked(**query_args)
+    else:
+        query = search_db(**query_args)
+    return [torrent.id for torrent in query.items]
+
+
 @bp.route('/view/<int:torrent_id>/comment/<int:comment_id>/edit', methods=['POST'])
 def edit_comment(torrent_id, comment_id):
     if not flask.g.user:
@@ -492,10 +642,94 @@ def _create_upload_category_choices():
     return choices
 
 
+def _get_torrent_file(torrent, ssi=False):
+    ''' Returns (data, etag, last modified time) of the .torrent file of a torrent,
+        from TORRENT_FILE_CACHE if possible. With ssi, the data has an SSI include in place
+        of the info dict, and is None if that can't be done (see _make_ssi_torrent_file). '''
+    version, last_modified = torrents.torrent_file_version(torrent)
+    if ssi:
+        version += ('ssi',)
+
+    cached = torrents.TORRENT_FILE_CACHE.get(torrent.id, version)
+    if cached is not None:
+        torrent_file, etag = cached
+    else:
+        if ssi:
+            torrent_file = _make_ssi_torrent_file(torrent)
+            if torrent_file is None:
+                return None, None, last_modified
+        else:
+            torrent_file, _ = _make_torrent_file(torrent)
+        etag = hashlib.sha1(torrent_file).hexdigest()
+
+        max_size = app.config.get('TORRENT_FILE_CACHE_SIZE')
+        if max_size:
+            torrents.TORRENT_FILE_CACHE.put(torrent.id, version, torrent_file, etag, max_size)
+
+    return torrent_file, etag, last_modified
+
+
+def _torrent_metadata(torrent, commit=True):
+    ''' Returns (metadata_base, bencoded_values) for the .torrent file of a torrent,
+        taking its trackers from the stored tracker payload '''
+    metadata_base = torrents.create_default_metadata_base(torrent, trackers=[], webseeds=[])
+    bencoded_values = bencode.split_dict(backend.get_tracker_payload(torrent, commit))
+    return metadata_base, bencoded_values
+
+
+def _make_ssi_torrent_file(torrent):
+    ''' Returns the .torrent file of a torrent with an SSI include in place of the info dict,
+        for the front-end server to fill in from TORRENT_INFO_DICT_SSI_LOCATION.
+        Returns None if the info dict isn't stored as a plain file (or the file is missing),
+        or if the metadata itself happens to contain an SSI directive. '''
+    if not info_dicts.get_store().path(torrent.info_hash):
+        return None
+
+    info_hash = torrent.info_hash_as_hex
+    ssi_include = '<!--# include virtual="{0}{1}/{2}/{3}" -->'.format(
+        app.config['TORRENT_INFO_DICT_SSI_LOCATION'], info_hash[0:2], info_hash[2:4], info_hash)
+
+    metadata_base, bencoded_values = _torrent_metadata(torrent)
+    torrent_file = torrents.create_bencoded_torrent(torrent, ssi_include.encode('ascii'),
+                                                    metadata_base,
+                                                    bencoded_values=bencoded_values)
+
+    # Don't let uploaded trackers or webseeds smuggle their own directives through
+    if torrent_file.count(b'<!--#') != 1:
+        return None
+    return torrent_file
+
+
+def _stream_torrent_file(torrent, info_dict_path):
+    ''' Returns (iterable, size, etag, last modified time) of the .torrent file of a torrent.
+        Only the metadata around the info dict is built here, the info dict file is
+        sent with the server's wsgi.file_wrapper. '''
+    _, last_modified = torrents.torrent_file_version(torrent)
+    metadata_base, bencoded_values = _torrent_metadata(torrent)
+    prefix, suffix = torrents.create_bencoded_torrent_parts(torrent, metadata_base,
+                                                            bencoded_values)
+
+    # The info hash pins down the info dict, so this is as good as hashing the whole file
+    etag = hashlib.sha1(prefix + torrent.info_hash + suffix).hexdigest()
+
+    info_file = open(info_dict_path, 'rb')
+    info_size = os.fstat(info_file.fileno()).st_size
+    info_chunks = wrap_file(flask.request.environ, info_file, buffer_size=64 * 1024)
+
+    torrent_file = ClosingIterator(
+        itertools.chain((bytes(prefix),), info_chunks, (bytes(suffix),)), info_file.close)
+
+    return torrent_file, len(prefix) + info_size + len(suffix), etag, last_modified
+
+
 def _make_torrent_file(torrent):
-    with open(torrent.info_dict_path, 'rb') as in_file:
-        bencoded_info = in_file.read()
+    bencoded_info = info_dicts.get_store().get(torrent.info_hash)
+    if bencoded_info is None:
+        flask.abort(404)
 
-    bencoded_torrent_data = torrents.create_bencoded_torrent(torrent, bencoded_info)
+    metadata_base, bencoded_values = _torrent_metadata(torrent)
+    bencoded_torrent_data = torrents.create_bencoded_torrent(torrent, bencoded_info,
+                                                             metadata_base,
+                                                             bencoded_values=bencoded_values)
 
     return bencoded_torrent_data, len(bencoded_torrent_data)
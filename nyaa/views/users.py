@@ -7,12 +7,14 @@ from itertools import chain
 import flask
 from flask_paginate import Pagination
 
+from elasticsearch.exceptions import ElasticsearchException
 from itsdangerous import BadSignature, URLSafeSerializer
 
 from nyaa import forms, models
 from nyaa.extensions import db
 from nyaa.search import (DEFAULT_MAX_SEARCH_RESULT, DEFAULT_PER_PAGE, SERACH_PAGINATE_DISPLAY_MSG,
-                         _generate_query_string, search_db, search_db_baked, search_elastic)
+                         _generate_query_string, es_health, keyset_query_args, search_db,
+                         search_db_baked, search_elastic)
 from nyaa.utils import admin_only, chain_get, sha1_hash
 
 app = flask.current_app
@@ -121,6 +123,7 @@ def view_user(user_name):
     quality_filter = chain_get(req_args, 'f', 'filter')
 
     page_number = chain_get(req_args, 'p', 'page', 'offset')
+    keyset_args = keyset_query_args(req_args, page_number)
     try:
         page_number = max(1, int(page_number))
     except (ValueError, TypeError):
@@ -148,29 +151,48 @@ def view_user(user_name):
     # Use elastic search for term searching
     rss_query_string = _generate_query_string(search_term, category, quality_filter, user_name)
     use_elastic = app.config.get('USE_ELASTIC_SEARCH')
-    if use_elastic and search_term:
-        query_args['term'] = search_term
+    # Browsing too with ES_BROWSE, unless ES is failing or lagging behind
+    es_browse = bool(use_elastic and not search_term and app.config.get('ES_BROWSE') and
+                     es_health.healthy())
+    query_results = None
+    if use_elastic and (search_term or es_browse):
+        es_query_args = dict(query_args, term=search_term or '')
 
         max_search_results = app.config.get('ES_MAX_SEARCH_RESULT', DEFAULT_MAX_SEARCH_RESULT)
 
-        # Only allow up to (max_search_results / page) pages
-        max_page = min(query_args['page'], int(math.ceil(max_search_results / results_per_page)))
-
-        query_args['page'] = max_page
-        query_args['max_search_results'] = max_search_results
-
-        query_results = search_elastic(**query_args)
-
-        max_results = min(max_search_results, query_results['hits']['total'])
-        # change p= argument to whatever you change page_parameter to or pagination breaks
-        pagination = Pagination(p=query_args['page'], per_page=results_per_page,
-                                total=max_results, bs_version=3, page_parameter='p',
-                                display_msg=SERACH_PAGINATE_DISPLAY_MSG)
+        # Cursors (search_after) reach all results, page numbers only max_search_results
+        if keyset_args['keyset']:
+            es_query_args.update(keyset_args)
+        else:
+            # Only allow up to (max_search_results / page) pages
+            max_page = min(query_args['page'],
+                           int(math.ceil(max_search_results / results_per_page)))
+
+            es_query_args['page'] = max_page
+            es_query_args['max_search_results'] = max_search_results
+
+        try:
+            query_results = search_elastic(**es_query_args)
+        except ElasticsearchException:
+            if not es_browse:
+                raise
+            # Browse the database instead (below), for a while
+            app.logger.exception('Browsing with ES failed, falling back to the database')
+            es_health.failed()
+
+    if query_results is not None:
+        pagination = None
+        if not es_query_args.get('keyset'):
+            max_results = min(max_search_results, query_results['hits']['total']['value'])
+            # change p= argument to whatever you change page_parameter to or pagination breaks
+            pagination = Pagination(p=es_query_args['page'], per_page=results_per_page,
+                                    total=max_results, bs_version=3, page_parameter='p',
+                                    display_msg=SERACH_PAGINATE_DISPLAY_MSG)
         return flask.render_template('user.html',
                                      use_elastic=True,
                                      pagination=pagination,
                                      torrent_query=query_results,
-                                     search=query_args,
+                                     search=es_query_args,
                                      user=user,
                                      user_page=True,
                                      rss_filter=rss_query_string,
@@ -178,13 +200,16 @@ def view_user(user_name):
                                      ban_form=ban_form,
                                      nuke_form=nuke_form,
                                      bans=bans,
-                                     ipbanned=ipbanned)
+                                     ipbanned=ipbanned,
+                                     es_lag=es_health.lag_notice() if es_browse else None)
     # Similar logic as home page
     else:
         if use_elastic:
             query_args['term'] = ''
         else:
             query_args['term'] = search_term or ''
+        query_args.update(keyset_args)
+        query_args['count'] = 'user' not in app.config.get('SEARCH_COUNTLESS_PAGINATION', ())
         if app.config['USE_BAKED_SEARCH']:
             query = search_db_baked(**query_args)
         else:
@@ -277,8 +302,10 @@ def nuke_user_torrents(user_name):
     nyaa_banned = 0
     sukebei_banned = 0
     for t in chain(user.nyaa_torrents, user.sukebei_torrents):
+        old_count_key = t.count_key
         t.deleted = True
         t.banned = True
+        t.update_count(old_count_key)
         t.stats.seed_count = 0
         t.stats.leech_count = 0
         db.session.add(t)
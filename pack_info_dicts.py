@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import shutil
+import sys
+
+import click
+
+from nyaa import create_app, info_dicts
+
+
+def packed_store():
+    ''' Returns the packed store configured with INFO_DICT_PACK_DIR etc.,
+        no matter what INFO_DICT_STORE is set to. '''
+    return info_dicts.create_store(dict(app.config, INFO_DICT_STORE='packed'))
+
+
+def format_size(size):
+    return '{:,.1f} MiB'.format(size / 1024 ** 2)
+
+
+@click.group()
+def pack_info_dicts():
+    global app
+    app = create_app('config')
+
+
+@pack_info_dicts.command()
+@click.option('--delete-source', is_flag=True, default=False,
+              help='Delete the info_dicts directory after a successful migration.')
+@click.option('--source', type=click.Path(exists=True, file_okay=False),
+              help='Directory to migrate from (defaults to BASE_DIR/info_dicts).')
+def migrate(delete_source, source):
+    ''' Copies info dicts from the one-file-per-hash directory tree into pack files.
+        Writes to the packed store wait until this is done. '''
+    with app.app_context():
+        source_store = info_dicts.create_store(dict(app.config, INFO_DICT_STORE='files'))
+        if source:
+            source_store.directory = source
+        store = packed_store()
+
+        def read_source():
+            count = 0
+            # Hashes come out of the directory tree in sorted order, as compact() wants
+            for info_hash in source_store.iter_hashes():
+                bencoded_info_dict = source_store.get(info_hash)
+                if bencoded_info_dict is None:
+                    continue
+                yield info_hash, bencoded_info_dict
+
+                count += 1
+                if count % 10000 == 0:
+                    click.echo('Read {} info dicts...'.format(count))
+
+        count, _, new_size = store.compact(added=read_source())
+        click.echo('{} info dicts now in {}, {} in total.'.format(
+            count, store.directory, format_size(new_size)))
+
+        if delete_source:
+            shutil.rmtree(source_store.directory)
+            click.echo('Deleted {}.'.format(source_store.directory))
+
+        if app.config.get('INFO_DICT_STORE') != 'packed':
+            click.secho("Set INFO_DICT_STORE = 'packed' in your config to use them.",
+                        fg='yellow')
+
+
+@pack_info_dicts.command()
+def compact():
+    ''' Rewrites the pack files, dropping deleted info dicts. '''
+    with app.app_context():
+        store = packed_store()
+        count, old_size, new_size = store.compact()
+        click.echo('Compacted {} info dicts from {} down to {}.'.format(
+            count, format_size(old_size), format_size(new_size)))
+
+
+@pack_info_dicts.command()
+@click.argument('info_hash')
+def show(info_hash):
+    ''' Writes out the bencoded info dict of a (hex) info hash. '''
+    with app.app_context():
+        bencoded_info_dict = info_dicts.get_store().get(bytes.fromhex(info_hash))
+        if bencoded_info_dict is None:
+            click.secho('No info dict for {} found.'.format(info_hash), err=True, fg='red')
+            sys.exit(1)
+        click.get_binary_stream('stdout').write(bencoded_info_dict)
+
+
+if __name__ == '__main__':
+    pack_info_dicts()
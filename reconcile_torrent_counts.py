@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import click
+import sqlalchemy
+
+from nyaa import create_app, models
+from nyaa.extensions import db
+
+FLAVORS = {
+    'nyaa': (models.NyaaTorrent, models.NyaaTorrentCount),
+    'sukebei': (models.SukebeiTorrent, models.SukebeiTorrentCount),
+}
+
+
+def reconcile_flavor(flavor, dry_run):
+    ''' Recounts the torrents of a flavor and fixes the torrent_counts rows that differ.
+        Returns the number of rows fixed. '''
+    torrent_class, count_class = FLAVORS[flavor]
+    torrents = torrent_class.__table__
+    counts = count_class.__table__
+
+    # Lock the counts first: uploads and edits wait for the recount to be written instead
+    # of changing counts the recount is about to overwrite
+    stored = {(row.main_category_id, row.sub_category_id, row.flags): row.torrent_count
+              for row in db.session.execute(counts.select().with_for_update())}
+
+    counted_flags = torrents.c.flags.op('&')(int(models.COUNTED_TORRENT_FLAGS))
+    actual = {(main_cat_id, sub_cat_id, flags): torrent_count
+              for main_cat_id, sub_cat_id, flags, torrent_count in db.session.execute(
+                  sqlalchemy.select([torrents.c.main_category_id, torrents.c.sub_category_id,
+                                     counted_flags, sqlalchemy.func.count()])
+                  .group_by(torrents.c.main_category_id, torrents.c.sub_category_id,
+                            counted_flags))}
+
+    fixed = 0
+    for count_key in sorted(set(stored) | set(actual)):
+        stored_count = stored.get(count_key, 0)
+        actual_count = actual.get(count_key, 0)
+        if stored_count == actual_count:
+            continue
+
+        fixed += 1
+        click.echo('{}\t{}_{}\tflags {}\t{} -> {}'.format(
+            flavor, count_key[0], count_key[1], count_key[2], stored_count, actual_count))
+        if not dry_run:
+            count_class.adjust(count_key, actual_count - stored_count)
+
+    if dry_run:
+        db.session.rollback()
+    else:
+        db.session.commit()
+    return fixed
+
+
+@click.command()
+@click.option('--flavor', 'flavors', type=click.Choice(sorted(FLAVORS)), multiple=True,
+              help='Torrent tables to reconcile (default: all).')
+@click.option('--dry-run', is_flag=True, default=False,
+              help='Only print the counts that differ.')
+def reconcile_torrent_counts(flavors, dry_run):
+    ''' Recounts torrents per category and counted flags, and fixes the torrent_counts
+        tables where they drifted. Meant to be run periodically, e.g. from cron.
+        Differences are written to stdout as tab-separated lines. '''
+    app = create_app('config')
+
+    with app.app_context():
+        for flavor in flavors or sorted(FLAVORS):
+            fixed = reconcile_flavor(flavor, dry_run)
+            click.echo('{}: {} counts {}'.format(
+                flavor, fixed, 'differ' if dry_run else 'fixed'), err=True)
+
+
+if __name__ == '__main__':
+    reconcile_torrent_counts()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Rebuilds the Elasticsearch index of a flavor without taking search down.
+
+The site and sync_es use the index by its plain name (ES_INDEX_NAME, e.g.
+`nyaa`), which this makes an alias of a versioned index (`nyaa-20200101120000`):
+- the binlog position is taken first, then all torrents are imported into a
+  new versioned index with refreshes off (see import_to_es),
+- the new index is caught up from that position with sync_es' engine, in
+  passes over the binlog until a pass is short,
+- after a sanity check of its document count, the alias is moved to the new
+  index in one atomic update. Changes sync_es posted to the old index during
+  the last pass are then replayed onto the new one.
+The previous indices are kept (--keep) so `rollback` can move the alias back.
+They stop getting updates when they stop serving, so the binlog position
+sync_es had reached then is recorded, and rollback replays the changes since
+into the index before moving the alias back to it.
+Indices are marked as served in their mapping's _meta when the alias is
+pointed at them, and only those are kept or rolled back to. A new index is
+deleted again if anything fails before it has taken over.
+
+The first time, `nyaa` is still an index rather than an alias. It has to be
+deleted in the same update that creates the alias, which --replace-index
+allows; there is nothing to roll back to then.
+"""
+import json
+import multiprocessing
+import os
+import time
+from datetime import datetime
+
+import click
+from elasticsearch import Elasticsearch
+from elasticsearch.client import IndicesClient
+from elasticsearch.exceptions import NotFoundError
+
+import import_to_es
+import sync_es
+from nyaa import create_app
+from nyaa.extensions import db
+
+MAPPING_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'es_mapping.yml')
+
+
+class ReindexError(Exception):
+    pass
+
+
+def versioned_indices(ic, alias, served=None):
+    ''' Returns the versioned indices of an alias, oldest first. With served set, only those
+        that have (or have not) been behind the alias. '''
+    indices = ic.get(index='{}-*'.format(alias), expand_wildcards='open')
+    return sorted(index_name for index_name, index in indices.items()
+                  if served is None or
+                  served == bool(index['mappings'].get('_meta', {}).get('served')))
+
+
+def alias_indices(ic, alias):
+    ''' Returns the indices an alias points at, or None if the name is an index itself '''
+    if ic.exists_alias(name=alias):
+        return sorted(ic.get_alias(name=alias))
+    if ic.exists(index=alias):
+        return None
+    return []
+
+
+def swap_alias(ic, alias, index_name, replace_index=False, retired_at=None):
+    ''' Points the alias at index_name alone, atomically. Returns the indices it pointed at
+        before. retired_at is the binlog position sync_es had posted up to, which the
+        indices that stop serving are recorded to be synced to. '''
+    current = alias_indices(ic, alias)
+    if current is None:
+        if not replace_index:
+            raise ReindexError('{} is an index, not an alias; pass --replace-index to delete '
+                               'it when the alias is created'.format(alias))
+        actions = [{'remove_index': {'index': alias}}]
+        current = []
+    else:
+        actions = [{'remove': {'index': old_index, 'alias': alias}} for old_index in current]
+    actions.append({'add': {'index': index_name, 'alias': alias}})
+    # Only indices that have served can be rolled back to
+    for old_index in current:
+        ic.put_mapping(index=old_index, body={'_meta': {'served': True,
+                                                        'retired_at': retired_at}})
+    ic.put_mapping(index=index_name, body={'_meta': {'served': True}})
+    ic.update_aliases(body={'actions': actions})
+    return current
+
+
+def synced_position(sync_config):
+    ''' Returns the binlog position sync_es has posted everything before '''
+    with open(sync_config.get('save_loc', '/tmp/pos.json')) as f:
+        pos = json.load(f)
+    return {'log_file': pos['log_file'], 'log_pos': pos['log_pos']}
+
+
+def create_index(es, index_name):
+    ''' Creates an index with the mapping in es_mapping.yml and refreshes off '''
+    with open(MAPPING_FILE) as mapping_file:
+        mapping = mapping_file.read()
+    es.transport.perform_request('PUT', '/' + index_name, body=mapping,
+                                 headers={'content-type': 'application/yaml'})
+    IndicesClient(es).put_settings(body={'index': {'refresh_interval': '-1'}}, index=index_name)
+
+
+def catch_up(es, sync_config, flavor, index_name, position, short_pass):
+    ''' Syncs the binlog from position into index_name in passes up to the head of the log,
+        until a pass takes less than short_pass seconds. Returns the position reached. '''
+    sink = sync_es.EsSink(es, sync_config.get('es_chunk_size', 10000), {flavor: index_name})
+    while True:
+        saves = []
+        engine = sync_es.SyncEngine(
+            sync_es.BinlogReader(sync_config, position['log_file'], position['log_pos'],
+                                 blocking=False),
+            sink,
+            save_pos=lambda log_file, log_pos, synced_time: saves.append(
+                {'log_file': log_file, 'log_pos': log_pos}),
+            chunk_size=sync_config.get('es_chunk_size', 10000),
+            flush_interval=1,
+            queue_depth=sync_config.get('internal_queue_depth', 10000),
+            max_in_flight=sync_config.get('max_in_flight_bulks', 2),
+            pos=(position['log_file'], position['log_pos'], None))
+
+        started = time.time()
+        engine.run()
+        elapsed = time.time() - started
+        if saves:
+            position = saves[-1]
+        click.echo('{}: caught up to {} in {:.1f}s'.format(
+            index_name, json.dumps(position), elapsed), err=True)
+        if elapsed < short_pass:
+            return position
+
+
+def switch_back(es, sync_config, flavor, index_name, short_pass):
+    ''' Points the alias of a flavor back at an index that served before, catching it up
+        first with the changes since it stopped serving. Returns the indices the alias
+        pointed at before. '''
+    ic = IndicesClient(es)
+    alias = flavor
+    meta = ic.get_mapping(index=index_name)[index_name]['mappings'].get('_meta', {})
+    position = meta.get('retired_at')
+    if position:
+        position = catch_up(es, sync_config, flavor, index_name, position, short_pass)
+    else:
+        click.echo('{}: no record of when {} stopped serving, it may be out of date'.format(
+            alias, index_name), err=True)
+
+    previous = swap_alias(ic, alias, index_name, retired_at=synced_position(sync_config))
+    if position:
+        # Changes sync_es posted to the alias during the last pass
+        catch_up(es, sync_config, flavor, index_name, position, short_pass=float('inf'))
+    return previous
+
+
+def reindex_flavor(app, es, pool, sync_config, flavor, replace_index, short_pass, keep,
+                   max_missing):
+    ic = IndicesClient(es)
+    alias = flavor
+    index_name = '{}-{:%Y%m%d%H%M%S}'.format(alias, datetime.utcnow())
+
+    with app.app_context():
+        # Everything that changes from here on is replayed into the new index
+        position = import_to_es.binlog_position()
+        torrent_count = import_to_es.FLAVORS[flavor].query.count()
+        db.session.remove()
+        db.engine.dispose()
+    click.echo('{}: building {} from {}'.format(alias, index_name, json.dumps(position)),
+               err=True)
+
+    create_index(es, index_name)
+    try:
+        import_to_es.import_flavor(flavor, pool, ic, import_to_es.ImportState(None),
+                                   index_name)
+        position = catch_up(es, sync_config, flavor, index_name, position, short_pass)
+
+        ic.refresh(index=index_name)
+        indexed = es.count(index=index_name)['count']
+        if torrent_count - indexed > max_missing * torrent_count:
+            raise ReindexError('{} has {} documents for {} torrents, not swapping'.format(
+                index_name, indexed, torrent_count))
+
+        previous = swap_alias(ic, alias, index_name, replace_index,
+                              retired_at=synced_position(sync_config))
+    except BaseException:
+        click.echo('{}: deleting unfinished {}'.format(alias, index_name), err=True)
+        ic.delete(index=index_name, ignore=404)
+        raise
+
+    click.echo('{}: now {} (was {})'.format(alias, index_name, ', '.join(previous) or '-'),
+               err=True)
+    try:
+        # sync_es posts to the alias, but until the swap that was the old index
+        catch_up(es, sync_config, flavor, index_name, position, short_pass=float('inf'))
+        es.search(index=alias, body={'query': {'match_all': {}}, 'size': 1})
+    except BaseException:
+        # Without a previous index (--replace-index), the new one is all there is
+        if previous:
+            click.echo('{}: rolling back to {}, deleting {}'.format(
+                alias, previous[-1], index_name), err=True)
+            switch_back(es, sync_config, flavor, previous[-1], short_pass)
+            ic.delete(index=index_name, ignore=404)
+        raise
+
+    for old_index in versioned_indices(ic, alias, served=True)[:-keep - 1]:
+        click.echo('{}: deleting {}'.format(alias, old_index), err=True)
+        ic.delete(index=old_index)
+
+
+@click.group()
+def reindex_es():
+    ''' Manages the versioned Elasticsearch indices behind the flavor aliases. '''
+
+
+@reindex_es.command()
+@click.argument('sync_config', type=click.File('r'))
+@click.option('--flavor', 'flavors', type=click.Choice(sorted(import_to_es.FLAVORS)),
+              multiple=True, help='Indices to rebuild (default: all).')
+@click.option('--replace-index', is_flag=True, default=False,
+              help='Delete an index with the name of the alias when creating the alias.')
+@click.option('--keep', type=int, default=1,
+              help='Previous indices to keep for rollback.')
+@click.option('--short-pass', type=float, default=10,
+              help='Seconds a binlog pass may take to count as caught up.')
+@click.option('--max-missing', type=float, default=0.001,
+              help='Share of torrents the new index may miss and still be swapped in.')
+@click.option('--workers', type=int, default=os.cpu_count(),
+              help='Importing processes (default: CPU count).')
+def reindex(sync_config, flavors, replace_index, keep, short_pass, max_missing, workers):
+    ''' Rebuilds indices into new versioned indices and swaps their aliases over.
+        SYNC_CONFIG is the config JSON of sync_es, for its mysql settings. '''
+    sync_config = json.load(sync_config)
+    sync_es.log.setLevel('WARNING')
+    app = create_app('config')
+    es = Elasticsearch(hosts=app.config['ES_HOSTS'], timeout=30)
+
+    bulk_options = {'thread_count': 2, 'chunk_size': 2000}
+    with multiprocessing.Pool(workers, import_to_es._init_worker, (bulk_options,)) as pool:
+        for flavor in flavors or sorted(import_to_es.FLAVORS):
+            try:
+                reindex_flavor(app, es, pool, sync_config, flavor, replace_index, short_pass,
+                               keep, max_missing)
+            except ReindexError as e:
+                raise click.ClickException(str(e))
+
+
+@reindex_es.command()
+@click.argument('sync_config', type=click.File('r'))
+@click.argument('flavor', type=click.Choice(sorted(import_to_es.FLAVORS)))
+@click.option('--to', 'index_name', help='Index to point the alias at '
+              '(default: the one before the current one).')
+@click.option('--short-pass', type=float, default=10,
+              help='Seconds a binlog pass may take to count as caught up.')
+def rollback(sync_config, flavor, index_name, short_pass):
+    ''' Points the alias of a flavor back at a previous versioned index. The index stopped
+        getting updates when it stopped serving, so the changes since then are replayed into
+        it from the binlog first. SYNC_CONFIG is the config JSON of sync_es. '''
+    sync_config = json.load(sync_config)
+    sync_es.log.setLevel('WARNING')
+    app = create_app('config')
+    es = Elasticsearch(hosts=app.config['ES_HOSTS'], timeout=30)
+    ic = IndicesClient(es)
+    alias = flavor
+
+    current = alias_indices(ic, alias)
+    if not current:
+        raise click.ClickException('{} is not an alias'.format(alias))
+    if index_name is None:
+        older = [old_index for old_index in versioned_indices(ic, alias, served=True)
+                 if old_index < current[-1]]
+        if not older:
+            raise click.ClickException('No index before {}'.format(current[-1]))
+        index_name = older[-1]
+
+    try:
+        ic.get(index=index_name)
+    except NotFoundError:
+        raise click.ClickException('No index {}'.format(index_name))
+    switch_back(es, sync_config, flavor, index_name, short_pass)
+    click.echo('{}: now {} (was {})'.format(alias, index_name, ', '.join(current)))
+
+
+if __name__ == '__main__':
+    reindex_es()
@@ -21,62 +21,55 @@ when import_to_es and sync_es will be lost. Instead, you can run SHOW MASTER
 STATUS _before_ you run import_to_es. That way you'll definitely pick up any
 changes that happen while the import_to_es script is dumping stuff from the
 database into es, at the expense of redoing a (small) amount of indexing.
+import_to_es prints a position taken that way. To rebuild an index while the
+old one keeps serving searches, use reindex_es.py instead, which takes care of
+the positions itself.
 
-This uses multithreading so we don't have to block on socket io (both binlog
-reading and es POSTing). asyncio soon™
+The binlog is read in a thread (the reader is synchronous) into a bounded
+asyncio queue, and up to max_in_flight_bulks bulk POSTs to es run at once, see
+SyncEngine. Flushing (es_chunk_size, flush_interval), read-ahead
+(internal_queue_depth) and saving (save_interval, save_every) are set in the
+config JSON.
+
+With "record_file" in the config, the binlog events read are also appended to
+that file. With "replay_file", events are read from such a file instead of
+mysql (from the saved position on, until the end of the file), so the sync
+can be run and benchmarked without mysql, see bench_sync_es.py.
 
 This script will exit on any sort of exception, so you'll want to use your
 supervisor's restart functionality, e.g. Restart=failure in systemd, or
 the poor man's `while true; do sync_es.py; sleep 1; done` in tmux.
 """
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk, BulkIndexError
 from pymysqlreplication import BinLogStreamReader
 from pymysqlreplication.row_event import UpdateRowsEvent, DeleteRowsEvent, WriteRowsEvent
-from datetime import datetime
+from statsd import StatsClient
 
-from nyaa import create_app, db, models
+from nyaa import create_app
 from nyaa.models import TorrentFlags
-app = create_app('config')
-
-import sys
-import json
-import time
-import logging
-from statsd import StatsClient
-from threading import Thread
-from queue import Queue, Empty
 
 logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s - %(message)s')
 
 log = logging.getLogger('sync_es')
 log.setLevel(logging.INFO)
 
-# config in json, 2lazy to argparse
-if len(sys.argv) != 2:
-    print("need config.json location", file=sys.stderr)
-    sys.exit(-1)
-with open(sys.argv[1]) as f:
-    config = json.load(f)
-
 # goes to netdata or other statsd listener
 stats = StatsClient('localhost', 8125, prefix="sync_es")
 
 #logging.getLogger('elasticsearch').setLevel(logging.DEBUG)
 
-# in prod want in /var/lib somewhere probably
-SAVE_LOC = config.get('save_loc', "/tmp/pos.json")
-MYSQL_HOST = config.get('mysql_host', '127.0.0.1')
-MYSQL_PORT = config.get('mysql_port', 3306)
-MYSQL_USER = config.get('mysql_user', 'root')
-MYSQL_PW = config.get('mysql_password', 'dunnolol')
-NT_DB = config.get('database', 'nyaav2')
-INTERNAL_QUEUE_DEPTH = config.get('internal_queue_depth', 10000)
-ES_CHUNK_SIZE = config.get('es_chunk_size', 10000)
-# seconds since no events happening to flush to es. remember this also
-# interacts with es' refresh_interval setting.
-FLUSH_INTERVAL = config.get('flush_interval', 5)
-
 def pad_bytes(in_bytes, size):
     return in_bytes + (b'\x00' * max(0, size - len(in_bytes)))
 
@@ -141,64 +134,99 @@ def delet_this(row, index_name):
         '_index': index_name,
         '_id': str(row['values']['id'])}
 
-# we could try to make this script robust to errors from es or mysql, but since
-# the only thing we can do is "clear state and retry", it's easier to leave
-# this to the supervisor. If we we carrying around heavier state in-process,
-# it'd be more worth it to handle errors ourselves.
-# 
-# Apparently there's no setDefaultUncaughtExceptionHandler in threading, and
-# sys.excepthook is also broken, so this gives us the same
-# exit-if-anything-happens semantics. 
-class ExitingThread(Thread):
-    def run(self):
-        try:
-            self.run_happy()
-        except:
-            log.exception("something happened")
-            # sys.exit only exits the thread, lame
-            import os
-            os._exit(1)
-
-class BinlogReader(ExitingThread):
-    # write_buf is the Queue we communicate with
-    def __init__(self, write_buf):
-        Thread.__init__(self)
-        self.write_buf = write_buf
-
-    def run_happy(self):
-        with open(SAVE_LOC) as f:
-            pos = json.load(f)
 
+def event_actions(table, kind, rows):
+    # turn the rows of a binlog row event (kind being the name of its
+    # pymysqlreplication class) into es actions
+    actions = []
+    if table == "nyaa_torrents" or table == "sukebei_torrents":
+        if table == "nyaa_torrents":
+            index_name = "nyaa"
+        else:
+            index_name = "sukebei"
+        if kind == 'WriteRowsEvent':
+            for row in rows:
+                actions.append(reindex_torrent(row['values'], index_name))
+        elif kind == 'UpdateRowsEvent':
+            # UpdateRowsEvent includes the old values too, but we don't care
+            for row in rows:
+                actions.append(reindex_torrent(row['after_values'], index_name))
+        elif kind == 'DeleteRowsEvent':
+            # ok, bye
+            for row in rows:
+                actions.append(delet_this(row, index_name))
+        else:
+            raise Exception(f"unknown event {kind}")
+    elif table == "nyaa_statistics" or table == "sukebei_statistics":
+        if table == "nyaa_statistics":
+            index_name = "nyaa"
+        else:
+            index_name = "sukebei"
+        if kind == 'WriteRowsEvent':
+            for row in rows:
+                actions.append(reindex_stats(row['values'], index_name))
+        elif kind == 'UpdateRowsEvent':
+            for row in rows:
+                actions.append(reindex_stats(row['after_values'], index_name))
+        elif kind == 'DeleteRowsEvent':
+            # uh ok. Assume that the torrent row will get deleted later,
+            # which will clean up the entire es "torrent" document
+            pass
+        else:
+            raise Exception(f"unknown event {kind}")
+    else:
+        raise Exception(f"unknown table {table}")
+    return actions
+
+class BinlogReader:
+    """
+    Iterates over (pos or None, action) for the rows of the binlog from a
+    saved position on, blocking at the head of the log. Only the last action
+    of each binlog event comes with the position after it, since that's only
+    safe to save once all of the event's actions are posted.
+
+    If record is a file, the events are also written to it for ReplaySource.
+    Without blocking, iterating ends at the head of the log.
+    """
+    def __init__(self, config, log_file, log_pos, record=None, blocking=True):
+        self.config = config
+        self.log_file = log_file
+        self.log_pos = log_pos
+        self.record = record
+        self.blocking = blocking
+
+    def __iter__(self):
         stream = BinLogStreamReader(
                 # TODO parse out from config.py or something
                 connection_settings = {
-                    'host': MYSQL_HOST,
-                    'port': MYSQL_PORT,
-                    'user': MYSQL_USER,
-                    'passwd': MYSQL_PW
+                    'host': self.config.get('mysql_host', '127.0.0.1'),
+                    'port': self.config.get('mysql_port', 3306),
+                    'user': self.config.get('mysql_user', 'root'),
+                    'passwd': self.config.get('mysql_password', 'dunnolol')
                 },
                 server_id=10, # arbitrary
                 # only care about this database currently
-                only_schemas=[NT_DB],
+                only_schemas=[self.config.get('database', 'nyaav2')],
                 # these tables in the database
                 only_tables=["nyaa_torrents", "nyaa_statistics", "sukebei_torrents", "sukebei_statistics"],
                 # from our save file
                 resume_stream=True,
-                log_file=pos['log_file'],
-                log_pos=pos['log_pos'],
+                log_file=self.log_file,
+                log_pos=self.log_pos,
                 # skip the other stuff like table mapping
                 only_events=[UpdateRowsEvent, DeleteRowsEvent, WriteRowsEvent],
                 # if we're at the head of the log, block until something happens
                 # note it'd be nice to block async-style instead, but the mainline
-                # binlogreader is synchronous. there is an (unmaintained?) fork
-                # using aiomysql if anybody wants to revive that.
-                blocking=True)
+                # binlogreader is synchronous, so SyncEngine reads it in a thread.
+                # there is an (unmaintained?) fork using aiomysql if anybody wants
+                # to revive that.
+                blocking=self.blocking)
 
         log.info(f"reading binlog from {stream.log_file}/{stream.log_pos}")
 
         for event in stream:
-            # save the pos of the stream and timestamp with each message, so we
-            # can commit in the other thread. and keep track of process latency
+            # the pos of the stream and timestamp after this event, to
+            # commit once it's posted. and keep track of process latency
             pos = (stream.log_file, stream.log_pos, event.timestamp)
             with stats.pipeline() as s:
                 s.incr('total_events')
@@ -208,139 +236,418 @@ class BinlogReader(ExitingThread):
                 # XXX not a "timer", but we get a histogram out of it
                 s.timing(f"rows_per_event.{event.table}.{type(event).__name__}", len(event.rows))
 
-            if event.table == "nyaa_torrents" or event.table == "sukebei_torrents":
-                if event.table == "nyaa_torrents":
-                    index_name = "nyaa"
-                else:
-                    index_name = "sukebei"
-                if type(event) is WriteRowsEvent:
-                    for row in event.rows:
-                        self.write_buf.put(
-                                (pos, reindex_torrent(row['values'], index_name)),
-                                block=True)
-                elif type(event) is UpdateRowsEvent:
-                    # UpdateRowsEvent includes the old values too, but we don't care
-                    for row in event.rows:
-                        self.write_buf.put(
-                                (pos, reindex_torrent(row['after_values'], index_name)),
-                                block=True)
-                elif type(event) is DeleteRowsEvent:
-                    # ok, bye
-                    for row in event.rows:
-                        self.write_buf.put((pos, delet_this(row, index_name)), block=True)
-                else:
-                    raise Exception(f"unknown event {type(event)}")
-            elif event.table == "nyaa_statistics" or event.table == "sukebei_statistics":
-                if event.table == "nyaa_statistics":
-                    index_name = "nyaa"
-                else:
-                    index_name = "sukebei"
-                if type(event) is WriteRowsEvent:
-                    for row in event.rows:
-                        self.write_buf.put(
-                                (pos, reindex_stats(row['values'], index_name)),
-                                block=True)
-                elif type(event) is UpdateRowsEvent:
-                    for row in event.rows:
-                        self.write_buf.put(
-                                (pos, reindex_stats(row['after_values'], index_name)),
-                                block=True)
-                elif type(event) is DeleteRowsEvent:
-                    # uh ok. Assume that the torrent row will get deleted later,
-                    # which will clean up the entire es "torrent" document
-                    pass
-                else:
-                    raise Exception(f"unknown event {type(event)}")
-            else:
-              raise Exception(f"unknown table {s.table}")
-
-class EsPoster(ExitingThread):
-    # read_buf is the queue of stuff to bulk post
-    def __init__(self, read_buf, chunk_size=1000, flush_interval=5):
-        Thread.__init__(self)
-        self.read_buf = read_buf
+            kind = type(event).__name__
+            if self.record:
+                record_event(self.record, pos, event.table, kind, event.rows)
+            yield from event_pos_actions(pos, event_actions(event.table, kind, event.rows))
+
+def event_pos_actions(pos, actions):
+    for i, action in enumerate(actions, 1):
+        yield (pos if i == len(actions) else None, action)
+
+# recorded events are json lines; rows hold bytes and datetimes, which
+# are written as {"$bytes": hex} and {"$datetime": iso format}
+def encode_value(value):
+    if isinstance(value, bytes):
+        return {"$bytes": value.hex()}
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    raise TypeError(f"can't record {type(value)}")
+
+def decode_value(obj):
+    if "$bytes" in obj:
+        return bytes.fromhex(obj["$bytes"])
+    if "$datetime" in obj:
+        return datetime.fromisoformat(obj["$datetime"])
+    return obj
+
+def record_event(f, pos, table, kind, rows):
+    (log_file, log_pos, timestamp) = pos
+    f.write(json.dumps({"log_file": log_file, "log_pos": log_pos, "timestamp": timestamp,
+                        "table": table, "kind": kind, "rows": rows},
+                       default=encode_value) + "\n")
+
+class ReplaySource:
+    """
+    Iterates over the events recorded by BinlogReader like it would, from
+    after log_file/log_pos on, then ends. For running the sync without mysql.
+    """
+    def __init__(self, path, log_file=None, log_pos=None):
+        self.path = path
+        self.log_file = log_file
+        self.log_pos = log_pos
+
+    def __iter__(self):
+        with open(self.path) as f:
+            for line in f:
+                event = json.loads(line, object_hook=decode_value)
+                pos = (event['log_file'], event['log_pos'], event['timestamp'])
+                # binlog file names sort in order
+                if self.log_file is not None and pos[:2] <= (self.log_file, self.log_pos):
+                    continue
+                yield from event_pos_actions(
+                    pos, event_actions(event['table'], event['kind'], event['rows']))
+
+class EsSink:
+    """
+    Posts bulks of actions to es; this is what SyncEngine's post_bulk is,
+    unless benchmarking. es only needs what helpers.bulk uses of the client.
+
+    With indices ({flavor index name: index name}), actions go to those
+    indices instead, and actions on other indices are dropped. reindex_es.py
+    uses this to catch up a new index.
+    """
+    def __init__(self, es, chunk_size, indices=None):
+        self.es = es
+        self.chunk_size = chunk_size
+        self.indices = indices
+
+    def __call__(self, actions):
+        if self.indices is not None:
+            actions = [dict(action, _index=self.indices[action['_index']])
+                       for action in actions if action['_index'] in self.indices]
+        try:
+            bulk(self.es, actions, chunk_size=self.chunk_size)
+        except BulkIndexError as bie:
+             # in certain cases where we're really out of sync, we update a
+             # stat when the torrent doc is, causing a "document missing"
+             # error from es, with no way to suppress that server-side.
+             # Thus ignore that type of error if it's the only problem.
+             # Likewise deletes of deleted torrents, which happen when a
+             # restart redoes the last batches.
+            for e in bie.errors:
+                try:
+                    if 'delete' in e:
+                        if e['delete']['status'] != 404:
+                            raise bie
+                    elif e['update']['error']['type'] != 'document_missing_exception':
+                        raise bie
+                except KeyError:
+                    raise bie
+
+def save_pos(save_loc, log_file, log_pos, synced_time):
+    # the site may be reading it, so replace it whole
+    with open(save_loc + '.tmp', 'w') as f:
+        json.dump({"log_file": log_file, "log_pos": log_pos,
+                   "synced_time": synced_time}, f)
+    os.replace(save_loc + '.tmp', save_loc)
+
+class ActionCoalescer:
+    """
+    Merges the actions of one bulk post per document, so a torrent whose stats
+    changed a dozen times in a flush window is only updated once. Actions on a
+    document are merged in binlog order:
+    - a delete supersedes everything before it,
+    - partial doc updates merge into the update before them, later values
+      winning, so an upsert (the torrent row) absorbs the stats updates after it.
+    An update after a delete, or an upsert after a plain update, is kept as a
+    separate action: the document may not exist before it, and merging would
+    change what ends up in es.
+    """
+    def __init__(self):
+        # (index, id) -> actions on that document, in order
+        self.docs = OrderedDict()
+        self.received = 0
+
+    def add(self, action):
+        self.received += 1
+        key = (action['_index'], action['_id'])
+        doc_actions = self.docs.setdefault(key, [])
+        if action['_op_type'] == 'delete':
+            doc_actions[:] = [action]
+        elif (doc_actions and doc_actions[-1]['_op_type'] == 'update' and
+                (doc_actions[-1].get('doc_as_upsert') or not action.get('doc_as_upsert'))):
+            last = doc_actions[-1]
+            doc_actions[-1] = dict(last, doc=dict(last['doc'], **action['doc']))
+        else:
+            doc_actions.append(action)
+
+    def actions(self):
+        return [action for doc_actions in self.docs.values() for action in doc_actions]
+
+
+class Batch:
+    # one bulk post; pos is that of the last event it completes, if any
+    def __init__(self, pos):
+        self.pos = pos
+        self.posted = False
+
+class SyncEngine:
+    """
+    Moves actions from a source to es. The source is iterated in a thread
+    (the binlog reader blocks) into a bounded queue, so reading stalls when
+    es falls queue_depth actions behind. Batches are cut every chunk_size
+    actions or flush_interval seconds, coalesced, and posted by post_bulk in
+    up to max_in_flight threads at once.
+
+    Batches may finish out of order, so:
+    - actions on documents that batches before are still posting are posted
+      after those batches,
+    - the position passed to save_pos only moves past a batch once it and every
+      batch before it are posted. After a crash, at most the batches that were
+      in flight are redone.
+    """
+    def __init__(self, source, post_bulk, save_pos, chunk_size=10000, flush_interval=5,
+                 queue_depth=10000, max_in_flight=2, save_interval=10, save_every=10000,
+                 pos=None):
+        self.source = source
+        self.post_bulk = post_bulk
+        self.save_pos = save_pos
         self.chunk_size = chunk_size
         self.flush_interval = flush_interval
+        self.queue_depth = queue_depth
+        self.max_in_flight = max_in_flight
+        self.save_interval = save_interval
+        self.save_every = save_every
+        # (log_file, log_pos, synced_time) the source starts at, if known
+        self.pos = pos
 
-    def run_happy(self):
-        es = Elasticsearch(hosts=app.config['ES_HOSTS'], timeout=30)
+    def run(self):
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        # bounds the queue from the reader's side, so the reader blocks without
+        # a round trip through the loop for every action
+        self.free_slots = threading.Semaphore(self.queue_depth)
+        self.stopping = threading.Event()
+        # the reader thread is left blocking on the binlog when we exit
+        reader_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='binlog')
+        reader = loop.run_in_executor(reader_executor, self.read_source, loop, queue)
+        bulk_executor = ThreadPoolExecutor(max_workers=self.max_in_flight,
+                                           thread_name_prefix='bulk')
+        # batches being posted, and their bulk posts
+        self.in_flight = set()
+        self.posts = set()
+        try:
+            await self.post_batches(loop, queue, reader, bulk_executor)
+        finally:
+            # after a failure, don't start the bulks still waiting
+            pending = self.in_flight | self.posts
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            # a reader waiting for the queue stops, one blocking on the binlog doesn't
+            self.stopping.set()
+            self.free_slots.release()
+            reader.cancel()
+            reader_executor.shutdown(wait=False)
+            # bulks already running in threads can't be cancelled. wait for them, so they
+            # don't finish into a closed loop
+            await loop.run_in_executor(None, bulk_executor.shutdown)
+
+    def read_source(self, loop, queue):
+        # runs in a thread, blocking while the queue is full
+        for item in self.source:
+            self.free_slots.acquire()
+            if self.stopping.is_set():
+                return
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        # done, for sources that end
+        loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    async def next_batch(self, queue, reader):
+        # -> (coalescer, pos of the last complete event, whether the source ended)
+        coalescer = ActionCoalescer()
+        batch_pos = None
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        # wait up to flush_interval seconds after starting the batch
+        deadline = now + self.flush_interval
+        while coalescer.received < self.chunk_size and now < deadline:
+            if reader.done() and queue.empty():
+                # a crashed reader won't put anything anymore
+                reader.result()
+            try:
+                item = await asyncio.wait_for(queue.get(), min(deadline - now, 1))
+            except asyncio.TimeoutError:
+                now = loop.time()
+                continue
+            if item is None:
+                return coalescer, batch_pos, True
+            self.free_slots.release()
+            (event_pos, action) = item
+            coalescer.add(action)
+            if event_pos is not None:
+                batch_pos = event_pos
+            now = loop.time()
+        return coalescer, batch_pos, False
+
+    async def post(self, loop, executor, actions, earlier=()):
+        if earlier:
+            # earlier bulks with the same documents go first
+            await asyncio.wait(earlier)
+            for task in earlier:
+                # don't post over a bulk that failed
+                task.result()
+        with stats.timer('post_bulk'):
+            await loop.run_in_executor(executor, self.post_bulk, actions)
+
+    async def finish_batch(self, batch, posts, slots):
+        try:
+            await asyncio.gather(*posts)
+            batch.posted = True
+        finally:
+            slots.release()
+
+    async def post_batches(self, loop, queue, reader, executor):
+        slots = asyncio.Semaphore(self.max_in_flight)
+        # batches not yet saved past, in order
+        unsaved = deque()
+        # the last bulk post touching each document
+        in_flight = self.in_flight
+        last_posting = {}
 
         last_save = time.time()
         since_last = 0
-        # XXX keep track of last posted position for save points, awkward
-        posted_log_file = None
-        posted_log_pos = None
-
-        while True:
-            actions = []
-            now = time.time()
-            # wait up to flush_interval seconds after starting the batch
-            deadline = now + self.flush_interval
-            while len(actions) < self.chunk_size and now < deadline:
-                timeout = deadline - now
-                try:
-                    # grab next event from queue with metadata that creepily
-                    # updates, surviving outside the scope of the loop
-                    ((log_file, log_pos, timestamp), action) = \
-                            self.read_buf.get(block=True, timeout=timeout)
-                    actions.append(action)
-                    now = time.time()
-                except Empty:
-                    # nothing new for the whole interval
-                    break
-
+        # the last saved position, and the time up to which all changes are in es.
+        # the site reads synced_time from the save file to tell how far behind es is.
+        saved_pos = self.pos
+        synced_time = self.pos[2] if self.pos else None
+
+        ended = False
+        while not ended:
+            batch_start = time.time()
+            coalescer, batch_pos, ended = await self.next_batch(queue, reader)
+            stats.gauge('queue_depth', queue.qsize())
+
+            actions = coalescer.actions()
             if actions:
                 # XXX "time" to get histogram of no events per bulk
                 stats.timing('actions_per_bulk', len(actions))
-
-                try:
-                    with stats.timer('post_bulk'):
-                        bulk(es, actions, chunk_size=self.chunk_size)
-                except BulkIndexError as bie:
-                     # in certain cases where we're really out of sync, we update a
-                     # stat when the torrent doc is, causing a "document missing"
-                     # error from es, with no way to suppress that server-side.
-                     # Thus ignore that type of error if it's the only problem
-                    for e in bie.errors:
-                        try:
-                            if e['update']['error']['type'] != 'document_missing_exception':
-                                raise bie
-                        except KeyError:
-                            raise bie
-
-                # how far we've gotten in the actual log
-                posted_log_file = log_file
-                posted_log_pos = log_pos
-
-                # how far we're behind, wall clock
-                stats.gauge('process_latency', int((time.time() - timestamp) * 1000))
-            else:
+                with stats.pipeline() as s:
+                    s.incr('actions_received', coalescer.received)
+                    s.incr('actions_posted', len(actions))
+                    # received per posted, >= 1
+                    s.gauge('coalesce_ratio', round(coalescer.received / len(actions), 3))
+
+                # blocks reading the queue while max_in_flight batches are posting
+                await slots.acquire()
+                # actions on documents that earlier bulks are still posting go in
+                # a second bulk after those, the rest right away
+                ready, after, earlier = [], [], set()
+                for action in actions:
+                    posting = last_posting.get((action['_index'], action['_id']))
+                    if posting is not None and not posting.done():
+                        after.append(action)
+                        earlier.add(posting)
+                    else:
+                        ready.append(action)
+
+                posts = []
+                for bulk_actions, bulk_earlier in ((ready, ()), (after, earlier)):
+                    if not bulk_actions:
+                        continue
+                    post = asyncio.ensure_future(
+                        self.post(loop, executor, bulk_actions, bulk_earlier))
+                    posts.append(post)
+                    self.posts.add(post)
+                    post.add_done_callback(self.posts.discard)
+                    for action in bulk_actions:
+                        last_posting[(action['_index'], action['_id'])] = post
+
+                batch = Batch(batch_pos)
+                in_flight.add(asyncio.ensure_future(self.finish_batch(batch, posts, slots)))
+                unsaved.append(batch)
+            stats.gauge('bulks_in_flight', len(in_flight))
+
+            if ended:
+                # post the rest and save
+                await asyncio.gather(*in_flight)
+
+            for task in [task for task in in_flight if task.done()]:
+                # any es error is fatal, like a dying reader
+                task.result()
+                in_flight.discard(task)
+            if not in_flight:
+                last_posting.clear()
+            elif len(last_posting) > 2 * self.chunk_size * self.max_in_flight:
+                last_posting = {key: post for key, post in last_posting.items()
+                                if not post.done()}
+
+            # how far we've gotten in the actual log
+            while unsaved and unsaved[0].posted:
+                batch = unsaved.popleft()
+                if batch.pos is not None:
+                    saved_pos = batch.pos
+                    synced_time = batch.pos[2]
+                    # how far we're behind, wall clock
+                    stats.gauge('process_latency', int((time.time() - synced_time) * 1000))
+            if not actions and not unsaved and not in_flight:
                 log.debug("no changes...")
-
-            since_last += len(actions)
-            # TODO instead of this manual timeout loop, could move this to another queue/thread
-            if posted_log_file is not None and (since_last >= 10000 or (time.time() - last_save) > 10):
-                log.info(f"saving position {log_file}/{log_pos}, {time.time() - timestamp:,.3f} seconds behind")
-                with stats.timer('save_pos'):
-                    with open(SAVE_LOC, 'w') as f:
-                        json.dump({"log_file": posted_log_file, "log_pos": posted_log_pos}, f)
+                # nothing came in for the whole interval, so we're caught up
+                # with everything that happened before it started
+                synced_time = batch_start
+
+            since_last += coalescer.received
+            # (saved when idle too, to keep synced_time current)
+            if ended or since_last >= self.save_every or \
+                    (time.time() - last_save) > self.save_interval:
+                if saved_pos is not None and synced_time is not None:
+                    log.info(f"saving position {saved_pos[0]}/{saved_pos[1]}, "
+                             f"{time.time() - synced_time:,.3f} seconds behind")
+                    with stats.timer('save_pos'):
+                        self.save_pos(saved_pos[0], saved_pos[1], synced_time)
                 last_save = time.time()
                 since_last = 0
-                posted_log_file = None
-                posted_log_pos = None
-
-# in-memory queue between binlog and es. The bigger it is, the more events we
-# can parse in memory while waiting for es to catch up, at the expense of heap.
-buf = Queue(maxsize=INTERNAL_QUEUE_DEPTH)
-
-reader = BinlogReader(buf)
-reader.daemon = True
-writer = EsPoster(buf, chunk_size=ES_CHUNK_SIZE, flush_interval=FLUSH_INTERVAL)
-writer.daemon = True
-reader.start()
-writer.start()
-
-# on the main thread, poll the queue size for monitoring
-while True:
-    stats.gauge('queue_depth', buf.qsize())
-    time.sleep(1)
+
+def main():
+    # config in json, 2lazy to argparse
+    if len(sys.argv) != 2:
+        print("need config.json location", file=sys.stderr)
+        sys.exit(-1)
+    with open(sys.argv[1]) as f:
+        config = json.load(f)
+
+    # in prod want in /var/lib somewhere probably
+    save_loc = config.get('save_loc', "/tmp/pos.json")
+    with open(save_loc) as f:
+        pos = json.load(f)
+
+    app = create_app('config')
+    es = Elasticsearch(hosts=app.config['ES_HOSTS'], timeout=30)
+    es_chunk_size = config.get('es_chunk_size', 10000)
+
+    if config.get('replay_file'):
+        # events recorded with record_file, instead of the binlog
+        source = ReplaySource(config['replay_file'], pos['log_file'], pos['log_pos'])
+    else:
+        record = open(config['record_file'], 'a', buffering=1) \
+            if config.get('record_file') else None
+        source = BinlogReader(config, pos['log_file'], pos['log_pos'], record=record)
+
+    engine = SyncEngine(
+        source,
+        post_bulk=EsSink(es, es_chunk_size),
+        save_pos=lambda log_file, log_pos, synced_time: save_pos(
+            save_loc, log_file, log_pos, synced_time),
+        chunk_size=es_chunk_size,
+        # seconds since no events happening to flush to es. remember this also
+        # interacts with es' refresh_interval setting.
+        flush_interval=config.get('flush_interval', 5),
+        # actions read ahead of es. The bigger it is, the more events we can
+        # parse in memory while waiting for es to catch up, at the expense of heap.
+        queue_depth=config.get('internal_queue_depth', 10000),
+        max_in_flight=config.get('max_in_flight_bulks', 2),
+        save_interval=config.get('save_interval', 10),
+        save_every=config.get('save_every', 10000),
+        pos=(pos['log_file'], pos['log_pos'], pos.get('synced_time')))
+
+    # we could try to make this script robust to errors from es or mysql, but since
+    # the only thing we can do is "clear state and retry", it's easier to leave
+    # this to the supervisor. If we we carrying around heavier state in-process,
+    # it'd be more worth it to handle errors ourselves.
+    status = 1
+    try:
+        engine.run()
+        # only replays end
+        status = 0
+    except Exception:
+        log.exception("something happened")
+    finally:
+        # the binlog thread blocks forever and would keep us alive
+        os._exit(status)
+
+if __name__ == '__main__':
+    main()
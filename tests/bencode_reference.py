@@ -0,0 +1,134 @@
+""" The original bencode implementations, which nyaa.bencode replaced with faster ones.
+    Kept as references for tests/test_bencode.py and utils/bencode_bench.py. """
+from io import BytesIO
+
+from nyaa import bencode
+
+
+def stream_decode(file_object, decode_keys_as_utf8=True):
+    """ Decodes a bencoded value from a file object one byte at a time """
+    if isinstance(file_object, str):
+        file_object = file_object.encode('utf8')
+    if isinstance(file_object, bytes):
+        file_object = BytesIO(file_object)
+
+    def create_ex(msg):
+        return bencode.MalformedBencodeException(
+            '{0} at position {1} (0x{1:02X} hex)'.format(msg, file_object.tell()))
+
+    def _read_list():
+        """ Decodes values from stream until a None is returned ('e') """
+        items = []
+        while True:
+            value = stream_decode(file_object, decode_keys_as_utf8=decode_keys_as_utf8)
+            if value is None:
+                break
+            items.append(value)
+        return items
+
+    kind = file_object.read(1)
+    if not kind:
+        raise create_ex('EOF, expecting kind')
+
+    if kind == bencode._B_INT:  # Integer
+        int_bytes = b''
+        while True:
+            c = file_object.read(1)
+            if not c:
+                raise create_ex('EOF, expecting more integer')
+            elif c == bencode._B_END:
+                try:
+                    return int(int_bytes.decode('utf8'))
+                except Exception:
+                    raise create_ex('Unable to parse int')
+
+            # not a digit OR '-' in the middle of the int
+            if (c not in bencode._DIGITS + b'-') or (c == b'-' and int_bytes):
+                raise create_ex('Unexpected input while reading an integer: ' + repr(c))
+            else:
+                int_bytes += c
+
+    elif kind == bencode._B_LIST:  # List
+        return _read_list()
+
+    elif kind == bencode._B_DICT:  # Dictionary
+        keys_and_values = _read_list()
+        if len(keys_and_values) % 2 != 0:
+            raise bencode.MalformedBencodeException('Uneven amount of key/value pairs')
+
+        # "Technically" the bencode dictionary keys are bytestrings,
+        # but real-world they're always(?) UTF-8.
+        decoded_dict = dict((decode_keys_as_utf8 and k.decode('utf8') or k, v)
+                            for k, v in bencode._pairwise(keys_and_values))
+        return decoded_dict
+
+    # List/dict end, but make sure input is not just 'e'
+    elif kind == bencode._B_END and file_object.tell() > 0:
+        return None
+
+    elif kind in bencode._DIGITS:  # Bytestring
+        str_len_bytes = kind  # keep first digit
+        # Read string length until a ':'
+        while True:
+            c = file_object.read(1)
+            if not c:
+                raise create_ex('EOF, expecting more string len')
+            if c in bencode._DIGITS:
+                str_len_bytes += c
+            elif c == b':':
+                break
+            else:
+                raise create_ex('Unexpected input while reading string length: ' + repr(c))
+        try:
+            str_len = int(str_len_bytes.decode())
+        except Exception:
+            raise create_ex('Unable to parse bytestring length')
+
+        bytestring = file_object.read(str_len)
+        if len(bytestring) != str_len:
+            raise create_ex('Read only {} bytes, {} wanted'.format(len(bytestring), str_len))
+
+        return bytestring
+    else:
+        raise create_ex('Unexpected data type ({})'.format(repr(kind)))
+
+
+# Encoding by joining nested bytes objects per list/dict level
+
+def _join_int(value):
+    """ Encode an integer, eg 64 -> i64e """
+    return bencode._B_INT + str(value).encode('utf8') + bencode._B_END
+
+
+def _join_bytes(value):
+    """ Encode a bytestring (strings as UTF-8), eg 'hello' -> 5:hello """
+    if isinstance(value, str):
+        value = value.encode('utf8')
+    return str(len(value)).encode('utf8') + b':' + value
+
+
+def _join_list(value):
+    """ Encode a list, eg [64, "hello"] -> li64e5:helloe """
+    return bencode._B_LIST + b''.join(join_encode(item) for item in value) + bencode._B_END
+
+
+def _join_dict(value):
+    """ Encode a dict, which is keys and values interleaved as a list,
+        eg {"hello":123}-> d5:helloi123ee """
+    dict_keys = sorted(value.keys())  # Sort keys as per spec
+    return bencode._B_DICT + b''.join(
+        _join_bytes(key) + join_encode(value[key]) for key in dict_keys) + bencode._B_END
+
+
+def join_encode(value):
+    """ Bencode any supported value (int, bytes, str, list, dict) """
+    if isinstance(value, int):
+        return _join_int(value)
+    elif isinstance(value, (str, bytes)):
+        return _join_bytes(value)
+    elif isinstance(value, list):
+        return _join_list(value)
+    elif isinstance(value, dict):
+        return _join_dict(value)
+
+    raise bencode.BencodeException('Unsupported type ' + str(type(value)))
@@ -1,6 +1,9 @@
+import re
 import unittest
+from io import BytesIO
 
 from nyaa import bencode
+from tests import bencode_reference
 
 
 class TestBencode(unittest.TestCase):
@@ -50,6 +53,23 @@ class TestBencode(unittest.TestCase):
         for raw, expected_result in test_cases:
             self.assertEqual(bencode.encode(raw), expected_result)
 
+    def test_encode_into(self):
+        value = {'numbers': [1, -2], 'hello': 'world', 'view': memoryview(b'abc'),
+                 'bytes': bytearray(b'de')}
+        expected_result = b'd5:bytes2:de5:hello5:world7:numbersli1ei-2ee4:view3:abce'
+
+        out = bytearray(b'prefix')
+        self.assertIs(bencode.encode_into(value, out), out)
+        self.assertEqual(out, b'prefix' + expected_result)
+
+        out = BytesIO()
+        bencode.encode_into(value, out)
+        self.assertEqual(out.getvalue(), expected_result)
+
+        self.assertEqual(bencode.encode(value), expected_result)
+        self.assertRaisesRegexp(bencode.BencodeException, r'Unsupported type',
+                                bencode.encode_into, [1.6], bytearray())
+
     def test_decode(self):
         exception_test_cases = [  # (raw, raised_exception, expected_result_regexp)
             # test malformed bencode
@@ -89,6 +109,111 @@ class TestBencode(unittest.TestCase):
         for raw, expected_result in test_cases:
             self.assertEqual(bencode.decode(raw), expected_result)
 
+    def test_decode_buffer_types(self):
+        raw = b'd5:hello5:world7:numbersli1ei2eee'
+        expected_result = {'hello': b'world', 'numbers': [1, 2]}
+
+        self.assertEqual(bencode.decode(bytearray(raw)), expected_result)
+        self.assertEqual(bencode.decode(memoryview(raw)), expected_result)
+        self.assertEqual(bencode.decode(BytesIO(raw)), expected_result)
+
+        self.assertRaisesRegexp(bencode.MalformedBencodeException,
+                                r'Dictionary key is not a bytestring',
+                                bencode.decode, b'di1ei2ee')
+
+        # Deep nesting doesn't recurse
+        self.assertEqual(len(bencode.decode(b'l' * 5000 + b'e' * 5000)), 1)
+
+    def test_decode_matches_stream_decoder(self):
+        test_cases = [
+            b'l4:hey', b'ie', b'i-e', b'i64', b'', b'i6-4', b'i--4e', b'4#string', b'4',
+            b'12', b'$:string', b'li1e$e', b'd5:world7:numbersli1ei2eee', b'd3:key',
+            b'i-0e', b'i007e', b'007:bencode', b'e', b'le', b'i1e4:trailing',
+            b'd4:infod6:lengthi5e4:name4:test12:piece lengthi16384e6:pieces3:abcee'
+        ]
+
+        for raw in test_cases:
+            try:
+                expected_result = bencode_reference.stream_decode(raw)
+            except bencode.MalformedBencodeException as e:
+                self.assertRaisesRegexp(bencode.MalformedBencodeException,
+                                        '^' + re.escape(str(e)) + '$',
+                                        bencode.decode, raw)
+            else:
+                self.assertEqual(bencode.decode(raw), expected_result)
+
+    def test_decode_with_span(self):
+        info = b'd6:lengthi5e4:name4:test12:piece lengthi16384e6:pieces3:abce'
+        raw = b'd8:announce3:foo4:info' + info + b'3:zzzi1ee'
+
+        value, span = bencode.decode_with_span(raw, 'info')
+        self.assertEqual(value, bencode.decode(raw))
+        self.assertEqual(raw[span[0]:span[1]], info)
+        self.assertEqual(bencode.encode(value['info']), info)
+        self.assertTrue(span[2])
+
+        # Only the top-level key counts
+        self.assertEqual(bencode.decode_with_span(b'd1:ad4:infoi1eee', 'info')[1], None)
+        self.assertEqual(bencode.decode_with_span(b'l4:infoi1ee', 'info')[1], None)
+        # Keys outside of the span don't affect it
+        self.assertTrue(bencode.decode_with_span(b'd4:infoi1e1:ai1ee', 'info')[1][2])
+
+        noncanonical_test_cases = [
+            b'd4:infod4:name1:a6:lengthi5eee',  # unsorted keys
+            b'd4:infod4:name1:a4:name1:bee',  # duplicate keys
+            b'd4:infod6:lengthi05eee',  # leading zero
+            b'd4:infod6:lengthi-0eee',  # negative zero
+            b'd4:infod4:name01:aee',  # leading zero in string length
+        ]
+
+        for raw in noncanonical_test_cases:
+            value, span = bencode.decode_with_span(raw, 'info')
+            self.assertFalse(span[2])
+            self.assertNotEqual(raw[span[0]:span[1]], bencode.encode(value['info']))
+
+    def test_decode_lazy(self):
+        raw = b'd4:infod4:name1:a6:pieces6:abcdefe12:piece layersd1:xl1:ai1eeee'
+
+        value = bencode.decode(raw, view_threshold=5)
+        self.assertIsInstance(value['info']['pieces'], memoryview)
+        self.assertEqual(value['info']['pieces'], b'abcdef')
+        self.assertIsInstance(value['info']['name'], bytes)
+        self.assertEqual(bencode.decode(raw), value)
+
+        value, span = bencode.decode_with_span(raw, 'info', view_threshold=5)
+        self.assertEqual(raw[span[0]:span[1]], bencode.encode(value['info']))
+
+        exception_test_cases = [  # (raw, expected_result_regexp)
+            (b'd1:al4:hey', r'Read only 3 bytes, 4 wanted'),
+            (b'd1:ali6-4ee', r'Unexpected input while reading an integer'),
+            (b'd1:al4#stringe', r'Unexpected input while reading string length'),
+            (b'd1:ali1ee', r'EOF, expecting kind'),
+            (b'd1:al$e', r'Unexpected data type'),
+        ]
+
+        for raw, expected_result_regexp in exception_test_cases:
+            self.assertRaisesRegexp(bencode.MalformedBencodeException, expected_result_regexp,
+                                    bencode.decode, raw, view_threshold=1)
+
+    def test_split_dict(self):
+        raw = b'd8:announce3:foo13:announce-listll3:fooel3:baree8:url-listli1ed1:a1:beee'
+        expected_result = {'announce': b'3:foo', 'announce-list': b'll3:fooel3:baree',
+                           'url-list': b'li1ed1:a1:bee'}
+        self.assertEqual(bencode.split_dict(raw), expected_result)
+        self.assertEqual(bencode.split_dict(b'de'), {})
+
+        exception_test_cases = [  # (raw, expected_result_regexp)
+            (b'l1:ae', r'Not a dictionary'),
+            (b'di1ei2ee', r'Dictionary key is not a bytestring'),
+            (b'd1:a', r'EOF, expecting kind'),
+            (b'd1:ai1e', r'EOF, expecting kind'),
+            (b'd1:a4:hey', r'Read only 3 bytes, 4 wanted'),
+        ]
+
+        for raw, expected_result_regexp in exception_test_cases:
+            self.assertRaisesRegexp(bencode.MalformedBencodeException, expected_result_regexp,
+                                    bencode.split_dict, raw)
+
 
 if __name__ == '__main__':
     unittest.main()
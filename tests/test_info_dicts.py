@@ -0,0 +1,132 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from nyaa import info_dicts
+
+
+def _make_info_dicts(count):
+    info_dicts = []
+    for i in range(count):
+        data = b'd6:lengthi%de4:name10:file%06de' % (i, i)
+        info_dicts.append((hashlib.sha1(data).digest(), data))
+    return info_dicts
+
+
+class TestInfoDicts(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_file_store(self):
+        store = info_dicts.FileInfoDictStore(self.directory)
+        (info_hash, data), (other_hash, _) = _make_info_dicts(2)
+
+        store.put(info_hash, data)
+        self.assertEqual(store.get(info_hash), data)
+        self.assertIn(info_hash, store)
+        self.assertIsNone(store.get(other_hash))
+        self.assertEqual(list(store.iter_hashes()), [info_hash])
+
+        hex_hash = info_hash.hex()
+        self.assertEqual(store.path(info_hash),
+                         os.path.join(self.directory, hex_hash[:2], hex_hash[2:4], hex_hash))
+        self.assertIsNone(store.path(other_hash))
+
+        store.delete(info_hash)
+        self.assertNotIn(info_hash, store)
+        store.delete(info_hash)
+
+    def test_packed_store(self):
+        items = _make_info_dicts(100)
+        for compression in (None, 'zlib'):
+            directory = os.path.join(self.directory, str(compression))
+            store = info_dicts.PackedInfoDictStore(directory, compression, max_pack_size=500)
+
+            store.put_many(items[:50])
+            for info_hash, data in items:
+                store.put(info_hash, data)
+            self.assertIsNone(store.path(items[0][0]))
+
+            for info_hash, data in items:
+                self.assertEqual(store.get(info_hash), data)
+            self.assertEqual(list(store.iter_hashes()), sorted(h for h, _ in items))
+            # Small packs were rolled over
+            self.assertGreater(len([name for name in os.listdir(directory)
+                                    if name.startswith('pack.')]), 1)
+
+            for info_hash, _ in items[::2]:
+                store.delete(info_hash)
+            self.assertNotIn(items[0][0], store)
+            self.assertIsNone(store.get(items[0][0]))
+
+            # Another process sees the same state
+            other_store = info_dicts.PackedInfoDictStore(directory, compression)
+            self.assertIsNone(other_store.get(items[0][0]))
+            self.assertEqual(other_store.get(items[1][0]), items[1][1])
+
+            count, old_size, new_size = store.compact()
+            self.assertEqual(count, 50)
+            self.assertLess(new_size, old_size)
+
+            # Compaction is picked up by other processes
+            for i, (info_hash, data) in enumerate(items):
+                self.assertEqual(other_store.get(info_hash), None if i % 2 == 0 else data)
+
+            # Written after compaction, then compacted again with some added
+            store.put(items[0][0], items[0][1])
+            self.assertEqual(other_store.get(items[0][0]), items[0][1])
+            count, _, _ = store.compact(added=sorted(items[:10]))
+            self.assertEqual(count, 55)
+            for info_hash, data in items[:10]:
+                self.assertEqual(other_store.get(info_hash), data)
+
+            store.close()
+            other_store.close()
+
+    def test_packed_store_partial_journal(self):
+        store = info_dicts.PackedInfoDictStore(self.directory)
+        (info_hash, data), (other_hash, other_data) = _make_info_dicts(2)
+        store.put(info_hash, data)
+
+        # A crashed writer left half a record behind
+        with open(os.path.join(self.directory, 'journal.0'), 'ab') as out_file:
+            out_file.write(b'\0' * 10)
+
+        other_store = info_dicts.PackedInfoDictStore(self.directory)
+        self.assertEqual(other_store.get(info_hash), data)
+        other_store.put(other_hash, other_data)
+        self.assertEqual(store.get(other_hash), other_data)
+
+    def test_packed_store_compacted_while_reading(self):
+        items = _make_info_dicts(20)
+        store = info_dicts.PackedInfoDictStore(self.directory, max_pack_size=200)
+        store.put_many(items)
+        other_store = info_dicts.PackedInfoDictStore(self.directory)
+        self.assertEqual(other_store.get(items[0][0]), items[0][1])
+
+        # Compacted between other_store finding an entry and opening its pack
+        real_find = other_store._find
+
+        def find_then_compact(info_hash):
+            del other_store._find
+            entry = real_find(info_hash)
+            store.compact()
+            return entry
+
+        other_store._find = find_then_compact
+        self.assertEqual(other_store.get(items[-1][0]), items[-1][1])
+        self.assertEqual(other_store.get(items[-2][0]), items[-2][1])
+
+        # Noticed by the generation in CURRENT, not its inode (which can be reused)
+        store.compact()
+        self.assertEqual(other_store.get(items[0][0]), items[0][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+import sqlalchemy
+
+from nyaa import models, search
+from nyaa.extensions import db
+from tests import NyaaTestCase
+
+
+class TestSearch(NyaaTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSearch, cls).setUpClass()
+        cls.app_context.app.config['COUNT_CACHE_DURATION'] = 30
+        cls.app_context.app.config['COUNT_CACHE_BACKEND'] = 'local'
+
+    def setUp(self):
+        search._count_cache = None
+
+    def test_baked_count_cache(self):
+        count_query = search.bakery(lambda session: session.query(
+            sqlalchemy.func.count(models.Torrent.id)))
+        count_query += lambda q: q.filter(
+            models.Torrent.uploader_id == sqlalchemy.bindparam('user'))
+
+        with self.app_context:
+            session = db.session()
+            key = search._count_query_key(count_query(session).params(user=1))
+            self.assertEqual(key, search._count_query_key(count_query(session).params(user=1)))
+            self.assertNotEqual(key,
+                                search._count_query_key(count_query(session).params(user=2)))
+
+            # Served from the cache as baked_paginate asks for it, without querying
+            search.get_count_cache().put(key, 42)
+            self.assertEqual(search.cached_count(count_query(session).params(user=1)), 42)
+            db.session.remove()
+
+
+if __name__ == '__main__':
+    unittest.main()
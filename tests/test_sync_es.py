@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import bench_sync_es
+import sync_es
+
+
+def _update(torrent_id, doc, upsert=False):
+    action = {'_op_type': 'update', '_index': 'nyaa', '_id': str(torrent_id), 'doc': doc}
+    if upsert:
+        action['doc_as_upsert'] = True
+    return action
+
+
+def _delete(torrent_id):
+    return {'_op_type': 'delete', '_index': 'nyaa', '_id': str(torrent_id)}
+
+
+class TestActionCoalescer(unittest.TestCase):
+
+    def coalesce(self, *actions):
+        coalescer = sync_es.ActionCoalescer()
+        for action in actions:
+            coalescer.add(action)
+        self.assertEqual(coalescer.received, len(actions))
+        return coalescer.actions()
+
+    def test_upsert_absorbs_stats(self):
+        self.assertEqual(
+            self.coalesce(_update(1, {'display_name': 'a'}, upsert=True),
+                          _update(2, {'seed_count': 1}),
+                          _update(1, {'seed_count': 1}),
+                          _update(1, {'seed_count': 2})),
+            [_update(1, {'display_name': 'a', 'seed_count': 2}, upsert=True),
+             _update(2, {'seed_count': 1})])
+
+    def test_delete_supersedes(self):
+        self.assertEqual(
+            self.coalesce(_update(1, {'display_name': 'a'}, upsert=True),
+                          _update(1, {'seed_count': 1}),
+                          _delete(1),
+                          _update(1, {'seed_count': 2})),
+            [_delete(1), _update(1, {'seed_count': 2})])
+
+    def test_upsert_after_update_kept(self):
+        # The update fails on a missing document, which the upsert would then create
+        actions = (_update(1, {'seed_count': 1}), _update(1, {'display_name': 'a'}, upsert=True))
+        self.assertEqual(self.coalesce(*actions), list(actions))
+
+
+class TestSyncEngine(unittest.TestCase):
+
+    def setUp(self):
+        sync_es.log.setLevel('WARNING')
+        self.directory = tempfile.mkdtemp()
+        self.recording = os.path.join(self.directory, 'events.jsonl')
+        bench_sync_es.write_churn_recording(self.recording, 300)
+        self.options = {'chunk_size': 200, 'es_chunk_size': 50, 'flush_interval': 0.05,
+                        'max_in_flight': 4, 'save_interval': 0.05, 'save_every': 200}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_replay_resumes_after_position(self):
+        events = list(sync_es.ReplaySource(self.recording))
+        positions = [pos for pos, _ in events if pos is not None]
+        self.assertIsNotNone(events[-1][0])
+        self.assertEqual(positions, sorted(positions))
+
+        log_file, log_pos, _ = positions[len(positions) // 2]
+        resumed = list(sync_es.ReplaySource(self.recording, log_file, log_pos))
+        self.assertEqual(resumed, events[-len(resumed):])
+        self.assertIsNotNone(events[-len(resumed) - 1][0])
+
+    def test_sync(self):
+        es = bench_sync_es.FakeElasticsearch()
+        saves = []
+        bench_sync_es.run_engine(
+            sync_es.ReplaySource(self.recording), es,
+            lambda log_file, log_pos, synced_time: saves.append((log_file, log_pos)),
+            **self.options)
+
+        expected = {}
+        for _, action in sync_es.ReplaySource(self.recording):
+            key = (action['_index'], action['_id'])
+            if action['_op_type'] == 'delete':
+                del expected[key]
+            elif key in expected or action.get('doc_as_upsert'):
+                expected[key] = dict(expected.get(key, {}), **action['doc'])
+
+        self.assertEqual(es.docs.keys(), expected.keys())
+        for key, doc in expected.items():
+            self.assertEqual(es.docs[key]['seed_count'], doc['seed_count'])
+            self.assertEqual(es.docs[key]['display_name'], doc['display_name'])
+
+        self.assertEqual(saves, sorted(saves))
+        last_pos = [pos for pos, _ in sync_es.ReplaySource(self.recording) if pos][-1]
+        self.assertEqual(saves[-1], last_pos[:2])
+
+    def test_crash_restart(self):
+        expected = bench_sync_es.FakeElasticsearch()
+        bench_sync_es.run_engine(sync_es.ReplaySource(self.recording), expected,
+                                 **self.options)
+
+        docs, restarts, _, in_order = bench_sync_es.crash_restart(
+            self.recording, crashes=3, **self.options)
+        self.assertEqual(restarts, 3)
+        self.assertTrue(in_order)
+        self.assertEqual(docs, expected.docs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+from nyaa import bencode, torrents
+
+
+class _Torrent(object):
+    encoding = 'utf-8'
+
+
+class TestTorrents(unittest.TestCase):
+
+    def test_torrent_file_cache(self):
+        cache = torrents.TorrentFileCache()
+
+        cache.put(1, 'v1', bytearray(b'a' * 10), 'etag1', max_size=25)
+        cache.put(2, 'v1', b'b' * 10, 'etag2', max_size=25)
+        self.assertEqual(cache.get(1, 'v1'), (b'a' * 10, 'etag1'))
+        self.assertIsInstance(cache.get(1, 'v1')[0], bytes)
+
+        # Evicts the least recently used entry (2, since 1 was just used)
+        cache.put(3, 'v1', b'c' * 10, 'etag3', max_size=25)
+        self.assertIsNone(cache.get(2, 'v1'))
+        self.assertEqual(cache.size, 20)
+
+        # Outdated versions are dropped
+        self.assertIsNone(cache.get(1, 'v2'))
+        self.assertIsNone(cache.get(1, 'v1'))
+        self.assertEqual(cache.size, 10)
+
+        # Too large to cache at all
+        cache.put(3, 'v2', b'c' * 30, 'etag3', max_size=25)
+        self.assertIsNone(cache.get(3, 'v2'))
+        self.assertEqual(cache.size, 0)
+
+        cache.put(4, 'v1', b'd', 'etag4', max_size=25)
+        cache.invalidate(4)
+        self.assertIsNone(cache.get(4, 'v1'))
+        self.assertEqual(cache.size, 0)
+
+    def test_create_bencoded_torrent_with_payload(self):
+        bencoded_info = bencode.encode({'name': 'test', 'length': 5})
+        trackers = ['http://a.example/announce', 'udp://b.example:1337']
+        webseeds = ['https://c.example/files/']
+        metadata_base = {'comment': 'https://nyaa.si/view/1', 'creation date': 1500000000}
+
+        expected_result = torrents.create_bencoded_torrent(
+            _Torrent(), bencoded_info,
+            dict(metadata_base, **torrents.create_tracker_metadata(trackers, webseeds)))
+
+        payload = bencode.encode(torrents.create_tracker_metadata(trackers, webseeds))
+        bencoded_values = bencode.split_dict(payload)
+        self.assertEqual(sorted(bencoded_values), ['announce', 'announce-list', 'url-list'])
+
+        self.assertEqual(torrents.create_bencoded_torrent(_Torrent(), bencoded_info,
+                                                          dict(metadata_base),
+                                                          bencoded_values=bencoded_values),
+                         expected_result)
+
+        prefix, suffix = torrents.create_bencoded_torrent_parts(_Torrent(), dict(metadata_base),
+                                                                bencoded_values)
+        self.assertEqual(prefix + bencoded_info + suffix, expected_result)
+
+
+if __name__ == '__main__':
+    unittest.main()
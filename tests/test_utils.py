@@ -1,4 +1,7 @@
+import io
+import time
 import unittest
+import zipfile
 from collections import OrderedDict
 
 from hashlib import sha1
@@ -110,6 +113,42 @@ class TestUtils(unittest.TestCase):
         }
         self.assertDictEqual(utils.flatten_dict(initial), expected)
 
+    def test_lru_cache(self):
+        cache = utils.LRUCache(max_entries=2, expiry=60)
+        self.assertIsNone(cache.get('a'))
+
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # 'b' is now the least recently used
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+        cache.put('d', 4, expiry=0.01)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('d', 'default'), 'default')
+        self.assertEqual(len(cache), 1)
+
+        self.assertEqual(dict(cache.stats),
+                         {'hits': 2, 'misses': 3, 'expired': 1, 'evictions': 2})
+        self.assertEqual(utils.hit_rate(cache.stats), 0.4)
+        self.assertIsNone(utils.hit_rate(utils.LRUCache().stats))
+
+    def test_stream_zip(self):
+        entries = [('a.torrent', (2017, 5, 1, 12, 0, 0), b'd4:infod4:name1:aee'),
+                   ('b.torrent', (2018, 1, 1, 0, 0, 0), b'')]
+        chunks = list(utils.stream_zip(iter(entries)))
+        self.assertEqual(len(chunks), 3)
+
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.namelist(), ['a.torrent', 'b.torrent'])
+            self.assertEqual(zip_file.getinfo('a.torrent').date_time, (2017, 5, 1, 12, 0, 0))
+            for name, _, data in entries:
+                self.assertEqual(zip_file.read(name), data)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# Benchmarks nyaa.bencode on generated large multi-file torrents.
+# Run from the repository root: python utils/bencode_bench.py [file counts...]
+import hashlib
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from nyaa import bencode, torrents  # noqa: E402
+from tests import bencode_reference  # noqa: E402
+
+DEFAULT_FILE_COUNTS = [100, 1000, 10000, 50000]
+DEFAULT_TRACKER_COUNTS = [10, 100, 1000]
+PIECE_LENGTH = 4 * 1024 * 1024
+
+
+def make_torrent(file_count, file_length=1000000, piece_layers=False):
+    ''' Returns a bencoded multi-file torrent with file_count files,
+        optionally with (fake) v2 piece layers '''
+    files = [
+        {
+            'length': file_length + i,
+            'path': [b'Season %02d' % (i // 1000), b'[Group] Some Show - %05d [1080p].mkv' % i]
+        }
+        for i in range(file_count)
+    ]
+    total_size = sum(f['length'] for f in files)
+    piece_count = total_size // PIECE_LENGTH + 1
+
+    torrent = {
+        'announce': 'http://127.0.0.1:6881/announce',
+        'announce-list': [['http://127.0.0.1:6881/announce'], ['udp://127.0.0.1:6969']],
+        'created by': 'bencode_bench',
+        'creation date': 1500000000,
+        'encoding': 'UTF-8',
+        'info': {
+            'name': 'Some Show',
+            'piece length': PIECE_LENGTH,
+            'pieces': os.urandom(20 * piece_count),
+            'files': files,
+        },
+    }
+    if piece_layers:
+        # Real keys are binary merkle roots, which only decode as skipped values
+        torrent['piece layers'] = {
+            os.urandom(16).hex(): os.urandom(32 * (f['length'] // PIECE_LENGTH + 1))
+            for f in files
+        }
+    return bencode.encode(torrent)
+
+
+def bench(label, func, number):
+    best = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print('  {:<8} {:9.2f}ms'.format(label, best * 1000))
+    return best
+
+
+def bench_decode(file_counts):
+    print('Decoding (best of 3)')
+    for file_count in file_counts:
+        data = make_torrent(file_count)
+        number = max(1, 2000 // file_count)
+        assert bencode.decode(data) == bencode_reference.stream_decode(data)
+
+        print('{} files, {:,} bytes'.format(file_count, len(data)))
+        stream_time = bench('stream', lambda: bencode_reference.stream_decode(data), number)
+        buffer_time = bench('buffer', lambda: bencode.decode(data), number)
+        print('  speedup  {:9.1f}x'.format(stream_time / buffer_time))
+
+
+def bench_info_hash(file_counts):
+    print('Decoding and hashing the info dict (best of 3)')
+    for file_count in file_counts:
+        data = make_torrent(file_count)
+        number = max(1, 2000 // file_count)
+
+        def reencode():
+            torrent_dict = bencode.decode(data)
+            return hashlib.sha1(bencode.encode(torrent_dict['info'])).digest()
+
+        def span():
+            torrent_dict, (start, end, canonical) = bencode.decode_with_span(data, 'info')
+            return hashlib.sha1(memoryview(data)[start:end]).digest()
+
+        assert reencode() == span()
+
+        print('{} files, {:,} bytes'.format(file_count, len(data)))
+        reencode_time = bench('reencode', reencode, number)
+        span_time = bench('span', span, number)
+        print('  speedup  {:9.1f}x'.format(reencode_time / span_time))
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_lazy_decode(file_counts):
+    print('Peak memory while decoding 1GB files, eager vs. lazy (pieces as a view)')
+    for file_count in file_counts:
+        data = make_torrent(file_count, file_length=1024 ** 3, piece_layers=True)
+
+        def eager():
+            return bencode.decode_with_span(data, 'info')
+
+        def lazy():
+            return bencode.decode_with_span(data, 'info', view_threshold=64 * 1024)
+
+        assert eager() == lazy()
+
+        print('{} files, {:,} bytes'.format(file_count, len(data)))
+        print('  {:<8} {:9,}B'.format('eager', peak_memory(eager)))
+        print('  {:<8} {:9,}B'.format('lazy', peak_memory(lazy)))
+
+
+def make_metadata_base(tracker_count):
+    ''' Returns a metadata dict like torrents.create_default_metadata_base, with
+        tracker_count trackers and webseeds '''
+    trackers = ['udp://tracker{}.example.org:{}/announce'.format(i, 1000 + i)
+                for i in range(tracker_count)]
+    return {
+        'created by': 'NyaaV2',
+        'creation date': 1500000000,
+        'comment': 'https://nyaa.si/view/1234567',
+        'announce': trackers[0],
+        'announce-list': [[tracker] for tracker in trackers],
+        'url-list': ['https://webseed{}.example.org/files/'.format(i)
+                     for i in range(tracker_count)],
+    }
+
+
+class _BenchTorrent(object):
+    encoding = 'utf-8'
+
+
+def bench_encode(tracker_counts):
+    print('Encoding metadata and assembling a .torrent (best of 3)')
+    bencoded_info = bencode.encode(bencode.decode(make_torrent(100))['info'])
+    torrent = _BenchTorrent()
+
+    def concatenate(metadata_base):
+        # What torrents.create_bencoded_torrent used to do
+        metadata_base = dict(metadata_base, encoding=torrent.encoding)
+        join_encode = bencode_reference.join_encode
+        prefix = join_encode({k: v for k, v in metadata_base.items() if k < 'info'})
+        suffix = join_encode({k: v for k, v in metadata_base.items() if k > 'info'})
+        return prefix[:-1] + b'4:info' + bencoded_info + suffix[1:]
+
+    def single_buffer(metadata_base):
+        return torrents.create_bencoded_torrent(torrent, bencoded_info, dict(metadata_base))
+
+    for tracker_count in tracker_counts:
+        metadata_base = make_metadata_base(tracker_count)
+        number = max(1, 20000 // tracker_count)
+        assert bencode_reference.join_encode(metadata_base) == bencode.encode(metadata_base)
+        assert concatenate(metadata_base) == single_buffer(metadata_base)
+
+        print('{} trackers and webseeds'.format(tracker_count))
+        join_time = bench('join', lambda: bencode_reference.join_encode(metadata_base), number)
+        buffer_time = bench('buffer', lambda: bencode.encode(metadata_base), number)
+        print('  speedup  {:9.1f}x'.format(join_time / buffer_time))
+        concat_time = bench('concat', lambda: concatenate(metadata_base), number)
+        single_time = bench('single', lambda: single_buffer(metadata_base), number)
+        print('  speedup  {:9.1f}x'.format(concat_time / single_time))
+
+
+if __name__ == '__main__':
+    file_counts = [int(arg) for arg in sys.argv[1:]] or DEFAULT_FILE_COUNTS
+    bench_decode(file_counts)
+    bench_info_hash(file_counts)
+    bench_lazy_decode(file_counts)
+    bench_encode(DEFAULT_TRACKER_COUNTS)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Compares worker CPU time per .torrent download for the TORRENT_FILE_DELIVERY modes.
+# Only the work done in the Python worker is measured (the front-end's share is not).
+# Run from the repository root: python utils/download_bench.py [file counts...]
+import hashlib
+import itertools
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from bencode_bench import make_metadata_base, make_torrent  # noqa: E402
+from nyaa import bencode, torrents  # noqa: E402
+
+DEFAULT_FILE_COUNTS = [10, 1000, 10000, 50000]
+TRACKER_COUNT = 20
+BUFFER_SIZE = 64 * 1024
+
+
+class _BenchTorrent(object):
+    encoding = 'utf-8'
+
+    def __init__(self, info_dict_path, info_hash):
+        self.info_dict_path = info_dict_path
+        self.info_hash = info_hash
+        self.info_hash_as_hex = info_hash.hex()
+
+
+def send(out_fd, body):
+    ''' Writes out a response body the way a WSGI server would '''
+    for chunk in body:
+        os.write(out_fd, chunk)
+
+
+def download_python(torrent, metadata_base, out_fd):
+    with open(torrent.info_dict_path, 'rb') as in_file:
+        bencoded_info = in_file.read()
+    torrent_file = torrents.create_bencoded_torrent(torrent, bencoded_info, dict(metadata_base))
+    hashlib.sha1(torrent_file).hexdigest()
+    send(out_fd, [torrent_file])
+
+
+def download_ssi(torrent, metadata_base, out_fd):
+    info_hash = torrent.info_hash_as_hex
+    ssi_include = '<!--# include virtual="/_info_dicts/{0}/{1}/{2}" -->'.format(
+        info_hash[0:2], info_hash[2:4], info_hash)
+    torrent_file = torrents.create_bencoded_torrent(
+        torrent, ssi_include.encode('ascii'), dict(metadata_base))
+    hashlib.sha1(torrent_file).hexdigest()
+    send(out_fd, [torrent_file])
+
+
+def download_file_wrapper(torrent, metadata_base, out_fd):
+    prefix, suffix = torrents.create_bencoded_torrent_parts(torrent, dict(metadata_base))
+    hashlib.sha1(prefix + torrent.info_hash + suffix).hexdigest()
+    with open(torrent.info_dict_path, 'rb') as info_file:
+        os.fstat(info_file.fileno())
+        # What werkzeug's FileWrapper does when the server has no wsgi.file_wrapper
+        info_chunks = iter(lambda: info_file.read(BUFFER_SIZE), b'')
+        send(out_fd, itertools.chain((bytes(prefix),), info_chunks, (bytes(suffix),)))
+
+
+MODES = [
+    ('python', download_python),
+    ('ssi', download_ssi),
+    ('wrapper', download_file_wrapper),
+]
+
+
+def cpu_per_download(func, number):
+    start = time.process_time()
+    for _ in range(number):
+        func()
+    return (time.process_time() - start) / number
+
+
+def bench_downloads(file_counts):
+    print('Worker CPU time per download (best of 3)')
+    metadata_base = make_metadata_base(TRACKER_COUNT)
+    out_fd = os.open(os.devnull, os.O_WRONLY)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for file_count in file_counts:
+            bencoded_info = bencode.encode(bencode.decode(make_torrent(file_count))['info'])
+            info_hash = hashlib.sha1(bencoded_info).digest()
+
+            info_dict_path = os.path.join(temp_dir, info_hash.hex())
+            with open(info_dict_path, 'wb') as out_file:
+                out_file.write(bencoded_info)
+            torrent = _BenchTorrent(info_dict_path, info_hash)
+
+            number = max(10, 20000 // file_count)
+            print('{} files, {:,} byte info dict'.format(file_count, len(bencoded_info)))
+            for label, download in MODES:
+                best = min(cpu_per_download(lambda: download(torrent, metadata_base, out_fd),
+                                            number)
+                           for _ in range(3))
+                print('  {:<8} {:9.3f}ms'.format(label, best * 1000))
+
+    os.close(out_fd)
+
+
+if __name__ == '__main__':
+    file_counts = [int(arg) for arg in sys.argv[1:]] or DEFAULT_FILE_COUNTS
+    bench_downloads(file_counts)
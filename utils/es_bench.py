@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# Compares search latency with a new Elasticsearch client per search (how search_elastic
+# used to work) against the per-process pooled client in nyaa.extensions.
+# Runs against a local stand-in that answers every request with a canned search response,
+# so only the client-side and connection costs differ.
+# Run from the repository root: python utils/es_bench.py [--searches N] [--threads N]
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import flask
+
+from elasticsearch import Elasticsearch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from nyaa.extensions import ElasticsearchClient  # noqa: E402
+
+SEARCH_BODY = {'query': {'bool': {'filter': [{'term': {'hidden': False}}]}},
+               'sort': [{'id': {'order': 'desc'}}], 'from': 0, 'size': 75}
+
+
+def make_response_body(hit_count=75):
+    hits = [{'_index': 'nyaa', '_type': '_doc', '_id': str(i), '_score': None,
+             '_source': {'id': i, 'display_name': 'Torrent {}'.format(i), 'filesize': i * 1000},
+             'sort': [i]} for i in range(hit_count)]
+    return json.dumps({'took': 1, 'timed_out': False,
+                       '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+                       'hits': {'total': {'value': 10000, 'relation': 'gte'},
+                                'max_score': None, 'hits': hits}}).encode('utf-8')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    response_body = make_response_body()
+    delay = 0
+
+    def setup(self):
+        super().setup()
+        # Like ES itself, otherwise kept-alive connections wait on delayed ACKs
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if self.delay:
+            time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(self.response_body)))
+        self.end_headers()
+        self.wfile.write(self.response_body)
+
+    do_GET = do_POST = do_HEAD = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stand_in(delay):
+    StandInHandler.delay = delay
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, '127.0.0.1:{}'.format(server.server_address[1])
+
+
+def run(search, searches, threads):
+    ''' Returns the sorted latencies (ms) of running search() searches times '''
+    def timed(_):
+        started = time.perf_counter()
+        search()
+        return (time.perf_counter() - started) * 1000
+
+    with ThreadPoolExecutor(threads) as executor:
+        return sorted(executor.map(timed, range(searches)))
+
+
+def percentile(sorted_values, percent):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--searches', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--delay', type=float, default=0,
+                        help='Seconds the stand-in takes to answer each request')
+    args = parser.parse_args()
+
+    server, host = start_stand_in(args.delay)
+
+    app = flask.Flask(__name__)
+    app.config.update(ES_HOSTS=[host], ES_POOL_SIZE=args.pool_size)
+    es = ElasticsearchClient(app)
+
+    def search_new_client():
+        Elasticsearch(hosts=[host]).search(index='nyaa', body=SEARCH_BODY)
+
+    def search_pooled_client():
+        es.client.search(index='nyaa', body=SEARCH_BODY)
+
+    print('{} searches, {} threads, stand-in delay {:.1f}ms'.format(
+        args.searches, args.threads, args.delay * 1000))
+    for label, search in (('new client', search_new_client),
+                          ('pooled client', search_pooled_client)):
+        run(search, min(100, args.searches), args.threads)  # Warm up
+        latencies = run(search, args.searches, args.threads)
+        print('{:>14}: p50 {:6.2f}ms  p99 {:6.2f}ms  mean {:6.2f}ms'.format(
+            label, percentile(latencies, 50), percentile(latencies, 99),
+            sum(latencies) / len(latencies)))
+
+    print('pooled client stats: {}'.format(es.stats.as_dict()))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()